@@ -30,16 +30,15 @@ import pi                   #
 import stackless
 import urlparse, cStringIO
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from stacklesslib.broadcast import Topic
 
 # Import the pi.comet related modules.
 import time, cgi
-piChatMessages = []
-# The channel needs to have its waiting tasklets scheduled for later
-# resumption rather than being immediately run.  This means that the
-# chat broadcast can happen without blocking or creating extra
-# unnecessary tasklets to invoke the channel send.
-waitChannel = stackless.channel()
-waitChannel.preference = 1
+# The chat messages, of which the last 1000 are kept.  The topic's waiting
+# tasklets are scheduled for later resumption rather than being immediately
+# run.  This means that the chat broadcast can happen without blocking or
+# creating extra unnecessary tasklets to invoke the channel send.
+piChat = Topic("chat", history_size=1000)
 
 pages = {
     "/":            "index.html",
@@ -100,12 +99,16 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.send_header("Content-type", pi.getContentType(cometType))
         self.end_headers()
     
-        global piChatMessages, waitChannel
-        
+        # Start with the history, then send each message once as it comes.
+        # The page shows the same as when the whole history was sent every
+        # time, as getData() in index.html skips the ids it has already seen
+        # and appends the rest.  Only the last 1000 messages are in the
+        # history though, so a page opened later starts with those.
+        messages, cursor = piChat.read(0)
         while True:
             output = "["
             first = True
-            for x in piChatMessages:
+            for x in messages:
                 if first==False:output+=","
                 else: first = False
                 output += "{ id:%i, 'text':'%s', 'nickname':'%s' }"%(x[2],x[0],x[1])
@@ -113,12 +116,11 @@ class RequestHandler(BaseHTTPRequestHandler):
             s = pi.getOutput(output,cometType,cometName)
             self.wfile.write(s)
 
-            # Block this tasklet on the common channel waiting for further
-            # messages.  This is not really that safe, the connection it is
-            # blocking may need special handling.  What happens if it closes?
-            # Does it need regular awakening to send token messages to keep
-            # the connection alive?
-            waitChannel.receive()
+            # Block this tasklet waiting for further messages.  This is not
+            # really that safe, the connection it is blocking may need special
+            # handling.  What happens if it closes?  Does it need regular
+            # awakening to send token messages to keep the connection alive?
+            messages, cursor = piChat.wait(cursor)
             
     def pi_send(self, nickname, text):
         # These messages come in through an XHR connection.  The web page
@@ -134,16 +136,9 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.send_header("Content-type", "text/html")
         self.end_headers()
 
-        global piChatMessages, waitChannel
-        piChatMessages.append((text, nickname, len(piChatMessages)))
-        
-        # With normal channel behaviour, calling this would block this tasklet as
-        # each blocked subscriber channel was sent to and immediately received.
-        # Instead because each subscriber channel has had its preference changed
-        # each send will schedule the tasklet waiting on the other side of the
-        # channel.
-        while waitChannel.balance < 0:
-            waitChannel.send(None)
+        # This schedules each tasklet waiting in pi_push, rather than
+        # running it straight away.
+        piChat.publish((text, nickname, piChat.cursor()))
             
 
 class StacklessHTTPServer(HTTPServer):
@@ -0,0 +1,227 @@
+#
+# Measures how many small calls a second can be made over a stacklessrpc
+# connection.
+#
+# A server and a client endpoint are connected over the loopback interface
+# in this one process, using the stacklesslib socket replacement.  Caller
+# tasklets on the client side make calls with a few small arguments to a
+# function on the server side which just returns them, one call after
+# another, and the completed round trips are counted.
+#
+# Usage: python benchmark.py [seconds] [callers ...]
+#        python benchmark.py codecs [seconds]
+#        python benchmark.py batch [seconds] [batch sizes ...]
+#
+# The number of concurrent caller tasklets defaults to 1 and 100.  The
+# second form measures the packet encoding alone: the size of a call packet
+# and how many can be encoded and decoded a second, for each codec and some
+# typical payloads.  The pickled tuple which packets used to be is there to
+# compare against.
+#
+# The third form has a single caller make the calls in batches, with a
+# result wanted for the last call in each batch only, and the rest sent as
+# notifications.  Batch sizes default to 1, 10 and 100.
+#
+
+from __future__ import with_statement
+import sys, time, asyncore, struct, cPickle
+import stackless
+from stacklesslib.replacements import socket_asyncore
+
+import socket
+from socket import AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+import rpc
+
+SERVER_HOST = "127.0.0.1"
+DEFAULT_CALLERS = [ 1, 100 ]
+DEFAULT_BATCH_SIZES = [ 1, 10, 100 ]
+
+
+# The socket replacement's own manager tasklet waits in select for a fixed
+# interval, which would be most of the time taken by a round trip.  This
+# one only waits when no other tasklet can run.
+def ManageSockets():
+    try:
+        while len(asyncore.socket_map):
+            if stackless.runcount > 1:
+                asyncore.poll(0)
+            else:
+                asyncore.poll(0.05)
+            stackless.schedule()
+    finally:
+        StartManager.running = False
+
+def StartManager():
+    if not StartManager.running:
+        StartManager.running = True
+        stackless.tasklet(ManageSockets)()
+StartManager.running = False
+
+
+class EchoEndPoint(rpc.EndPoint):
+    def DispatchIncomingCall(self, functionID, args, kwargs):
+        return args
+
+
+def ConnectEndPoints():
+    """Returns a client endpoint, and the server endpoint connected to it."""
+    listenSocket = socket.socket(AF_INET, SOCK_STREAM)
+    listenSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    listenSocket.bind((SERVER_HOST, 0))
+    listenSocket.listen(1)
+
+    clientSocket = socket.socket(AF_INET, SOCK_STREAM)
+    clientSocket.connect(listenSocket.getsockname())
+    serverSocket, clientAddress = listenSocket.accept()
+    listenSocket.close()
+    for s in (clientSocket, serverSocket):
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return rpc.EndPoint(clientSocket), EchoEndPoint(serverSocket)
+
+
+def MeasureCalls(callers, seconds):
+    """Returns the number of round trips per second made by the given
+    number of concurrent caller tasklets."""
+    clientEndPoint, serverEndPoint = ConnectEndPoints()
+    svc = rpc.RemoteEndPoint(clientEndPoint, "benchmark")
+    counts = []
+    doneChannel = stackless.channel()
+    endTime = time.time() + seconds
+
+    def Caller():
+        count = 0
+        while time.time() < endTime:
+            svc.Echo(1, "two", 3.0)
+            count += 1
+        counts.append(count)
+        doneChannel.send(None)
+
+    startTime = time.time()
+    for i in range(callers):
+        stackless.tasklet(Caller)()
+    for i in range(callers):
+        doneChannel.receive()
+    elapsed = time.time() - startTime
+
+    clientEndPoint.Release()
+    serverEndPoint.Release()
+    clientEndPoint.socket.close()
+    serverEndPoint.socket.close()
+    return sum(counts) / elapsed
+
+
+def MeasureBatches(batchSize, seconds):
+    """Returns the number of calls per second made in batches of the given
+    size."""
+    clientEndPoint, serverEndPoint = ConnectEndPoints()
+    count = 0
+    startTime = time.time()
+    endTime = startTime + seconds
+    while time.time() < endTime:
+        with rpc.Batch(clientEndPoint) as batch:
+            svc = batch.RemoteEndPoint("benchmark")
+            for i in xrange(batchSize - 1):
+                svc.Echo.Notify(1, "two", 3.0)
+            future = svc.Echo(1, "two", 3.0)
+        future.Wait()
+        count += batchSize
+    elapsed = time.time() - startTime
+
+    clientEndPoint.Release()
+    serverEndPoint.Release()
+    clientEndPoint.socket.close()
+    serverEndPoint.socket.close()
+    return count / elapsed
+
+
+CODEC_PAYLOADS = [
+    ("null call", (("svc", "Ping"), (), {})),
+    ("small args", (("svc", "Move"), (12345, 1.5, -2.25, "player"), { "flags": 3 })),
+    ("1 KB string", (("svc", "Store"), ("x" * 1024,), {})),
+    ("100 item dict", (("svc", "Update"), (dict(("key%d" % i, i * 1.5) for i in range(100)),), {})),
+]
+
+
+def MeasureRate(function, seconds):
+    count = 0
+    endTime = time.time() + seconds
+    startTime = time.time()
+    while True:
+        for i in xrange(100):
+            function()
+        count += 100
+        now = time.time()
+        if now >= endTime:
+            return count / (now - startTime)
+
+
+def MeasureCodecs(seconds):
+    headerFmt = rpc.EndPoint.packetHeaderFmt
+    headerLength = rpc.EndPoint.packetHeaderLength
+    print "%-14s %-18s %8s %12s %12s" % ("payload", "codec", "bytes", "encodes/s", "decodes/s")
+    for payloadName, payload in CODEC_PAYLOADS:
+        def OldEncode():
+            return cPickle.dumps((rpc.PKT_CALL, 7, payload))
+        def OldDecode():
+            return cPickle.loads(oldPacket)
+        oldPacket = OldEncode()
+        measurements = [ ("pickle0 (old)", oldPacket, OldEncode, OldDecode) ]
+
+        for codec in rpc.codecsByID.values():
+            def Encode(codec=codec):
+                return struct.pack(headerFmt, rpc.PKT_CALL, codec.codecID, 7) + codec.dumps(payload)
+            def Decode(codec=codec):
+                struct.unpack_from(headerFmt, packet)
+                return codec.loads(packet[headerLength:])
+            try:
+                packet = Encode()
+            except ValueError:
+                continue
+            assert Decode() == payload
+            measurements.append((codec.name, packet, Encode, Decode))
+
+        for codecName, packet, encode, decode in measurements:
+            print "%-14s %-18s %8d %12.0f %12.0f" % (payloadName, codecName, len(packet),
+                MeasureRate(encode, seconds), MeasureRate(decode, seconds))
+
+
+def Run(seconds, callerCounts=None, batchSizes=None):
+    socket_asyncore.stacklesssocket_manager(StartManager)
+    socket_asyncore.install()
+
+    def RunAll():
+        if callerCounts:
+            print "%8s %14s %12s" % ("callers", "round trips/s", "us per call")
+            for callers in callerCounts:
+                rate = MeasureCalls(callers, seconds)
+                print "%8d %14.0f %12.1f" % (callers, rate, 1e6 / rate)
+        if batchSizes:
+            print "%8s %14s %12s" % ("batch", "calls/s", "us per call")
+            for batchSize in batchSizes:
+                rate = MeasureBatches(batchSize, seconds)
+                print "%8d %14.0f %12.1f" % (batchSize, rate, 1e6 / rate)
+
+    stackless.tasklet(RunAll)()
+    while stackless.runcount > 1:
+        stackless.run()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == [ "codecs" ]:
+        seconds = 0.5
+        if len(args) > 1:
+            seconds = float(args[1])
+        MeasureCodecs(seconds)
+    elif args[:1] == [ "batch" ]:
+        seconds = 3.0
+        if len(args) > 1:
+            seconds = float(args[1])
+        batchSizes = [ int(arg) for arg in args[2:] ] or DEFAULT_BATCH_SIZES
+        Run(seconds, batchSizes=batchSizes)
+    else:
+        seconds = 3.0
+        if args:
+            seconds = float(args[0])
+        callerCounts = [ int(arg) for arg in args[1:] ] or DEFAULT_CALLERS
+        Run(seconds, callerCounts)
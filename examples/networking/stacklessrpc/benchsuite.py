@@ -0,0 +1,251 @@
+#
+# Canned benchmarks for stacklessrpc, to keep as a baseline and compare
+# between revisions.
+#
+# In each scenario a number of caller tasklets make calls to a function on
+# the server, which returns the payload it was given, one call after another
+# for some seconds.  The results are:
+#   calls/s     completed calls per second
+#   p50, p99    the latency of the calls, in milliseconds
+#   bytes/call  the bytes sent and received by the client, headers and all
+#
+# The server runs in this process, sharing the scheduler with the callers,
+# unless --process is given, in which case it runs in a child process of
+# its own.  With --phases, both endpoints add up the time spent in each
+# phase of the calls (see EndPoint.EnablePhaseTiming), and it is shown in
+# microseconds per call.  The phase timing slows the calls down a little.
+#
+# Usage: python benchsuite.py [--process] [--phases] [--json] [-d seconds] [scenario ...]
+#
+# The scenarios are listed by -l.  With --json, one JSON object is printed
+# per scenario.
+#
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+import stackless
+from stacklesslib.replacements import socket_asyncore
+
+import socket
+from socket import AF_INET, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR
+import benchmark
+import rpc
+
+HOST = "127.0.0.1"
+
+# name: (description, payload size, callers)
+# A payload size of None makes null calls, with no arguments and no result.
+SCENARIOS = [
+    ("null-1", ("null calls, 1 caller", None, 1)),
+    ("null-100", ("null calls, 100 callers", None, 100)),
+    ("null-10k", ("null calls, 10000 callers", None, 10000)),
+    ("1kb-1", ("1 KB payloads, 1 caller", 1024, 1)),
+    ("1kb-100", ("1 KB payloads, 100 callers", 1024, 100)),
+    ("1kb-10k", ("1 KB payloads, 10000 callers", 1024, 10000)),
+    ("1mb-1", ("1 MB payloads, 1 caller", 1048576, 1)),
+    ("1mb-100", ("1 MB payloads, 100 callers", 1048576, 100)),
+]
+
+PHASES = ("serialize", "send", "queueWait", "dispatch", "reply")
+
+
+class BenchEndPoint(rpc.EndPoint):
+    def DispatchIncomingCall(self, functionID, args, kwargs):
+        if functionID == ("bench", "EnablePhaseTiming"):
+            self.EnablePhaseTiming()
+        elif functionID == ("bench", "GetPhaseTimes"):
+            return self.phaseTimes
+        elif args:
+            return args[0]
+
+
+def Serve(listenSocket, endpoints):
+    while True:
+        serverSocket, clientAddress = listenSocket.accept()
+        serverSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        endpoints.append(BenchEndPoint(serverSocket))
+
+
+def Listen(port=0):
+    listenSocket = socket.socket(AF_INET, SOCK_STREAM)
+    listenSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    listenSocket.bind((HOST, port))
+    listenSocket.listen(100)
+    return listenSocket
+
+
+def Percentile(sortedValues, fraction):
+    if not sortedValues:
+        return 0.0
+    return sortedValues[min(int(len(sortedValues) * fraction), len(sortedValues) - 1)]
+
+
+def RunScenario(name, seconds, address, phases=False):
+    """Run one scenario against the server at address, and return its
+    result as a dict."""
+    description, payloadSize, callers = dict(SCENARIOS)[name]
+    clientSocket = socket.socket(AF_INET, SOCK_STREAM)
+    clientSocket.connect(address)
+    clientSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    endpoint = rpc.EndPoint(clientSocket)
+    bench = rpc.RemoteEndPoint(endpoint, "bench")
+    if phases:
+        endpoint.EnablePhaseTiming()
+        bench.EnablePhaseTiming()
+        # Leave out the call which turned it on at the server.
+        for phase in PHASES:
+            endpoint.phaseTimes[phase] = 0.0
+
+    if payloadSize is None:
+        args = ()
+    else:
+        args = ("x" * payloadSize,)
+    latencies = []
+    doneChannel = stackless.channel()
+
+    def Caller():
+        try:
+            while time.time() < endTime:
+                startTime = time.time()
+                bench.Echo(*args)
+                latencies.append(time.time() - startTime)
+        finally:
+            doneChannel.send(None)
+
+    startBytes = endpoint.bytesSent + endpoint.bytesReceived
+    startTime = time.time()
+    endTime = startTime + seconds
+    for i in xrange(callers):
+        stackless.tasklet(Caller)()
+    for i in xrange(callers):
+        doneChannel.receive()
+    elapsed = time.time() - startTime
+    totalBytes = endpoint.bytesSent + endpoint.bytesReceived - startBytes
+
+    calls = len(latencies)
+    latencies.sort()
+    result = {
+        "scenario": name,
+        "description": description,
+        "payload_size": payloadSize or 0,
+        "callers": callers,
+        "calls": calls,
+        "seconds": elapsed,
+        "calls_per_sec": calls / elapsed,
+        "latency_ms": {
+            "p50": Percentile(latencies, 0.50) * 1000.0,
+            "p99": Percentile(latencies, 0.99) * 1000.0,
+            "max": Percentile(latencies, 1.0) * 1000.0,
+        },
+        "bytes_per_call": totalBytes / float(max(calls, 1)),
+    }
+    if phases:
+        clientTimes = dict(endpoint.phaseTimes)
+        serverTimes = bench.GetPhaseTimes()
+        result["phases_us"] = {
+            "client": dict((phase, clientTimes[phase] * 1e6 / max(calls, 1)) for phase in PHASES),
+            "server": dict((phase, serverTimes[phase] * 1e6 / max(calls, 1)) for phase in PHASES),
+        }
+
+    endpoint.Release()
+    clientSocket.close()
+    return result
+
+
+def Report(result, as_json):
+    if as_json:
+        print json.dumps(result, sort_keys=True)
+    else:
+        latency = result["latency_ms"]
+        print "%-10s %10.0f %9.3f %9.3f %11.0f" % (result["scenario"], result["calls_per_sec"],
+            latency["p50"], latency["p99"], result["bytes_per_call"])
+        if "phases_us" in result:
+            for side in ("client", "server"):
+                times = result["phases_us"][side]
+                print "  %-8s %s" % (side, "  ".join("%s %.1f" % (phase, times[phase]) for phase in PHASES))
+    sys.stdout.flush()
+
+
+def Main(names, seconds, as_json, inProcess=True, phases=False):
+    server = None
+    if not inProcess:
+        # The child says which port it is listening on, once it is.
+        server = subprocess.Popen([ sys.executable, os.path.abspath(__file__), "--serve" ],
+                                  stdout=subprocess.PIPE)
+        address = (HOST, int(server.stdout.readline()))
+
+    socket_asyncore.stacklesssocket_manager(benchmark.StartManager)
+    socket_asyncore.install()
+    try:
+        results = []
+        def RunAll():
+            if inProcess:
+                listenSocket = Listen()
+                serverEndPoints = []
+                serveTasklet = stackless.tasklet(Serve)(listenSocket, serverEndPoints)
+                serverAddress = listenSocket.getsockname()
+            else:
+                serverAddress = address
+            if not as_json:
+                print "%-10s %10s %9s %9s %11s" % ("scenario", "calls/s", "p50 ms", "p99 ms", "bytes/call")
+            for name in names:
+                result = RunScenario(name, seconds, serverAddress, phases)
+                result["in_process"] = inProcess
+                Report(result, as_json)
+                results.append(result)
+            if inProcess:
+                serveTasklet.kill()
+                listenSocket.close()
+                # Let the socket manager exit, and the scheduler with it.
+                for endpoint in serverEndPoints:
+                    endpoint.Release()
+                    endpoint.socket.close()
+        stackless.tasklet(RunAll)()
+        while stackless.runcount > 1:
+            stackless.run()
+        return results
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def ServeChild():
+    socket_asyncore.stacklesssocket_manager(benchmark.StartManager)
+    socket_asyncore.install()
+    def Start():
+        listenSocket = Listen()
+        print listenSocket.getsockname()[1]
+        sys.stdout.flush()
+        Serve(listenSocket, [])
+    stackless.tasklet(Start)()
+    while True:
+        stackless.run()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == [ "--serve" ]:
+        ServeChild()
+    elif args[:1] == [ "-l" ]:
+        for name, info in SCENARIOS:
+            print "%-10s %s" % (name, info[0])
+    else:
+        options = {}
+        for option in ("--process", "--phases", "--json"):
+            options[option] = option in args
+            if options[option]:
+                args.remove(option)
+        seconds = 3.0
+        if args[:1] == [ "-d" ]:
+            seconds = float(args[1])
+            del args[:2]
+        names = args or [ name for name, info in SCENARIOS ]
+        for name in names:
+            if name not in dict(SCENARIOS):
+                sys.exit("unknown scenario %r, see -l" % name)
+        Main(names, seconds, options["--json"], not options["--process"], options["--phases"])
@@ -16,6 +16,8 @@
 #  - The Stackless socket module has already been monkeypatched in place.
 #  - The responsibility for running the Stackless scheduler lies elsewhere.
 #  - Connected sockets are established and provided by the user.
+#  - For call timeouts, stacklesslib is importable and its main event queue
+#    is being pumped.
 #
 
 """
@@ -31,15 +33,138 @@ The ability to make function calls directly through a network connection
 is one example of this.
 """
 
-__all__ = [ "EndPoint", "RemoteEndPoint" ]
+__all__ = [ "EndPoint", "RemoteEndPoint", "Batch", "CallFuture", "ResultStream", "PickleCodec", "MarshalCodec",
+            "RPCError", "RemoteError", "CallTimeoutError", "CallCancelledError", "DisconnectedError",
+            "ProtocolError" ]
 
 import socket
-import types, struct, cPickle, sys
+import types, struct, cPickle, marshal, sys, time, traceback
+from collections import deque
 import stackless
 
+try:
+    from stacklesslib.util import channel_wait, WaitTimeoutError
+except ImportError:
+    channel_wait = None
+
 PKT_CALL = 1
 PKT_RESULT = 2
 PKT_ERROR = 3
+PKT_HELLO = 4
+PKT_NOTIFY = 5
+PKT_BATCH = 6
+PKT_CANCEL = 7
+PKT_PING = 8
+PKT_STREAM_START = 9
+PKT_STREAM = 10
+PKT_STREAM_END = 11
+PKT_CREDIT = 12
+PKT_CHUNK = 13
+PKT_CHUNK_END = 14
+
+
+class RPCError(Exception):
+    pass
+
+class RemoteError(RPCError):
+    """Raised for a call which raised an exception on the remote side.
+    excTypeName is the name of the exception's class there and excMessage
+    its message.  remoteTraceback is its formatted traceback, or None if the
+    remote side keeps those to itself."""
+    def __init__(self, excTypeName, excMessage, remoteTraceback=None):
+        RPCError.__init__(self, excTypeName, excMessage, remoteTraceback)
+        self.excTypeName = excTypeName
+        self.excMessage = excMessage
+        self.remoteTraceback = remoteTraceback
+
+    def __str__(self):
+        return "%s: %s" % (self.excTypeName, self.excMessage)
+
+class CallTimeoutError(RPCError):
+    """Raised for a call whose result did not arrive in time."""
+
+class CallCancelledError(RPCError):
+    """Raised for a call which was cancelled, on the calling side by a
+    cancelled future and on the remote side in the tasklet running it."""
+
+class DisconnectedError(RPCError):
+    """Raised for a call which the connection dropped under, or which was
+    made after it had."""
+
+class ProtocolError(RPCError):
+    """Raised for a packet which the endpoint cannot make sense of.  A call
+    which cannot be decoded is answered with it, and anything else drops
+    the connection, as what follows cannot be trusted either."""
+
+
+class PickleCodec:
+    """Serialises payloads with binary pickles, which can hold almost
+    anything.  Unpickling can be made to run arbitrary code."""
+    name = "pickle2"
+    codecID = 1
+
+    def dumps(self, payload):
+        return cPickle.dumps(payload, 2)
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+
+class MarshalCodec:
+    """Serialises payloads of plain data (numbers, strings, and tuples, lists
+    and dictionaries of them) with the marshal module, which is faster and
+    more compact than pickling.  Other payloads raise ValueError."""
+    name = "marshal"
+    codecID = 2
+
+    # Marshal writes subclasses of these, and buffers like array.array, out
+    # as if they were the base type or raw bytes, so only the exact types
+    # are let through.
+    scalarTypes = frozenset([ types.NoneType, bool, int, long, float, complex, str, unicode ])
+    containerTypes = frozenset([ tuple, list, set, frozenset ])
+
+    def dumps(self, payload):
+        self._CheckPlain(payload)
+        return marshal.dumps(payload, 2)
+
+    def _CheckPlain(self, payload):
+        # Walked without recursion, keeping the containers on the way down
+        # to the current value to spot ones which contain themselves.
+        pending = [ (False, payload) ]
+        path = set()
+        while pending:
+            leaving, value = pending.pop()
+            if leaving:
+                path.remove(id(value))
+                continue
+            valueType = type(value)
+            if valueType in self.scalarTypes:
+                continue
+            if valueType is dict:
+                contents = value.items()
+            elif valueType in self.containerTypes:
+                contents = value
+            else:
+                raise ValueError("marshal cannot encode %s" % valueType.__name__)
+            if id(value) in path:
+                raise ValueError("marshal cannot encode recursive payloads")
+            path.add(id(value))
+            pending.append((True, value))
+            pending.extend((False, item) for item in contents)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+
+codecsByName = {}
+codecsByID = {}
+def RegisterCodec(codec):
+    codecsByName[codec.name] = codec
+    codecsByID[codec.codecID] = codec
+
+RegisterCodec(PickleCodec())
+RegisterCodec(MarshalCodec())
+
 
 class EndPoint:
     """Used to manage incoming and outgoing packets over a socket, allowing
@@ -56,24 +181,154 @@ class EndPoint:
 
     packetSizeFmt = "!I"
     packetSizeLength = struct.calcsize(packetSizeFmt)
+    # Each packet starts with the packet type, the id of the codec of the
+    # payload and the callID.  None of those go through a codec.
+    packetHeaderFmt = "!BBI"
+    packetHeaderLength = struct.calcsize(packetHeaderFmt)
+    # The codecs this endpoint accepts, in order of preference.  Each
+    # packet goes out with the first one that the peer accepts too and is
+    # able to encode its payload, so plain data takes the marshal fast path
+    # and anything else falls back to pickling.  No codec makes it safe to
+    # decode packets from a hostile peer: unpickling can run arbitrary code,
+    # and the marshal module is not hardened against malformed data either.
+    # Only connect endpoints to trusted peers.
+    codecNames = ( "marshal", "pickle2" )
+    # How much to ask the socket for at a time.  Many small packets can
+    # arrive in one read.
+    readBlockSize = 65536
+    # The most incoming calls which are dispatched at once, each in a worker
+    # tasklet of its own.  Further calls wait in a queue for a worker, so a
+    # slow call does not hold up the others.  None dispatches each call on
+    # the tasklet reading the socket, one after another.
+    maxConcurrentCalls = 32
+    # The seconds to wait for the result of a call before giving up on it,
+    # unless the call says otherwise.  None waits for as long as it takes.
+    callTimeout = None
+    # Whether the remote side gets the tracebacks of the calls which fail.
+    # The type and message of the exception are always sent.
+    sendErrorTracebacks = True
+    # Packets bigger than this are sent in chunks of this size, so that the
+    # packets of other tasklets go out in between rather than wait for all
+    # of it, and no single read or write has to be larger.  Chunking does
+    # not bound memory use: the whole packet is encoded before it is sent,
+    # and its chunks are held until the last arrives.  Only results streamed
+    # from generators are bounded in size.
+    chunkSize = 262144
+    # The largest packet put back together from chunks.  A call over it is
+    # answered with an error, and anything else drops the connection.  None
+    # puts no limit on it.
+    maxChunkedPacketSize = 67108864
+    # When a call returns a generator, its items are sent to the caller as
+    # they are produced, each in a packet of its own.  No more than this
+    # many go out ahead of those the caller has taken.  As each item costs a
+    # packet, generators should yield pieces of a fair size, like lists of
+    # rows rather than single rows.
+    streamWindow = 64
+    # Set to a dictionary by EnablePhaseTiming, to add up where the time
+    # spent on calls goes.
+    phaseTimes = None
 
-    def __init__(self, epSocket):
+    def __init__(self, epSocket, codecNames=None):
         """Stores and manages the socket to allow synchronous calls over it."""
         self.socket = epSocket
         self.callID = 0
+        # The CallFuture of each call awaiting a result.
         self.channelsByCallID = {}
+        # The ResultStream of each call whose result is being streamed.
+        self.streamsByCallID = {}
+        self.disconnected = False
+
+        if codecNames is not None:
+            self.codecNames = tuple(codecNames)
+        for name in self.codecNames:
+            if name not in codecsByName:
+                raise ValueError("unknown codec %r" % name)
+        # Until the peer says which codecs it accepts, assume it accepts ours.
+        self.sendCodecs = [ codecsByName[name] for name in self.codecNames ]
+        self.acceptedCodecIDs = set(codec.codecID for codec in self.sendCodecs)
+
+        # Data read from the socket but not yet handed out as packets starts
+        # at readOffset.
+        self.readBuffer = ""
+        self.readOffset = 0
+
+        # Incoming calls waiting for a worker, as (handler, args, queueTime).
+        self.callQueue = deque()
+        self.callWorkers = 0
+        self.callsDispatched = 0
+        self.callQueuePeak = 0
+        self.callQueueWaitTime = 0.0
+        # The tasklet running each incoming call, so that it can be cancelled.
+        self.callsInProgress = {}
+        # The _StreamCredit of each incoming call streaming its result.
+        self.streamCredits = {}
+
+        # Large packets being received in chunks, by chunkID, and how many
+        # bytes of each have arrived.
+        self.chunkID = 0
+        self.chunksByID = {}
+        self.chunkBytesByID = {}
+        # The chunkIDs of packets which were too large, whose remaining
+        # chunks are ignored.
+        self.refusedChunkIDs = set()
+
+        # Packets are written by whichever tasklet has a result or a call to
+        # send.  Those waiting for another to finish block on this channel,
+        # created when first needed.
+        self.sending = False
+        self.sendingTasklet = None
+        self.sendWaitChannel = None
+
+        # The bytes written to and read from the socket.
+        self.bytesSent = 0
+        self.bytesReceived = 0
 
         self.tasklet = stackless.tasklet(self._ManageSocket)()
 
+    def EnablePhaseTiming(self):
+        """Starts adding up the seconds spent in each phase of the calls
+        going through this endpoint, in the phaseTimes dictionary:
+        - serialize: encoding and decoding packets.
+        - send: writing packets, including waiting for a turn to.
+        - queueWait: incoming calls waiting for a worker.
+        - dispatch: running incoming calls.
+        - reply: results waiting for their callers to run again.
+        It costs a little time of its own, so is off by default."""
+        self.phaseTimes = dict.fromkeys(("serialize", "send", "queueWait", "dispatch", "reply"), 0.0)
+
     def Release(self):
         self.tasklet.kill()
+        # In case the tasklet had not started, or had already exited.
+        if not self.disconnected:
+            self._Disconnected()
 
     def _ManageSocket(self):
         try:
+            # Tell the peer which codecs we accept.
+            self._SendPacket(PKT_HELLO, 0, self.codecNames)
             self._ReceivePackets()
         except socket.error:
             # Disconnection while blocking on a recv call.
-            return
+            pass
+        except ProtocolError:
+            traceback.print_exc()
+            sys.exc_clear()
+            # Let the peer know, rather than leave it waiting on results.
+            self.socket.close()
+        finally:
+            self._Disconnected()
+
+    def _Disconnected(self):
+        """Fails all the calls awaiting results, as none will arrive."""
+        self.disconnected = True
+        futures = self.channelsByCallID.values() + self.streamsByCallID.values()
+        self.channelsByCallID.clear()
+        self.streamsByCallID.clear()
+        for future in futures:
+            future.send_exception(DisconnectedError, "The connection was lost")
+        # Nothing can be streamed any more.
+        for credit in self.streamCredits.values():
+            credit.Add(None)
 
     def _ReceivePackets(self):
         rawPacket = self._ReadIncomingPacket()
@@ -82,47 +337,335 @@ class EndPoint:
             rawPacket = self._ReadIncomingPacket()
 
     def _ReadIncomingPacket(self):
-        sizeData = self._ReadIncomingData(self.packetSizeLength)
-        if sizeData:
-            dataLength = struct.unpack(self.packetSizeFmt, sizeData)[0]
-            return self._ReadIncomingData(dataLength)
+        """Returns the next packet, only reading from the socket when the
+        buffered data does not hold all of it."""
+        sizeLength = self.packetSizeLength
+        while True:
+            readBuffer, offset = self.readBuffer, self.readOffset
+            available = len(readBuffer) - offset
+            if available >= sizeLength:
+                dataLength = struct.unpack_from(self.packetSizeFmt, readBuffer, offset)[0]
+                end = offset + sizeLength + dataLength
+                if end <= len(readBuffer):
+                    self.readOffset = end
+                    return readBuffer[offset + sizeLength:end]
+                needed = end - len(readBuffer)
+            else:
+                needed = sizeLength - available
 
-    def _ReadIncomingData(self, dataLength):
-        readBuffer = ""
-        while len(readBuffer) != dataLength:
-            data = self.socket.recv(dataLength - len(readBuffer))
+            if needed > self.readBlockSize:
+                # Read the rest of a large packet in one go, rather than
+                # growing the buffer a block at a time.
+                data = self._ReadIncomingData(needed)
+            else:
+                data = self.socket.recv(self.readBlockSize)
             if not data:
                 # print self.__class__.__name__, "socket unexpectedly disconnected"
                 return
-            readBuffer += data
-        return readBuffer
+            self.bytesReceived += len(data)
+            self.readBuffer = readBuffer[offset:] + data
+            self.readOffset = 0
+
+    def _ReadIncomingData(self, dataLength):
+        chunks = []
+        while dataLength:
+            data = self.socket.recv(dataLength)
+            if not data:
+                return
+            chunks.append(data)
+            dataLength -= len(data)
+        return "".join(chunks)
+
+    def _EncodePacket(self, packetType, callID, payload):
+        """Returns the packet for the given payload, without the size."""
+        if packetType == PKT_HELLO:
+            # Sent before the peer's codecs are known, so keep it simple.
+            return struct.pack(self.packetHeaderFmt, packetType, 0, callID) + ",".join(payload)
+        for codec in self.sendCodecs:
+            try:
+                data = codec.dumps(payload)
+            except (ValueError, TypeError, cPickle.PicklingError):
+                continue
+            return struct.pack(self.packetHeaderFmt, packetType, codec.codecID, callID) + data
+        raise ValueError("No codec accepted by the peer can encode %r" % (payload,))
+
+    def _DecodePacket(self, rawPacket):
+        """Returns the packet type, callID and payload of a packet."""
+        packetType, codecID, callID = struct.unpack_from(self.packetHeaderFmt, rawPacket)
+        data = rawPacket[self.packetHeaderLength:]
+        if packetType == PKT_HELLO:
+            return packetType, callID, data.split(",")
+        if codecID not in self.acceptedCodecIDs:
+            raise ProtocolError("Packet encoded with codec %d, which is not accepted" % codecID)
+        try:
+            return packetType, callID, codecsByID[codecID].loads(data)
+        except Exception, e:
+            raise ProtocolError("Packet could not be decoded: %s" % e)
 
     def _DispatchIncomingPacket(self, rawPacket):
-        packetType, callID, payload = cPickle.loads(rawPacket)
+        packetType, codecID, chunkID = struct.unpack_from(self.packetHeaderFmt, rawPacket)
+        if packetType in (PKT_CHUNK, PKT_CHUNK_END):
+            if chunkID in self.refusedChunkIDs:
+                if packetType == PKT_CHUNK_END:
+                    self.refusedChunkIDs.discard(chunkID)
+                return
+            chunks = self.chunksByID.setdefault(chunkID, [])
+            chunks.append(rawPacket[self.packetHeaderLength:])
+            size = self.chunkBytesByID.get(chunkID, 0) + len(chunks[-1])
+            if self.maxChunkedPacketSize is not None and size > self.maxChunkedPacketSize:
+                del self.chunksByID[chunkID]
+                self.chunkBytesByID.pop(chunkID, None)
+                if packetType == PKT_CHUNK:
+                    self.refusedChunkIDs.add(chunkID)
+                # The first chunk starts with the header of the packet.
+                error = ProtocolError("Packet larger than %d bytes" % self.maxChunkedPacketSize)
+                self._RefusePacket(chunks[0], error)
+                return
+            if packetType == PKT_CHUNK:
+                self.chunkBytesByID[chunkID] = size
+                return
+            # The chunks make up the packet, header and all.
+            del self.chunksByID[chunkID]
+            self.chunkBytesByID.pop(chunkID, None)
+            rawPacket = "".join(chunks)
+            del chunks
+        if self.phaseTimes is not None:
+            startTime = time.time()
+        try:
+            packet = self._DecodePacket(rawPacket)
+        except ProtocolError, e:
+            self._RefusePacket(rawPacket, e)
+            return
+        if self.phaseTimes is not None:
+            self.phaseTimes["serialize"] += time.time() - startTime
+        self._DispatchPacket(*packet)
+
+    def _RefusePacket(self, rawPacket, error):
+        # The peer may have sent calls in a codec we do not accept before our
+        # HELLO reached it.  Those get an error, rather than no result.
+        packetType, codecID, callID = struct.unpack_from(self.packetHeaderFmt, rawPacket)
+        if packetType == PKT_CALL:
+            self._SendReply(PKT_ERROR, callID, ("rpc.ProtocolError", str(error), None))
+        elif packetType == PKT_NOTIFY:
+            print >>sys.stderr, "Notification refused:", error
+        else:
+            raise error
+
+    def _DispatchPacket(self, packetType, callID, payload):
+        if packetType in (PKT_CALL, PKT_NOTIFY):
+            self._StartIncomingCall(self._HandleIncomingCall, packetType, callID, payload)
+        elif packetType == PKT_BATCH:
+            self._DispatchIncomingBatch(payload)
+        elif packetType == PKT_RESULT:
+            self._DispatchIncomingResult(callID, payload)
+        elif packetType == PKT_ERROR:
+            self._DispatchIncomingError(callID, payload)
+        elif packetType == PKT_CANCEL:
+            self._DispatchIncomingCancel(callID)
+        elif packetType in (PKT_STREAM_START, PKT_STREAM, PKT_STREAM_END):
+            self._DispatchIncomingStream(packetType, callID, payload)
+        elif packetType == PKT_CREDIT:
+            credit = self.streamCredits.get(callID, None)
+            if credit is not None:
+                credit.Add(payload)
+        elif packetType == PKT_PING:
+            # Answered straight away, so that it shows whether the peer is
+            # reading its socket however busy its workers are.
+            self._SendReply(PKT_RESULT, callID, None)
+        elif packetType == PKT_HELLO:
+            self._DispatchIncomingHello(payload)
+        else:
+            raise ProtocolError("unknown packet type %s" % packetType)
+
+    def _DispatchIncomingBatch(self, packets):
+        # The calls in a batch are dispatched one after another by the one
+        # worker, in the order they were made.
+        calls = []
+        for packet in packets:
+            if packet[0] in (PKT_CALL, PKT_NOTIFY):
+                calls.append(packet)
+            else:
+                self._DispatchPacket(*packet)
+        if calls:
+            self._StartIncomingCall(self._HandleIncomingBatch, calls)
+
+    def _StartIncomingCall(self, handler, *args):
+        if self.maxConcurrentCalls is None:
+            handler(*args)
+        else:
+            self._QueueIncomingCall(handler, args)
+
+    def _QueueIncomingCall(self, handler, args):
+        self.callQueue.append((handler, args, time.time()))
+        self.callQueuePeak = max(self.callQueuePeak, len(self.callQueue))
+        # Workers take calls from the queue until it is empty, and then
+        # exit.  Extra workers which find nothing left exit straight away.
+        if self.callWorkers < self.maxConcurrentCalls:
+            self.callWorkers += 1
+            stackless.tasklet(self._CallWorker)()
+
+    def _CallWorker(self):
+        try:
+            while self.callQueue:
+                handler, args, queueTime = self.callQueue.popleft()
+                waitTime = time.time() - queueTime
+                self.callQueueWaitTime += waitTime
+                if self.phaseTimes is not None:
+                    self.phaseTimes["queueWait"] += waitTime
+                handler(*args)
+        finally:
+            self.callWorkers -= 1
+
+    def _HandleIncomingCall(self, packetType, callID, payload):
+        reply = self._RunIncomingCall(packetType, callID, payload)
+        if reply is not None:
+            self._SendReply(*reply)
+
+    def _HandleIncomingBatch(self, calls):
+        replies = []
+        for packetType, callID, payload in calls:
+            reply = self._RunIncomingCall(packetType, callID, payload)
+            if reply is not None:
+                replies.append(reply)
+        # The results go back together too.
+        if replies:
+            self._SendReply(PKT_BATCH, 0, replies)
+
+    def _SendReply(self, packetType, callID, payload):
+        try:
+            self._SendPacket(packetType, callID, payload)
+        except socket.error:
+            # The socket managing tasklet deals with the disconnection.
+            pass
+
+    def _RunIncomingCall(self, packetType, callID, payload):
+        """Dispatches an incoming call, and returns the packet to reply with
+        as (packetType, callID, payload), or None for a notification."""
+        self.callsDispatched += 1
         if packetType == PKT_CALL:
+            self.callsInProgress[callID] = stackless.getcurrent()
+        try:
             try:
-                self._SendPacket(PKT_RESULT, callID, self.DispatchIncomingCall(*payload))
-            except Exception, e:
-                # For now let the local side know of the error the remote side triggered.
-                import traceback
+                if self.phaseTimes is None:
+                    result = self.DispatchIncomingCall(*payload)
+                else:
+                    startTime = time.time()
+                    result = self.DispatchIncomingCall(*payload)
+                    self.phaseTimes["dispatch"] += time.time() - startTime
+                if type(result) is types.GeneratorType and packetType == PKT_CALL:
+                    self._StreamResult(callID, result)
+                    return PKT_STREAM_END, callID, None
+            except (CallCancelledError, DisconnectedError):
+                # The caller has given up on the result, or cannot get it.
+                sys.exc_clear()
+                return None
+            except Exception:
+                # Let the local side know of the error the remote side triggered.
                 traceback.print_exc()
 
-                # Send the error message.
-                self._SendPacket(PKT_ERROR, callID, "SOME EXC STATE HERE")
+                excType, excValue, tb = sys.exc_info()
+                excTypeName = excType.__name__
+                if excType.__module__ != "exceptions":
+                    excTypeName = "%s.%s" % (excType.__module__, excTypeName)
+                remoteTraceback = None
+                if self.sendErrorTracebacks:
+                    remoteTraceback = "".join(traceback.format_exception(excType, excValue, tb))
+                errorData = excTypeName, str(excValue), remoteTraceback
+                del tb
 
                 # Prevent the exception being leaked.
                 sys.exc_clear()
-        elif packetType == PKT_RESULT:
-            self._DispatchIncomingResult(callID, payload)
-        elif packetType == PKT_ERROR:
-            raise NotImplementedError("todo, call error handling")
-        else:
-            raise NotImplementedError("unknown packet type %s" % packetType)
+
+                if packetType == PKT_NOTIFY:
+                    return None
+                return PKT_ERROR, callID, errorData
+        finally:
+            if packetType == PKT_CALL:
+                del self.callsInProgress[callID]
+        if packetType == PKT_NOTIFY:
+            return None
+        return PKT_RESULT, callID, result
+
+    def _StreamResult(self, callID, generator):
+        """Sends the items of a generator to the caller as they are produced,
+        as long as the caller has given the credit for them."""
+        credit = self.streamCredits[callID] = _StreamCredit(self.streamWindow)
+        try:
+            self._SendPacket(PKT_STREAM_START, callID, self.streamWindow)
+            for item in generator:
+                credit.Take()
+                self._SendPacket(PKT_STREAM, callID, item)
+        finally:
+            del self.streamCredits[callID]
+            generator.close()
+
+    def _DispatchIncomingCancel(self, callID):
+        tasklet = self.callsInProgress.get(callID, None)
+        if tasklet is not None:
+            # Only interrupt the call while it waits on something, other
+            # than the socket in the middle of a packet.  Otherwise it is
+            # about to finish anyway.
+            if tasklet.blocked and tasklet is not self.sendingTasklet:
+                tasklet.raise_exception(CallCancelledError, "The caller cancelled the call")
+            return
+        for entry in self.callQueue:
+            handler, args, queueTime = entry
+            if handler == self._HandleIncomingCall and args[:2] == (PKT_CALL, callID):
+                self.callQueue.remove(entry)
+                return
+
+    def GetCallStats(self):
+        """Returns a dictionary of counters for the incoming calls:
+        - running: worker tasklets, each dispatching a call.
+        - queued: calls waiting for a worker.
+        - queuePeak: the most calls there have been waiting at once.
+        - dispatched: calls dispatched in all.
+        - queueWaitTime: the seconds calls have spent waiting, in all."""
+        return {
+            "running": self.callWorkers,
+            "queued": len(self.callQueue),
+            "queuePeak": self.callQueuePeak,
+            "dispatched": self.callsDispatched,
+            "queueWaitTime": self.callQueueWaitTime,
+        }
+
+    def _DispatchIncomingHello(self, codecNames):
+        # Use our preferred codecs among those the peer accepts.
+        sendCodecs = [ codecsByName[name] for name in self.codecNames if name in codecNames ]
+        if not sendCodecs:
+            raise ProtocolError("No codec in common with the peer, which accepts %s" % codecNames)
+        self.sendCodecs = sendCodecs
 
     def _DispatchIncomingResult(self, callID, payload):
-        channel = self.channelsByCallID[callID]
-        del self.channelsByCallID[callID]
-        channel.send(payload)
+        # Results of calls which timed out or were cancelled are ignored.
+        future = self.channelsByCallID.pop(callID, None)
+        if future is not None:
+            future.send(payload)
+
+    def _DispatchIncomingError(self, callID, payload):
+        future = self.channelsByCallID.pop(callID, None)
+        if future is None:
+            # The error may have come part way through a stream.
+            future = self.streamsByCallID.pop(callID, None)
+        if future is not None:
+            future.send_exception(RemoteError, *payload)
+
+    def _DispatchIncomingStream(self, packetType, callID, payload):
+        if packetType == PKT_STREAM_START:
+            future = self.channelsByCallID.pop(callID, None)
+            if future is None:
+                return
+            # The call's result is the stream, which the items go to.
+            stream = self.streamsByCallID[callID] = ResultStream(self, callID, payload)
+            future.send(stream)
+        elif packetType == PKT_STREAM:
+            stream = self.streamsByCallID.get(callID, None)
+            if stream is not None:
+                stream.send(payload)
+        else:
+            stream = self.streamsByCallID.pop(callID, None)
+            if stream is not None:
+                stream.send_exception(StopIteration)
 
     def DispatchIncomingCall(self, functionID, args, kwargs):
         """This method should be overridden so that the user can deal with
@@ -132,23 +675,130 @@ class EndPoint:
 
     def _SendPacket(self, packetType, callID, payload):
         # Marshal the data to be sent, into a packet.
-        data = cPickle.dumps((packetType, callID, payload))
-        # Packet size.
-        self.socket.send(struct.pack("!I", len(data)))
-        # Packet data.
-        self.socket.send(data)
-
-    def _RemoteCall(self, remoteFunction):
-        self.callID += 1
-        callID = self.callID
-
-        channel = self.channelsByCallID[callID] = stackless.channel()
-        # Ensure recipients of sends are scheduled, and our send operation returns immediately.
-        channel.preference = 1
+        if self.phaseTimes is None:
+            data = self._EncodePacket(packetType, callID, payload)
+        else:
+            startTime = time.time()
+            data = self._EncodePacket(packetType, callID, payload)
+            self.phaseTimes["serialize"] += time.time() - startTime
+        if len(data) <= self.chunkSize:
+            self._SendData(struct.pack(self.packetSizeFmt, len(data)) + data)
+            return
+
+        # Send each chunk as a packet of its own, taking turns with the
+        # packets of other tasklets.
+        self.chunkID = (self.chunkID + 1) & 0xFFFFFFFF
+        chunkID = self.chunkID
+        chunkSize = self.chunkSize
+        for offset in xrange(0, len(data), chunkSize):
+            if offset + chunkSize < len(data):
+                chunkType = PKT_CHUNK
+            else:
+                chunkType = PKT_CHUNK_END
+            chunk = data[offset:offset + chunkSize]
+            header = struct.pack(self.packetHeaderFmt, chunkType, 0, chunkID)
+            self._SendData(struct.pack(self.packetSizeFmt, len(header) + len(chunk)) + header + chunk)
+
+    def _SendData(self, data):
+        # The packet size and data go in one write.  'sendall' sends all of
+        # it, where 'send' may only send part.  It may block, so the packets
+        # of different tasklets have to take turns, or they would interleave.
+        if self.phaseTimes is not None:
+            startTime = time.time()
+        if self.sending:
+            if self.sendWaitChannel is None:
+                self.sendWaitChannel = stackless.channel()
+                self.sendWaitChannel.preference = 1
+            # Wait for the sending tasklet to hand over its turn.
+            try:
+                self.sendWaitChannel.receive()
+            except:
+                # Killed after being handed the turn, but before running.
+                if self.sendingTasklet is stackless.getcurrent():
+                    self._PassSendTurn()
+                raise
+        else:
+            self.sending = True
+        self.sendingTasklet = stackless.getcurrent()
+        try:
+            self.socket.sendall(data)
+            self.bytesSent += len(data)
+        finally:
+            if self.phaseTimes is not None:
+                self.phaseTimes["send"] += time.time() - startTime
+            self._PassSendTurn()
+
+    def _PassSendTurn(self):
+        # Hand the turn straight to the next in line, so that a tasklet
+        # sending chunks cannot take it back before the others get one.
+        if self.sendWaitChannel is not None and self.sendWaitChannel.balance < 0:
+            self.sendingTasklet = self.sendWaitChannel.queue
+            self.sendWaitChannel.send(None)
+        else:
+            self.sendingTasklet = None
+            self.sending = False
+
+    def _NextCallID(self):
+        # The callID has to fit in the packet header.
+        self.callID = (self.callID + 1) & 0xFFFFFFFF
+        return self.callID
+
+    def _RegisterCall(self):
+        """Returns a CallFuture, which the result of the call with its
+        callID will be passed to."""
+        if self.disconnected:
+            raise DisconnectedError("The connection has been lost")
+        callID = self._NextCallID()
+        future = self.channelsByCallID[callID] = CallFuture(self, callID)
+        return future
+
+    def _CancelCall(self, callID):
+        """Stops waiting for the result of a call, and tells the remote side
+        it need not carry on with it."""
+        if self.channelsByCallID.pop(callID, None) is not None:
+            try:
+                self._SendPacket(PKT_CANCEL, callID, None)
+            except socket.error:
+                pass
+
+    def Ping(self, timeout=None):
+        """Returns the seconds taken by a round trip to the remote side.
+        The remote side answers without dispatching anything, so this
+        checks the connection is alive rather than that the application
+        on the other end is responsive."""
+        future = self._RegisterCall()
+        startTime = time.time()
+        try:
+            self._SendPacket(PKT_PING, future.callID, None)
+            future.Wait(timeout)
+        except:
+            self.channelsByCallID.pop(future.callID, None)
+            raise
+        return time.time() - startTime
+
+    def _RemoteCall(self, remoteFunction, timeout=None):
+        future = self._RegisterCall()
+        functionData = remoteFunction.functionID, remoteFunction.args, remoteFunction.kwargs
+        try:
+            self._SendPacket(PKT_CALL, future.callID, functionData)
+            # Block the calling tasklet until its result (or error) has arrived.
+            if timeout is None:
+                timeout = self.callTimeout
+            result = future.Wait(timeout)
+            if self.phaseTimes is not None and future.doneTime is not None:
+                self.phaseTimes["reply"] += time.time() - future.doneTime
+            return result
+        except:
+            # The call timed out, or the calling tasklet was killed.
+            self._CancelCall(future.callID)
+            raise
+
+    def _RemoteNotify(self, remoteFunction):
+        if self.disconnected:
+            raise DisconnectedError("The connection has been lost")
         functionData = remoteFunction.functionID, remoteFunction.args, remoteFunction.kwargs
-        self._SendPacket(PKT_CALL, callID, functionData)
-        # Block the calling tasklet until its result (or error) has arrived.
-        return channel.receive()
+        # Nothing comes back, so there is no callID to wait on.
+        self._SendPacket(PKT_NOTIFY, 0, functionData)
 
 
 class RemoteEndPoint:
@@ -180,9 +830,256 @@ class _RemoteFunction:
     def __init__(self, endpoint, *functionID):
         self.endpoint = endpoint
         self.functionID = functionID
+        self.timeout = None
 
     def __call__(self, *args, **kwargs):
         self.args = args
         self.kwargs = kwargs
 
-        return self.endpoint._RemoteCall(self)
+        if self.timeout is None:
+            return self.endpoint._RemoteCall(self)
+        return self.endpoint._RemoteCall(self, self.timeout)
+
+    def Timeout(self, timeout):
+        """Gives the call a timeout of its own, in place of the endpoint's:
+            remote.Func.Timeout(2.0)(arg)
+        CallTimeoutError is raised if the result takes longer, and the
+        remote side is told to cancel the call."""
+        self.timeout = timeout
+        return self
+
+    def Notify(self, *args, **kwargs):
+        """Makes the call without waiting for it, or getting a result.  Any
+        error it raises on the remote side is only logged there."""
+        self.args = args
+        self.kwargs = kwargs
+
+        self.endpoint._RemoteNotify(self)
+
+
+class Batch:
+    """Batch(endpoint)
+
+    Collects calls to the remote side of an endpoint, to be sent together in
+    one packet rather than in a packet each.  The remote side dispatches
+    them one after another, in the order they were made, and sends back
+    their results together.
+
+    Calls are made through RemoteEndPoint objects which wrap the batch in
+    place of the endpoint.  Calls return a CallFuture for the result
+    instead of blocking, and their Notify method queues a call that has no
+    result.  Nothing is sent until Send is called, or the batch is used as
+    a context manager and the block exits without an exception:
+
+        with rpc.Batch(endpoint) as batch:
+            world = batch.RemoteEndPoint("world")
+            for entity in moved:
+                world.Move.Notify(entity.id, entity.position)
+            future = world.GetTick()
+        tick = future.Wait()"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.packets = []
+
+    def RemoteEndPoint(self, namespaceID=None):
+        return RemoteEndPoint(self, namespaceID)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if excType is None:
+            self.Send()
+        else:
+            self.Discard()
+
+    def Send(self):
+        """Sends the calls made since the last time."""
+        packets, self.packets = self.packets, []
+        if packets:
+            self.endpoint._SendPacket(PKT_BATCH, 0, packets)
+
+    def Discard(self):
+        """Forgets the calls made since the last send.  Their futures raise
+        CallCancelledError."""
+        packets, self.packets = self.packets, []
+        for packetType, callID, functionData in packets:
+            future = self.endpoint.channelsByCallID.pop(callID, None)
+            if future is not None:
+                future.send_exception(CallCancelledError, "The batch was discarded")
+
+    def _RemoteCall(self, remoteFunction, timeout=None):
+        # Timeouts are given to CallFuture.Wait instead.
+        future = self.endpoint._RegisterCall()
+        functionData = remoteFunction.functionID, remoteFunction.args, remoteFunction.kwargs
+        self.packets.append((PKT_CALL, future.callID, functionData))
+        return future
+
+    def _RemoteNotify(self, remoteFunction):
+        functionData = remoteFunction.functionID, remoteFunction.args, remoteFunction.kwargs
+        self.packets.append((PKT_NOTIFY, 0, functionData))
+
+
+class ResultStream:
+    """The result of a call to a remote function which returned a generator.
+    Iterating over it gives the items as they arrive.  As they are taken,
+    the remote side is given the credit to send more, so no more than its
+    streamWindow of them are ever waiting here.
+
+    Close it to stop the remote side early.  Any exception the remote
+    generator raises is raised as a RemoteError by the iteration."""
+
+    def __init__(self, endpoint, callID, window):
+        self.endpoint = endpoint
+        self.callID = callID
+        self.items = deque()
+        self.done = False
+        # The exception to raise once the items run out, as (type, args).
+        self.exception = None
+        self.channel = None
+        # Credit is given back in batches, once half the window is taken.
+        self.creditBatch = max(1, window // 2)
+        self.taken = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while not self.items:
+            if self.exception is not None:
+                excType, args = self.exception
+                raise excType(*args)
+            if self.channel is None:
+                self.channel = stackless.channel()
+                self.channel.preference = 1
+            self.channel.receive()
+        item = self.items.popleft()
+        self.taken += 1
+        if self.taken >= self.creditBatch and not self.done:
+            taken, self.taken = self.taken, 0
+            try:
+                self.endpoint._SendPacket(PKT_CREDIT, self.callID, taken)
+            except socket.error:
+                pass
+        return item
+
+    def Close(self):
+        """Stops the remote side sending any more items."""
+        if not self.done:
+            self.endpoint.streamsByCallID.pop(self.callID, None)
+            self.send_exception(StopIteration)
+            try:
+                self.endpoint._SendPacket(PKT_CANCEL, self.callID, None)
+            except socket.error:
+                pass
+        self.items.clear()
+
+    # The endpoint passes the items on with these, in the manner of a
+    # channel.  StopIteration ends the stream.
+    def send(self, item):
+        self.items.append(item)
+        self._Wake()
+
+    def send_exception(self, excType, *args):
+        self.done = True
+        self.exception = excType, args
+        self._Wake()
+
+    def _Wake(self):
+        if self.channel is not None and self.channel.balance < 0:
+            self.channel.send(None)
+
+
+class _StreamCredit:
+    """The number of items a streamed result may send before the caller
+    gives more credit."""
+
+    def __init__(self, credit):
+        self.credit = credit
+        self.channel = stackless.channel()
+        self.channel.preference = 1
+
+    def Take(self):
+        while self.credit is not None and self.credit <= 0:
+            self.channel.receive()
+        if self.credit is None:
+            raise DisconnectedError("The connection was lost")
+        self.credit -= 1
+
+    def Add(self, credit):
+        """Adds to the credit, or with None, fails the stream."""
+        if credit is None:
+            self.credit = None
+        else:
+            self.credit += credit
+        if self.channel.balance < 0:
+            self.channel.send(None)
+
+
+class CallFuture:
+    """The result of a call, which arrives later.  Calls made in a Batch
+    return one."""
+
+    def __init__(self, endpoint, callID):
+        self.endpoint = endpoint
+        self.callID = callID
+        self.done = False
+        self.result = None
+        # The exception to raise in place of a result, as (type, args).
+        self.exception = None
+        self.channel = None
+        # When the result arrived, if phase timing was on by then.
+        self.doneTime = None
+
+    def Done(self):
+        return self.done
+
+    def Wait(self, timeout=None):
+        """Blocks the calling tasklet until the result has arrived, and
+        returns it, or raises the exception which arrived instead.  If the
+        timeout passes first, CallTimeoutError is raised, but the call is
+        not cancelled."""
+        if not self.done:
+            if self.channel is None:
+                self.channel = stackless.channel()
+                # Ensure recipients of sends are scheduled, and our send operation returns immediately.
+                self.channel.preference = 1
+            if timeout is None:
+                self.channel.receive()
+            elif channel_wait is None:
+                raise RuntimeError("Call timeouts need stacklesslib")
+            else:
+                try:
+                    channel_wait(self.channel, timeout)
+                except WaitTimeoutError:
+                    raise CallTimeoutError("No result after %s seconds" % timeout)
+        if self.exception is not None:
+            excType, args = self.exception
+            raise excType(*args)
+        return self.result
+
+    def Cancel(self):
+        """Gives up on the result, and tells the remote side that it need
+        not carry on with the call.  Waiting tasklets get CallCancelledError."""
+        if not self.done:
+            self.endpoint._CancelCall(self.callID)
+            self.send_exception(CallCancelledError, "The call was cancelled")
+
+    # The endpoint passes the result on with these, in the manner of a
+    # channel.  Any number of tasklets may be waiting, or none.
+    def send(self, result):
+        self.result = result
+        self._Finished()
+
+    def send_exception(self, excType, *args):
+        self.exception = excType, args
+        self._Finished()
+
+    def _Finished(self):
+        self.done = True
+        if self.endpoint.phaseTimes is not None:
+            self.doneTime = time.time()
+        if self.channel is not None:
+            while self.channel.balance < 0:
+                self.channel.send(None)
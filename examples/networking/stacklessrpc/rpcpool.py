@@ -0,0 +1,264 @@
+#
+# A pool of stacklessrpc client connections.
+#
+# Purpose:
+#
+#  - To spread the calls made to a remote address over several connections,
+#    without the caller having to set them up or look after them.
+#
+# Expectations:
+#
+#  - The Stackless socket module has already been monkeypatched in place.
+#  - The responsibility for running the Stackless scheduler lies elsewhere.
+#  - For health checks and idle eviction to happen by themselves,
+#    stacklesslib is importable and its main event queue is being pumped.
+#    Otherwise call Maintain() every so often.
+#
+
+"""
+Pooled connections for making calls with stacklessrpc.
+
+    pool = RPCClientPool(connectionsPerAddress=4)
+    svc = pool.RemoteEndPoint(("10.0.0.5", 40404), "testSvc")
+    result = svc.TestFunc(1, 2)
+
+Connections to an address are made when calls need them.  Each call goes
+out on the connection with the fewest calls awaiting results, and if all of
+them have some, another connection is opened for the calls which follow.
+So a call with a large payload, or a slow result, does not hold up the
+calls made after it.
+
+Connections which drop are replaced when next needed.  When connecting to
+an address fails, it is not tried again until a delay has passed, which
+doubles with each failure in a row, and calls to it in the meantime raise
+rpc.DisconnectedError.  Connections are pinged every so often, and closed
+if the ping goes unanswered, or if they have not been used for a while.
+"""
+
+__all__ = [ "RPCClientPool" ]
+
+import socket, time
+from socket import AF_INET, SOCK_STREAM
+import stackless
+import rpc
+
+try:
+    from stacklesslib import main
+except ImportError:
+    main = None
+
+
+class RPCClientPool:
+    """Keeps connections to any number of remote addresses, up to
+    connectionsPerAddress of them to each."""
+
+    connectionsPerAddress = 4
+    # The seconds between the health checks and idle evictions made by
+    # Maintain().  None leaves calling Maintain() to the application.
+    maintenanceInterval = 10.0
+    # The seconds a ping may take before its connection is closed.
+    healthCheckTimeout = 5.0
+    # The seconds a connection is kept open without being used.  None keeps
+    # connections open for as long as they work.
+    idleTimeout = 300.0
+    # The delay before connecting again to an address that failed, which
+    # doubles with each failure in a row up to maxReconnectDelay.
+    reconnectDelay = 0.5
+    maxReconnectDelay = 30.0
+
+    endPointClass = rpc.EndPoint
+
+    def __init__(self, connectionsPerAddress=None, endPointClass=None, maintenanceInterval=None):
+        if connectionsPerAddress is not None:
+            self.connectionsPerAddress = connectionsPerAddress
+        if endPointClass is not None:
+            self.endPointClass = endPointClass
+        if maintenanceInterval is not None:
+            self.maintenanceInterval = maintenanceInterval
+        self.addressPools = {}
+        self.maintenanceTasklet = None
+
+    def RemoteEndPoint(self, address, namespaceID=None):
+        """Returns an rpc.RemoteEndPoint whose calls are made over the
+        connections to the given address."""
+        return rpc.RemoteEndPoint(self._GetAddressPool(address), namespaceID)
+
+    def GetEndPoint(self, address):
+        """Returns the least busy endpoint connected to the address, for
+        uses that need one, like rpc.Batch."""
+        return self._GetAddressPool(address).GetEndPoint()
+
+    def CreateEndPoint(self, address):
+        """Connects to the address, and returns an endpoint for the socket.
+        Override this to set up the connections differently."""
+        epSocket = socket.socket(AF_INET, SOCK_STREAM)
+        epSocket.connect(address)
+        epSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self.endPointClass(epSocket)
+
+    def Maintain(self):
+        """Checks the health of the connections with pings, and closes those
+        which are dead or have not been used for a while."""
+        now = time.time()
+        for addressPool in self.addressPools.values():
+            for connection in addressPool.connections:
+                endpoint = connection.endpoint
+                if endpoint is None:
+                    continue
+                if endpoint.disconnected:
+                    connection.endpoint = None
+                elif (self.idleTimeout is not None and not endpoint.channelsByCallID and
+                        now - connection.lastUsed > self.idleTimeout):
+                    connection.Close()
+                elif rpc.channel_wait is not None:
+                    # The timeout of the ping needs stacklesslib.
+                    stackless.tasklet(connection.CheckHealth)(self.healthCheckTimeout)
+
+    def Close(self):
+        """Closes all the connections.  Calls awaiting results on them raise
+        rpc.DisconnectedError."""
+        if self.maintenanceTasklet is not None:
+            self.maintenanceTasklet.kill()
+            self.maintenanceTasklet = None
+        for addressPool in self.addressPools.values():
+            for connection in addressPool.connections:
+                connection.Close()
+        self.addressPools.clear()
+
+    def GetStats(self):
+        """Returns a dictionary for each address, of:
+        - connected: connections which are open.
+        - connecting: connections which are being made.
+        - outstanding: calls awaiting results, over all the connections.
+        - failures: the connection attempts which failed in a row."""
+        stats = {}
+        for address, addressPool in self.addressPools.iteritems():
+            endpoints = [ connection.endpoint for connection in addressPool.connections
+                          if connection.endpoint is not None and not connection.endpoint.disconnected ]
+            stats[address] = {
+                "connected": len(endpoints),
+                "connecting": len([ c for c in addressPool.connections if c.connecting ]),
+                "outstanding": sum(len(endpoint.channelsByCallID) for endpoint in endpoints),
+                "failures": addressPool.failures,
+            }
+        return stats
+
+    def _GetAddressPool(self, address):
+        addressPool = self.addressPools.get(address, None)
+        if addressPool is None:
+            addressPool = self.addressPools[address] = _AddressPool(self, address)
+        if self.maintenanceTasklet is None and self.maintenanceInterval is not None and main is not None:
+            self.maintenanceTasklet = stackless.tasklet(self._MaintenanceLoop)()
+        return addressPool
+
+    def _MaintenanceLoop(self):
+        while True:
+            main.sleep(self.maintenanceInterval)
+            self.Maintain()
+
+
+class _AddressPool:
+    """The connections to one address.  RemoteEndPoint objects wrap it in
+    place of an endpoint, and it passes each call on to one of them."""
+
+    def __init__(self, pool, address):
+        self.pool = pool
+        self.address = address
+        self.connections = [ _Connection() for i in range(pool.connectionsPerAddress) ]
+        # Connection attempts are put off until retryTime after failures.
+        self.failures = 0
+        self.retryTime = 0.0
+        self.lastError = None
+        # Calls waiting for a connection to be made block on this.
+        self.waitChannel = stackless.channel()
+        self.waitChannel.preference = 1
+
+    def _RemoteCall(self, remoteFunction, timeout=None):
+        return self.GetEndPoint()._RemoteCall(remoteFunction, timeout)
+
+    def _RemoteNotify(self, remoteFunction):
+        return self.GetEndPoint()._RemoteNotify(remoteFunction)
+
+    def GetEndPoint(self):
+        while True:
+            best = None
+            for connection in self.connections:
+                endpoint = connection.endpoint
+                if endpoint is None:
+                    continue
+                if endpoint.disconnected:
+                    connection.endpoint = None
+                    continue
+                # A connection in the middle of sending a packet, which may
+                # be a large one, counts as busier than one which is not.
+                load = len(endpoint.channelsByCallID) + endpoint.sending
+                if best is None or load < bestLoad:
+                    best, bestLoad = connection, load
+
+            spare = self._GetSpareConnection()
+            if best is not None:
+                if bestLoad and spare is not None:
+                    # Open another connection for the calls that follow.
+                    # It counts as being made from now, so that callers
+                    # before the tasklet runs do not start it again.
+                    spare.connecting = True
+                    stackless.tasklet(self._Connect)(spare)
+                best.lastUsed = time.time()
+                return best.endpoint
+
+            if spare is not None:
+                self._Connect(spare)
+            elif [ c for c in self.connections if c.connecting ]:
+                self.waitChannel.receive()
+            else:
+                raise rpc.DisconnectedError("Unable to connect to %s: %s" % (self.address, self.lastError))
+
+    def _GetSpareConnection(self):
+        """Returns a connection which can be made now, if there is one."""
+        if time.time() < self.retryTime:
+            return None
+        for connection in self.connections:
+            if connection.endpoint is None and not connection.connecting:
+                return connection
+
+    def _Connect(self, connection):
+        connection.connecting = True
+        try:
+            try:
+                connection.endpoint = self.pool.CreateEndPoint(self.address)
+            except socket.error, e:
+                self.failures += 1
+                self.lastError = e
+                delay = self.pool.reconnectDelay * 2 ** (self.failures - 1)
+                self.retryTime = time.time() + min(delay, self.pool.maxReconnectDelay)
+            else:
+                self.failures = 0
+                connection.lastUsed = time.time()
+        finally:
+            connection.connecting = False
+            # Let those waiting look again, whether it worked or not.
+            while self.waitChannel.balance < 0:
+                self.waitChannel.send(None)
+
+
+class _Connection:
+    def __init__(self):
+        self.endpoint = None
+        self.connecting = False
+        self.lastUsed = 0.0
+
+    def CheckHealth(self, timeout):
+        endpoint = self.endpoint
+        try:
+            endpoint.Ping(timeout)
+        except (rpc.RPCError, socket.error):
+            if self.endpoint is endpoint:
+                self.Close()
+
+    def Close(self):
+        endpoint, self.endpoint = self.endpoint, None
+        if endpoint is not None:
+            # The socket managing tasklet fails the calls awaiting results
+            # as it exits.
+            endpoint.Release()
+            endpoint.socket.close()
@@ -1,4 +1,5 @@
-import os, sys, logging, unittest, StringIO
+from __future__ import with_statement
+import os, sys, logging, unittest, StringIO, struct, array
 import stackless
 
 # Ensure the module to be tested is importable.
@@ -121,9 +122,9 @@ class RPCTestCase(TestCase):
 
         # Inject a method into the socket to collect sent strings.
         socketSends = []
-        def socket_send(data):
+        def socket_sendall(data):
             socketSends.append(data)
-        _socket.send = socket_send
+        _socket.sendall = socket_sendall
 
         # Inject a method into the endpoint to collect deserialised packets.
         deserialisedPackets = []
@@ -131,13 +132,16 @@ class RPCTestCase(TestCase):
             deserialisedPackets.append((callID, payload))
         endpoint._DispatchIncomingResult = EndPoint__DispatchIncomingResult
 
-        callIDAndPayload = ("B", "C")
+        callIDAndPayload = (2, "C")
         endpoint._SendPacket(rpc.PKT_RESULT, *callIDAndPayload)        
         
-        # Ensure we received to sends, the length and the raw packet that it was followed by.
-        self.failUnless(len(socketSends) == 2, "Expected two entries, a length and packet, got %s entries" % len(socketSends))
+        # Ensure we received one send, the length followed by the raw packet.
+        self.failUnless(len(socketSends) == 1, "Expected one entry, a length and packet, got %s entries" % len(socketSends))
+        packetLength = endpoint.packetSizeLength
+        rawPacket = socketSends[0][packetLength:]
+        self.failUnless(len(rawPacket) == struct.unpack(endpoint.packetSizeFmt, socketSends[0][:packetLength])[0], "The length does not match the packet")
         
-        endpoint._DispatchIncomingPacket(socketSends[1])
+        endpoint._DispatchIncomingPacket(rawPacket)
 
         # Ensure we got only as many deserialised packet data entries as we expect.
         self.failUnless(len(deserialisedPackets) == 1, "Expected one deserialised packet, got %d" % len(deserialisedPackets))
@@ -161,10 +165,10 @@ class RPCTestCase(TestCase):
         sio = StringIO.StringIO()        
 
         # Inject a method into the mocked socket to collect the "sent" data.
-        def socket_send(data):
+        def socket_sendall(data):
             sio.write(data)
-        socket_send.raise_error = False
-        _socket.send = socket_send
+        socket_sendall.raise_error = False
+        _socket.sendall = socket_sendall
 
         numPackets = 3
         functionDatas = []
@@ -177,7 +181,7 @@ class RPCTestCase(TestCase):
         # Rewind the string IO object to the beginning ready for reeling its contents off.
         sio.seek(0)
         # Ignore error and result packets that may be caused.
-        _socket.send = lambda *args, **kwargs: None
+        _socket.sendall = lambda *args, **kwargs: None
         
         callsToDispatch = []
         def EndPoint_DispatchIncomingCall(*args):
@@ -195,8 +199,716 @@ class RPCTestCase(TestCase):
         self.failUnless(len(callsToDispatch) == numPackets, "Expected to have received %d calls, got %d" % (numPackets, len(callsToDispatch)))
         self.failUnless(callsToDispatch == functionDatas, "Send function data does not match that which was received")
 
+    def testBufferedPacketReading(self):
+        """The goal of this test is to ensure that packets are split out of
+        the incoming data correctly, however it arrives.  Many packets may
+        come in one read, and one packet may take many reads."""
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+
+        sent = []
+        _socket.sendall = sent.append
+        payloads = [ "small", "x" * (endpoint.readBlockSize * 3), "", "last" ]
+        for i, payload in enumerate(payloads):
+            endpoint._SendPacket(rpc.PKT_RESULT, i, payload)
+        data = "".join(sent)
+
+        for readSize in (1, 7, len(data)):
+            endpoint.readBuffer, endpoint.readOffset = "", 0
+            sio = StringIO.StringIO(data)
+            _socket.recv = lambda numBytes: sio.read(min(numBytes, readSize))
+
+            received = []
+            rawPacket = endpoint._ReadIncomingPacket()
+            while rawPacket:
+                received.append(endpoint._DecodePacket(rawPacket)[2])
+                rawPacket = endpoint._ReadIncomingPacket()
+            self.failUnless(received == payloads, "Packets were not read back intact with reads of %d bytes" % readSize)
+
+    def testSlowCallDoesNotBlockFastCalls(self):
+        """The goal of this test is to ensure that incoming calls are
+        dispatched concurrently, so that a call which blocks does not
+        delay the calls which arrive after it on the same socket, and
+        that their results are sent as soon as each is ready."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+
+        sentResults = []
+        def socket_sendall(data):
+            packetType, callID, payload = endpoint._DecodePacket(data[endpoint.packetSizeLength:])
+            sentResults.append((callID, payload))
+        _socket.sendall = socket_sendall
+
+        slowChannel = stackless.channel()
+        def EndPoint_DispatchIncomingCall(functionID, args, kwargs):
+            if functionID == "slow":
+                return slowChannel.receive()
+            return functionID
+        endpoint.DispatchIncomingCall = EndPoint_DispatchIncomingCall
+
+        endpoint._DispatchIncomingPacket(endpoint._EncodePacket(rpc.PKT_CALL, 1, ("slow", (), {})))
+        for callID in range(2, 5):
+            endpoint._DispatchIncomingPacket(endpoint._EncodePacket(rpc.PKT_CALL, callID, ("fast", (), {})))
+        # Run everything but the endpoint's socket reading tasklet.
+        endpoint.tasklet.kill()
+        stackless.run()
+
+        self.failUnless(sentResults == [(2, "fast"), (3, "fast"), (4, "fast")], "The fast calls were held up by the slow one, got %s" % sentResults)
+        stats = endpoint.GetCallStats()
+        self.failUnless(stats["running"] == 1 and stats["dispatched"] == 4, "Unexpected call stats %s" % stats)
+
+        slowChannel.send("slow")
+        stackless.run()
+        self.failUnless(sentResults[-1] == (1, "slow"), "The slow call's result was not sent")
+        self.failUnless(endpoint.GetCallStats()["running"] == 0, "Workers were left running")
+
+    def testKilledSenderPassesTurnOn(self):
+        """The goal of this test is to ensure that a tasklet which is killed
+        after being handed the turn to send, but before it got to run, does
+        not leave the other senders blocked."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+        rpc.stackless.getcurrent = stackless.getcurrent
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+        endpoint.tasklet.kill()
+        sent = []
+        blockChannel = stackless.channel()
+        def socket_sendall(data):
+            if not sent:
+                blockChannel.receive()
+            sent.append(data)
+        _socket.sendall = socket_sendall
+
+        first = stackless.tasklet(endpoint._SendData)("first")
+        second = stackless.tasklet(endpoint._SendData)("second")
+        stackless.run()
+        # The first sends and hands the turn to the second, which is killed.
+        blockChannel.send(None)
+        second.kill()
+        stackless.run()
+        self.failUnless(sent == [ "first" ] and not endpoint.sending, "The turn to send was not given up")
+
+        endpoint._SendData("third")
+        self.failUnless(sent == [ "first", "third" ], "Sending after the killed tasklet was blocked")
+
+    def testPhaseTimingEnabledDuringCall(self):
+        """The goal of this test is to ensure that turning on phase timing
+        while a call awaits its result does not break the call."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+
+        _socket = DummyClass()
+        _socket.sendall = lambda data: None
+        endpoint = rpc.EndPoint(_socket)
+        endpoint.tasklet.kill()
+
+        results = []
+        stackless.tasklet(lambda: results.append(rpc.RemoteEndPoint(endpoint).Func()))()
+        stackless.run()
+        # The result arrives, and phase timing is turned on before the
+        # caller gets to run again.
+        endpoint._DispatchIncomingResult(endpoint.channelsByCallID.keys()[0], "result")
+        endpoint.EnablePhaseTiming()
+        stackless.run()
+        self.failUnless(results == [ "result" ], "The call failed, got %s" % results)
+
+    def testCallConcurrencyLimit(self):
+        """The goal of this test is to ensure that no more than the
+        endpoint's maximum number of calls are dispatched at once, and
+        that the rest wait their turn in order."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+        endpoint.maxConcurrentCalls = 2
+        _socket.sendall = lambda data: None
+
+        blockedChannel = stackless.channel()
+        dispatchOrder = []
+        def EndPoint_DispatchIncomingCall(functionID, args, kwargs):
+            dispatchOrder.append(functionID)
+            blockedChannel.receive()
+        endpoint.DispatchIncomingCall = EndPoint_DispatchIncomingCall
+
+        for callID in range(5):
+            endpoint._DispatchIncomingPacket(endpoint._EncodePacket(rpc.PKT_CALL, callID, (callID, (), {})))
+        endpoint.tasklet.kill()
+        stackless.run()
+
+        stats = endpoint.GetCallStats()
+        self.failUnless(dispatchOrder == [0, 1], "Expected two calls dispatched, got %s" % dispatchOrder)
+        self.failUnless(stats["queued"] == 3 and stats["queuePeak"] == 5, "Unexpected call stats %s" % stats)
+
+        while blockedChannel.balance < 0:
+            blockedChannel.send(None)
+            stackless.run()
+        self.failUnless(dispatchOrder == range(5), "Queued calls were not dispatched in order, got %s" % dispatchOrder)
+        self.failUnless(endpoint.GetCallStats()["running"] == 0, "Workers were left running")
+
+    def testCodecSelection(self):
+        """The goal of this test is to ensure that payloads go out with the
+        first codec that can encode them, of those the peer accepts, and
+        that packets in codecs the endpoint does not accept are refused."""
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+
+        def CodecOf(rawPacket):
+            return struct.unpack_from(endpoint.packetHeaderFmt, rawPacket)[1]
+
+        plainData = ("svc", "Func"), (1, 2.5, "three", [ None, True ]), { "four": 4 }
+        objectData = ("svc", "Func"), (DummyClass,), {}
+        self.failUnless(CodecOf(endpoint._EncodePacket(rpc.PKT_CALL, 1, plainData)) == rpc.MarshalCodec.codecID, "Plain data was not marshalled")
+        self.failUnless(CodecOf(endpoint._EncodePacket(rpc.PKT_CALL, 1, objectData)) == rpc.PickleCodec.codecID, "Other data was not pickled")
+        for payload in (plainData, objectData):
+            rawPacket = endpoint._EncodePacket(rpc.PKT_RESULT, 7, payload)
+            self.failUnless(endpoint._DecodePacket(rawPacket) == (rpc.PKT_RESULT, 7, payload), "The packet did not decode to what was encoded")
+
+        # The peer only accepts pickles.
+        endpoint._DispatchIncomingHello([ "pickle2", "unknown" ])
+        self.failUnless(CodecOf(endpoint._EncodePacket(rpc.PKT_CALL, 1, plainData)) == rpc.PickleCodec.codecID, "Plain data was not pickled for the peer")
+
+        # This endpoint does not accept pickles.
+        marshalEndpoint = rpc.EndPoint(_socket, codecNames=[ "marshal" ])
+        self.failUnlessRaises(ValueError, marshalEndpoint._EncodePacket, rpc.PKT_CALL, 1, objectData)
+        self.failUnlessRaises(rpc.ProtocolError, marshalEndpoint._DecodePacket, endpoint._EncodePacket(rpc.PKT_CALL, 1, objectData))
+        self.failUnlessRaises(rpc.ProtocolError, marshalEndpoint._DispatchIncomingHello, [ "pickle2" ])
+
+    def testCodecKeepsTypes(self):
+        """The goal of this test is to ensure that values which marshal
+        would silently turn into something else, like subclasses of the
+        builtin types and buffers, are pickled and arrive unchanged."""
+
+        endpoint = rpc.EndPoint(DummyClass())
+
+        def RoundTrip(payload):
+            rawPacket = endpoint._EncodePacket(rpc.PKT_CALL, 1, payload)
+            codecID = struct.unpack_from(endpoint.packetHeaderFmt, rawPacket)[1]
+            return codecID, endpoint._DecodePacket(rawPacket)[2]
+
+        for value in (DummyUnicode(u"bob"), DummyStr("bob"), DummyInt(3), array.array("d", [ 1.5 ])):
+            payload = ("svc", "Func"), (1, [ { "key": (value,) } ]), {}
+            codecID, decoded = RoundTrip(payload)
+            self.failUnless(codecID == rpc.PickleCodec.codecID, "%r was marshalled" % (value,))
+            decodedValue = decoded[1][1][0]["key"][0]
+            self.failUnless(type(decodedValue) is type(value) and decodedValue == value, "%r arrived as %r" % (value, decodedValue))
+
+        # Exact builtin types all the way down still take the fast path.
+        payload = ("svc", "Func"), (u"bob", 2L, 1j, frozenset([ 1 ]), { (1, 2): [ None, False ] }), {}
+        self.failUnless(RoundTrip(payload) == (rpc.MarshalCodec.codecID, payload), "Plain data was not marshalled")
+
+        # A payload which contains itself is left to pickle.
+        recursive = []
+        recursive.append(recursive)
+        codecID, decoded = RoundTrip(recursive)
+        self.failUnless(codecID == rpc.PickleCodec.codecID and decoded[0] is decoded, "A recursive payload did not round trip")
+
+    def testMismatchedCodecs(self):
+        """The goal of this test is to ensure that a call sent before the
+        peer's codecs were known, in a codec the peer does not accept, fails
+        with an error rather than leaving the caller waiting, and that calls
+        which follow use a codec the peer accepts."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+        rpc.stackless.getcurrent = stackless.getcurrent
+
+        client, server = ConnectedEndPoints(codecNames=(None, [ "pickle2" ]))
+        server.DispatchIncomingCall = lambda functionID, args, kwargs: args[0]
+
+        results = []
+        def Caller(value):
+            try:
+                results.append(rpc.RemoteEndPoint(client).Echo(value))
+            except rpc.RemoteError, e:
+                results.append(e.excTypeName)
+        stackless.tasklet(Caller)(1)
+        stackless.run()
+        # The HELLO packets are sent after the call, as the socket managing
+        # tasklets are not running.
+        for endpoint in (client, server):
+            endpoint._SendPacket(rpc.PKT_HELLO, 0, endpoint.codecNames)
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            PumpEndPoints(client, server)
+        finally:
+            sys.stderr = stderr
+        self.failUnless(results == [ "rpc.ProtocolError" ], "Expected the early call to fail, got %s" % results)
+        self.failUnless(client.channelsByCallID == {}, "Results are still expected")
+
+        stackless.tasklet(Caller)(2)
+        PumpEndPoints(client, server)
+        self.failUnless(results[1:] == [ 2 ], "The call after the HELLO failed, got %s" % results)
+
+    def testUnknownPacketDisconnects(self):
+        """The goal of this test is to ensure that a packet of an unknown
+        type drops the connection cleanly, failing the calls awaiting
+        results, rather than killing the reading tasklet with an error."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+
+        _socket = DummyClass()
+        _socket.sendall = lambda data: None
+        _socket.closed = False
+        def socket_close():
+            _socket.closed = True
+        _socket.close = socket_close
+        recvChannel = stackless.channel()
+        _socket.recv = lambda numBytes: recvChannel.receive()
+        endpoint = rpc.EndPoint(_socket)
+        stackless.run()
+        future = endpoint._RegisterCall()
+
+        packet = struct.pack(endpoint.packetHeaderFmt, 99, 0, 0)
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            recvChannel.send(struct.pack(endpoint.packetSizeFmt, len(packet)) + packet)
+            stackless.run()
+        finally:
+            sys.stderr = stderr
+        self.failUnless(endpoint.disconnected and _socket.closed, "The connection was not dropped")
+        self.failUnlessRaises(rpc.DisconnectedError, future.Wait)
+
+    def testNotifyHasNoResult(self):
+        """The goal of this test is to ensure that a notification is
+        dispatched on the remote side, but that nothing is sent back for
+        it, even when it fails."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+        endpoint.tasklet.kill()
+
+        sent = []
+        _socket.sendall = lambda data: sent.append(data[endpoint.packetSizeLength:])
+        rpc.RemoteEndPoint(endpoint, "svc").Update.Notify(1, two=2)
+        self.failUnless(len(sent) == 1 and endpoint._DecodePacket(sent[0]) == (rpc.PKT_NOTIFY, 0, (("svc", "Update"), (1,), { "two": 2 })), "Unexpected notify packet")
+        self.failUnless(endpoint.channelsByCallID == {}, "A notification is waiting for a result")
+
+        dispatched = []
+        def EndPoint_DispatchIncomingCall(functionID, args, kwargs):
+            dispatched.append(args)
+            raise RuntimeError("ignored")
+        endpoint.DispatchIncomingCall = EndPoint_DispatchIncomingCall
+        del sent[:]
+        # Hide the traceback printed for the error.
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            endpoint._DispatchIncomingPacket(endpoint._EncodePacket(rpc.PKT_NOTIFY, 0, ("f", (3,), {})))
+            stackless.run()
+        finally:
+            sys.stderr = stderr
+        self.failUnless(dispatched == [(3,)], "The notification was not dispatched")
+        self.failUnless(sent == [], "Something was sent back for a notification")
+
+    def testBatchDispatchedInOrder(self):
+        """The goal of this test is to ensure that the calls in a batch go
+        out in one packet, are dispatched in the order they were made, and
+        that their results come back together to the right futures."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+        endpoint.tasklet.kill()
+        sent = []
+        _socket.sendall = lambda data: sent.append(data[endpoint.packetSizeLength:])
+
+        futures = []
+        with rpc.Batch(endpoint) as batch:
+            svc = batch.RemoteEndPoint("svc")
+            for i in range(5):
+                if i % 2:
+                    svc.Set.Notify(i)
+                else:
+                    futures.append(svc.Get(i))
+            self.failUnless(sent == [], "The batch was sent before the block ended")
+        self.failUnless(len(sent) == 1, "Expected one packet for the batch, got %d" % len(sent))
+        self.failUnless(not any(future.Done() for future in futures), "A future has a result already")
+
+        # Dispatch the batch on the same endpoint, to loop its results back.
+        dispatchOrder = []
+        blockedChannel = stackless.channel()
+        def EndPoint_DispatchIncomingCall(functionID, args, kwargs):
+            dispatchOrder.append(args[0])
+            if args[0] == 0:
+                # The calls after this one wait for it.
+                blockedChannel.receive()
+            return args[0] * 10
+        endpoint.DispatchIncomingCall = EndPoint_DispatchIncomingCall
+        batchPacket = sent.pop()
+        endpoint._DispatchIncomingPacket(batchPacket)
+        stackless.run()
+        self.failUnless(dispatchOrder == [0], "Calls after a blocked one were dispatched, got %s" % dispatchOrder)
+
+        results = []
+        stackless.tasklet(lambda: results.append([ future.Wait() for future in futures ]))()
+        stackless.run()
+        blockedChannel.send(None)
+        stackless.run()
+        self.failUnless(dispatchOrder == range(5), "The batch was not dispatched in order, got %s" % dispatchOrder)
+        self.failUnless(len(sent) == 1 and endpoint._DecodePacket(sent[0])[0] == rpc.PKT_BATCH, "The results were not sent back in one batch")
+
+        endpoint._DispatchIncomingPacket(sent[0])
+        stackless.run()
+        self.failUnless(results == [[ 0, 20, 40 ]], "Unexpected results %s" % results)
+        self.failUnless(endpoint.channelsByCallID == {}, "Results are still expected")
+
+    def testRemoteErrorPropagation(self):
+        """The goal of this test is to ensure that an exception raised by a
+        call on the remote side is raised for the caller, with the type,
+        message and traceback it had there."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+        rpc.stackless.getcurrent = stackless.getcurrent
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+        endpoint.tasklet.kill()
+        sent = []
+        _socket.sendall = lambda data: sent.append(data[endpoint.packetSizeLength:])
+
+        def EndPoint_DispatchIncomingCall(functionID, args, kwargs):
+            return {}[args[0]]
+        endpoint.DispatchIncomingCall = EndPoint_DispatchIncomingCall
+
+        errors = []
+        def Caller():
+            try:
+                rpc.RemoteEndPoint(endpoint, "svc").Lookup("missing")
+            except rpc.RemoteError, e:
+                errors.append(e)
+        stackless.tasklet(Caller)()
+        stackless.run()
+
+        # Loop the call back to the endpoint, and its error too.
+        stderr, sys.stderr = sys.stderr, StringIO.StringIO()
+        try:
+            endpoint._DispatchIncomingPacket(sent.pop())
+            stackless.run()
+        finally:
+            sys.stderr = stderr
+        self.failUnless(endpoint._DecodePacket(sent[0])[0] == rpc.PKT_ERROR, "No error packet was sent")
+        endpoint._DispatchIncomingPacket(sent.pop())
+        stackless.run()
+
+        self.failUnless(len(errors) == 1, "The caller did not get a RemoteError")
+        e = errors[0]
+        self.failUnless(e.excTypeName == "KeyError" and e.excMessage == "'missing'", "Unexpected error %s" % e)
+        self.failUnless("EndPoint_DispatchIncomingCall" in e.remoteTraceback, "The remote traceback is missing")
+        self.failUnless(endpoint.channelsByCallID == {}, "Results are still expected")
+
+    def testDisconnectFailsPendingCalls(self):
+        """The goal of this test is to ensure that calls awaiting results
+        fail when the connection drops, and that calls made afterwards fail
+        straight away."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+
+        _socket = DummyClass()
+        _socket.sendall = lambda data: None
+        # Block the socket managing tasklet in recv until we disconnect it.
+        recvChannel = stackless.channel()
+        _socket.recv = lambda numBytes: recvChannel.receive()
+        endpoint = rpc.EndPoint(_socket)
+
+        errors = []
+        def Caller():
+            try:
+                rpc.RemoteEndPoint(endpoint).Func()
+            except rpc.DisconnectedError, e:
+                errors.append(e)
+        for i in range(3):
+            stackless.tasklet(Caller)()
+        stackless.run()
+        future = rpc.Batch(endpoint).RemoteEndPoint().Func()
+        self.failUnless(len(endpoint.channelsByCallID) == 4, "Expected four calls awaiting results")
+
+        recvChannel.send("")
+        stackless.run()
+        self.failUnless(len(errors) == 3, "Expected three failed calls, got %d" % len(errors))
+        self.failUnlessRaises(rpc.DisconnectedError, future.Wait)
+        self.failUnless(endpoint.channelsByCallID == {}, "Results are still expected")
+        self.failUnlessRaises(rpc.DisconnectedError, rpc.RemoteEndPoint(endpoint).Func)
+
+    def testCancellation(self):
+        """The goal of this test is to ensure that a cancelled call is
+        taken out of the queue if it has not started, and interrupted if it
+        has, and that no result is sent for it either way."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+        rpc.stackless.getcurrent = stackless.getcurrent
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+        endpoint.tasklet.kill()
+        endpoint.maxConcurrentCalls = 1
+        sent = []
+        _socket.sendall = lambda data: sent.append(endpoint._DecodePacket(data[endpoint.packetSizeLength:]))
+
+        blockedChannel = stackless.channel()
+        dispatched = []
+        def EndPoint_DispatchIncomingCall(functionID, args, kwargs):
+            dispatched.append(functionID)
+            return blockedChannel.receive()
+        endpoint.DispatchIncomingCall = EndPoint_DispatchIncomingCall
+
+        for callID in (1, 2, 3):
+            endpoint._DispatchIncomingPacket(endpoint._EncodePacket(rpc.PKT_CALL, callID, (callID, (), {})))
+        stackless.run()
+        self.failUnless(dispatched == [1], "Expected one call running, got %s" % dispatched)
+
+        # Cancel the queued call 2, and the running call 1.
+        for callID in (2, 1):
+            endpoint._DispatchIncomingPacket(endpoint._EncodePacket(rpc.PKT_CANCEL, callID, None))
+        stackless.run()
+        self.failUnless(dispatched == [1, 3], "Expected call 3 to follow call 1, got %s" % dispatched)
+        blockedChannel.send("three")
+        stackless.run()
+        self.failUnless(sent == [(rpc.PKT_RESULT, 3, "three")], "Unexpected replies %s" % sent)
+
+        # The calling side of a cancelled future.
+        del sent[:]
+        future = rpc.Batch(endpoint).RemoteEndPoint().Func()
+        future.Cancel()
+        self.failUnless(sent == [(rpc.PKT_CANCEL, future.callID, None)], "No cancel was sent")
+        self.failUnlessRaises(rpc.CallCancelledError, future.Wait)
+        self.failUnless(endpoint.channelsByCallID == {}, "Results are still expected")
+
+    def testCallTimeout(self):
+        """The goal of this test is to ensure that a call times out through
+        the event queue, and that the remote side is told to cancel it."""
+
+        if rpc.channel_wait is None:
+            self.skipTest("call timeouts need stacklesslib")
+        import stacklesslib.main
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+        endpoint.tasklet.kill()
+        sent = []
+        _socket.sendall = lambda data: sent.append(endpoint._DecodePacket(data[endpoint.packetSizeLength:]))
+
+        errors = []
+        def Caller():
+            try:
+                rpc.RemoteEndPoint(endpoint).Func.Timeout(0.01)()
+            except rpc.CallTimeoutError, e:
+                errors.append(e)
+        stackless.tasklet(Caller)()
+        stackless.run()
+        while not errors:
+            stacklesslib.main.event_queue.pump()
+            stackless.run()
+
+        callID = sent[0][1]
+        self.failUnless(sent[1:] == [(rpc.PKT_CANCEL, callID, None)], "No cancel was sent, got %s" % sent)
+        self.failUnless(endpoint.channelsByCallID == {}, "Results are still expected")
+        # A late result is ignored.
+        endpoint._DispatchIncomingResult(callID, "late")
+
+    def testStreamedResult(self):
+        """The goal of this test is to ensure that the items of a generator
+        returned by a remote function are streamed to the caller, and that
+        no more than the stream window of them are sent ahead of those the
+        caller has taken."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+        rpc.stackless.getcurrent = stackless.getcurrent
+
+        client, server = ConnectedEndPoints()
+        server.streamWindow = 4
+        produced = []
+        def EndPoint_DispatchIncomingCall(functionID, args, kwargs):
+            def Generate():
+                for i in range(args[0]):
+                    produced.append(i)
+                    yield i
+            return Generate()
+        server.DispatchIncomingCall = EndPoint_DispatchIncomingCall
+
+        streams = []
+        stackless.tasklet(lambda: streams.append(rpc.RemoteEndPoint(client).Range(20)))()
+        PumpEndPoints(client, server)
+        self.failUnless(len(streams) == 1 and isinstance(streams[0], rpc.ResultStream), "The caller did not get a stream")
+        stream = streams[0]
+        # The generator is held up, with the window full and nothing taken.
+        self.failUnless(len(produced) == 5 and len(stream.items) == 4, "Expected 4 items sent, got %d" % len(stream.items))
+
+        received = []
+        def Consume():
+            for item in stream:
+                received.append(item)
+        stackless.tasklet(Consume)()
+        PumpEndPoints(client, server)
+        self.failUnless(received == range(20), "Unexpected items %s" % received)
+        self.failUnless(client.streamsByCallID == {} and server.streamCredits == {}, "The stream was not cleaned up")
+
+    def testStreamClosedEarly(self):
+        """The goal of this test is to ensure that closing a stream stops
+        the remote generator."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+        rpc.stackless.getcurrent = stackless.getcurrent
+
+        client, server = ConnectedEndPoints()
+        server.streamWindow = 2
+        closed = []
+        def EndPoint_DispatchIncomingCall(functionID, args, kwargs):
+            def Generate():
+                try:
+                    i = 0
+                    while True:
+                        yield i
+                        i += 1
+                finally:
+                    closed.append(True)
+            return Generate()
+        server.DispatchIncomingCall = EndPoint_DispatchIncomingCall
+
+        streams = []
+        stackless.tasklet(lambda: streams.append(rpc.RemoteEndPoint(client).Count()))()
+        PumpEndPoints(client, server)
+        stream = streams[0]
+        self.failUnless(stream.next() == 0, "Unexpected first item")
+        stream.Close()
+        PumpEndPoints(client, server)
+        self.failUnless(closed == [True], "The remote generator was not closed")
+        self.failUnlessRaises(StopIteration, stream.next)
+        self.failUnless(server.GetCallStats()["running"] == 0, "The streaming call is still running")
+
+    def testLargePacketChunking(self):
+        """The goal of this test is to ensure that a packet larger than the
+        chunk size is sent in chunks and put back together, and that the
+        packets of other tasklets are sent in between its chunks."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+        rpc.stackless.getcurrent = stackless.getcurrent
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+        endpoint.tasklet.kill()
+        endpoint.chunkSize = 1000
+
+        # Make sending block, so that other tasklets get to queue up.
+        sendChannel = stackless.channel()
+        def socket_sendall(data):
+            sendChannel.receive()
+            sent.append(data[endpoint.packetSizeLength:])
+        sent = []
+        _socket.sendall = socket_sendall
+
+        largePayload = "x" * 4500
+        stackless.tasklet(endpoint._SendPacket)(rpc.PKT_RESULT, 1, largePayload)
+        stackless.tasklet(endpoint._SendPacket)(rpc.PKT_RESULT, 2, "small")
+        stackless.run()
+        while sendChannel.balance < 0:
+            sendChannel.send(None)
+            stackless.run()
+
+        packetTypes = [ struct.unpack_from(endpoint.packetHeaderFmt, rawPacket)[0] for rawPacket in sent ]
+        self.failUnless(packetTypes == [ rpc.PKT_CHUNK, rpc.PKT_RESULT, rpc.PKT_CHUNK, rpc.PKT_CHUNK, rpc.PKT_CHUNK, rpc.PKT_CHUNK_END ], "Unexpected packets %s" % packetTypes)
+        self.failUnless(max(len(rawPacket) for rawPacket in sent) <= 1000 + endpoint.packetHeaderLength, "A chunk was too large")
+
+        results = []
+        endpoint._DispatchIncomingResult = lambda callID, payload: results.append((callID, payload))
+        for rawPacket in sent:
+            endpoint._DispatchIncomingPacket(rawPacket)
+        self.failUnless(results == [ (2, "small"), (1, largePayload) ], "The packets were not put back together")
+        self.failUnless(endpoint.chunksByID == {}, "Chunks were left over")
+
+    def testChunkedPacketSizeLimit(self):
+        """The goal of this test is to ensure that a call too large to be put
+        back together from its chunks is answered with an error, and that
+        the rest of its chunks are ignored."""
+
+        rpc.stackless.tasklet = stackless.tasklet
+        rpc.stackless.channel = stackless.channel
+        rpc.stackless.getcurrent = stackless.getcurrent
+
+        _socket = DummyClass()
+        endpoint = rpc.EndPoint(_socket)
+        endpoint.tasklet.kill()
+        endpoint.chunkSize = 1000
+        endpoint.maxChunkedPacketSize = 2500
+        sent = []
+        _socket.sendall = lambda data: sent.append(data[endpoint.packetSizeLength:])
+
+        endpoint._SendPacket(rpc.PKT_CALL, 1, (("svc", "Store"), ("x" * 4500,), {}))
+        endpoint._SendPacket(rpc.PKT_CALL, 2, (("svc", "Store"), ("x" * 2000,), {}))
+        chunks, sent[:] = sent[:], []
+        calls = []
+        endpoint.DispatchIncomingCall = lambda functionID, args, kwargs: calls.append(len(args[0]))
+        for rawPacket in chunks:
+            endpoint._DispatchIncomingPacket(rawPacket)
+        stackless.run()
+
+        replies = [ endpoint._DecodePacket(rawPacket) for rawPacket in sent ]
+        self.failUnless(calls == [ 2000 ], "Expected only the smaller call, got %s" % calls)
+        self.failUnless([ reply[:2] for reply in replies ] == [ (rpc.PKT_ERROR, 1), (rpc.PKT_RESULT, 2) ], "Unexpected replies %s" % replies)
+        self.failUnless(replies[0][2][0] == "rpc.ProtocolError", "The error was not a ProtocolError")
+        self.failUnless(endpoint.chunksByID == {} and endpoint.refusedChunkIDs == set(), "Chunks were left over")
+
 # ...
 
+def ConnectedEndPoints(codecNames=(None, None)):
+    """Returns two endpoints, whose sent packets are collected for
+    PumpEndPoints to pass to the other."""
+    endpoints = []
+    for i in range(2):
+        _socket = DummyClass()
+        _socket.sent = []
+        _socket.sendall = _socket.sent.append
+        endpoint = rpc.EndPoint(_socket, codecNames[i])
+        endpoint.tasklet.kill()
+        endpoints.append(endpoint)
+    return endpoints
+
+def PumpEndPoints(*endpoints):
+    """Passes the packets sent by each of two endpoints to the other, until
+    there are no more."""
+    first, second = endpoints
+    stackless.run()
+    while first.socket.sent or second.socket.sent:
+        for endpoint, peer in ((first, second), (second, first)):
+            sent, endpoint.socket.sent[:] = endpoint.socket.sent[:], []
+            for data in sent:
+                peer._DispatchIncomingPacket(data[endpoint.packetSizeLength:])
+        stackless.run()
+
+
+class DummyUnicode(unicode):
+    pass
+
+class DummyStr(str):
+    pass
+
+class DummyInt(int):
+    pass
+
 class DummyClass:
     def __init__(self, *args, **kwargs):
         pass
@@ -0,0 +1,152 @@
+import os, sys, logging, unittest, socket
+import stackless
+
+# Ensure the module to be tested is importable.
+if __name__ == "__main__":
+    currentPath = sys.path[0]
+    parentPath = os.path.dirname(currentPath)
+    if parentPath not in sys.path:
+        sys.path.append(parentPath)
+
+import rpc, rpcpool
+
+
+class DummySocket:
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class PoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.pool = rpcpool.RPCClientPool(connectionsPerAddress=2)
+        # The tests call Maintain() themselves.
+        self.pool.maintenanceInterval = None
+        self.connects = []
+        self.pool.CreateEndPoint = self.CreateEndPoint
+        self.refuse = False
+        # When set, connections are not made until released.
+        self.connectChannel = None
+
+    def tearDown(self):
+        self.pool.Close()
+        stackless.run()
+
+    def CreateEndPoint(self, address):
+        self.connects.append(address)
+        if self.connectChannel is not None:
+            self.connectChannel.receive()
+        if self.refuse:
+            raise socket.error("refused")
+        endpoint = rpc.EndPoint(DummySocket())
+        # Nothing is read in these tests.
+        endpoint.tasklet.kill()
+        return endpoint
+
+    def testLazyConnectAndLeastOutstanding(self):
+        """The goal of this test is to ensure that connections are only made
+        as they are needed, and that each call goes out on the connection
+        with the fewest calls awaiting results."""
+
+        address = ("127.0.0.1", 1)
+        remote = self.pool.RemoteEndPoint(address)
+        self.failUnless(self.connects == [], "A connection was made before any call")
+
+        first = self.pool.GetEndPoint(address)
+        self.failUnless(len(self.connects) == 1, "Expected one connection")
+        self.failUnless(self.pool.GetEndPoint(address) is first, "An idle connection was not reused")
+
+        # With a call awaiting a result on the first, the next is opened.
+        firstFuture = first._RegisterCall()
+        self.failUnless(self.pool.GetEndPoint(address) is first, "Expected the only connection")
+        stackless.run()
+        second = self.pool.GetEndPoint(address)
+        self.failUnless(len(self.connects) == 2 and second is not first, "A second connection was not opened")
+
+        # Both are busy, and there is no room for a third.
+        second._RegisterCall()
+        second._RegisterCall()
+        self.failUnless(self.pool.GetEndPoint(address) is first, "The least busy connection was not chosen")
+        stackless.run()
+        self.failUnless(len(self.connects) == 2, "Too many connections were opened")
+
+        stats = self.pool.GetStats()[address]
+        self.failUnless(stats["connected"] == 2 and stats["outstanding"] == 3, "Unexpected stats %s" % stats)
+
+    def testConcurrentCallersConnectOnce(self):
+        """The goal of this test is to ensure that callers which arrive
+        while another connection is being made do not make it again."""
+
+        address = ("127.0.0.1", 1)
+        first = self.pool.GetEndPoint(address)
+        first._RegisterCall()
+
+        self.connectChannel = stackless.channel()
+        for i in range(5):
+            self.failUnless(self.pool.GetEndPoint(address) is first, "Expected the only connection")
+        stackless.run()
+        self.failUnless(len(self.connects) == 2, "Expected one more connection, got %d" % (len(self.connects) - 1))
+        self.failUnless(self.pool.GetStats()[address]["connecting"] == 1, "Expected a connection being made")
+
+        self.connectChannel.send(None)
+        stackless.run()
+        second = self.pool.GetEndPoint(address)
+        self.failUnless(second is not first, "The second connection was not made")
+        self.failUnless(self.pool.GetStats()[address]["connected"] == 2, "Unexpected stats %s" % self.pool.GetStats()[address])
+
+    def testReconnectBackoff(self):
+        """The goal of this test is to ensure that an address which refuses
+        connections is not tried again until the backoff delay passes, and
+        that a dropped connection is replaced."""
+
+        address = ("127.0.0.1", 1)
+        self.refuse = True
+        self.failUnlessRaises(rpc.DisconnectedError, self.pool.GetEndPoint, address)
+        self.failUnlessRaises(rpc.DisconnectedError, self.pool.GetEndPoint, address)
+        self.failUnless(len(self.connects) == 1, "The address was tried again during the backoff")
+
+        addressPool = self.pool.addressPools[address]
+        self.failUnless(addressPool.retryTime > 0 and addressPool.failures == 1, "No backoff was set")
+        addressPool.retryTime = 0.0
+        self.failUnlessRaises(rpc.DisconnectedError, self.pool.GetEndPoint, address)
+        self.failUnless(addressPool.failures == 2, "The failures were not counted")
+
+        addressPool.retryTime = 0.0
+        self.refuse = False
+        endpoint = self.pool.GetEndPoint(address)
+        self.failUnless(addressPool.failures == 0, "The failures were not reset")
+
+        endpoint._Disconnected()
+        replacement = self.pool.GetEndPoint(address)
+        self.failUnless(replacement is not endpoint and not replacement.disconnected, "The dropped connection was not replaced")
+
+    def testMaintenance(self):
+        """The goal of this test is to ensure that connections which have
+        not been used for a while are closed, and that busy ones are left
+        alone."""
+
+        address = ("127.0.0.1", 1)
+        busy = self.pool.GetEndPoint(address)
+        future = busy._RegisterCall()
+        self.pool.GetEndPoint(address)
+        stackless.run()
+        idle = self.pool.GetEndPoint(address)
+        self.failUnless(idle is not busy, "Expected two connections")
+
+        self.pool.idleTimeout = -1
+        self.pool.Maintain()
+        # The busy connection gets a ping, which is never answered here.
+        stackless.run()
+        self.failUnless(idle.socket.closed and not hasattr(busy.socket, "closed"), "The idle connection was not closed")
+        self.failUnless(self.pool.GetStats()[address]["connected"] == 1, "Expected one connection left")
+
+        self.pool.Close()
+        self.failUnlessRaises(rpc.DisconnectedError, future.Wait)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+
+    unittest.main()
@@ -32,6 +32,7 @@
 
 import stackless
 import time
+from stacklesslib.broadcast import Topic
 
 # Nice way to put the tasklet to sleep - from stackless.com wiki/Idioms
 ##########################################################
@@ -70,17 +71,16 @@ stackless.tasklet(ManageSleepingTasklets)()
 # make something up - say, fire an event whenever time.time() is divisble
 # by 10.
 
-fake_event_listeners = []
+# Only the latest event matters to the clients, so there's no history.
+fake_events = Topic("fake events", history_size=1)
 def fake_event_source():
     """This function loops indefinately, and on every 10 second boundary
-    from the epoch, it dispatches an event to a list of listeners. The listeners
-    are called with the current timestamp as the sole argument."""
+    from the epoch, it publishes the current timestamp to fake_events. That
+    wakes up everyone waiting on the topic in one go."""
     while 1:
-        if len(fake_event_listeners):
-            now = int(time.time())
-            if now % 10 == 0:
-                for f in fake_event_listeners:
-                    f(now)
+        now = int(time.time())
+        if now % 10 == 0:
+            fake_events.publish(now)
         sleep(1)
         
 stackless.tasklet(fake_event_source)()
@@ -88,16 +88,9 @@ stackless.tasklet(fake_event_source)()
 
 def wsgi_app(environ, start_response):
     
-    # Set up a channel and an event listener that will send() on that
-    # channel when the event occurs.
-    ch = stackless.channel()
-    def evt(timestamp):
-        stackless.tasklet(ch.send)(timestamp)
-    fake_event_listeners.append(evt)
-    
-    # Then we suspend until that happens, meanwhile the client waits
-    timestamp = ch.receive()
-    fake_event_listeners.remove(evt)
+    # Suspend until the next event is published, meanwhile the client waits
+    events, cursor = fake_events.wait(fake_events.cursor())
+    timestamp = events[-1]
     
     start_response('200 OK', [('Content-type','text/plain')])
     return ['The time is %s\n' % time.strftime("%d.%m.%Y %H:%M:%S", time.localtime(timestamp))]
@@ -0,0 +1,145 @@
+#
+# Measures how fast stacklesswsgi can push out responses of various sizes.
+#
+# The server runs in a child process serving GET /bytes/<n>, which returns
+# n bytes with a Content-Length header. The parent fetches responses over
+# one keep-alive connection with a plain blocking socket and reports
+# requests and megabytes per second for each size.
+#
+# Usage: python bench_throughput.py [-p depth] [seconds] [size ...]
+#
+# Sizes default to 1 KB, 100 KB and 10 MB. With -p, each size is also
+# fetched with depth requests pipelined at a time, which is where the
+# server's batching of pipelined responses shows.
+#
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+HOST = "127.0.0.1"
+PORT = 40406
+DEFAULT_SIZES = [1024, 100 * 1024, 10 * 1024 * 1024]
+
+
+bodies = {}
+
+
+def bytes_app(environ, start_response):
+    """Serves /bytes/<n>. Bodies are built once and then reused."""
+    try:
+        size = int(environ["PATH_INFO"].split("/")[2])
+    except (IndexError, ValueError):
+        start_response("404 Not Found", [("Content-Length", "0")])
+        return [""]
+    body = bodies.get(size)
+    if body is None:
+        body = bodies[size] = "x" * size
+    start_response("200 OK", [("Content-Type", "application/octet-stream"),
+                              ("Content-Length", str(size))])
+    return [body]
+
+
+def serve(port):
+    import stacklesswsgi
+    stacklesswsgi.Server((HOST, port), bytes_app).start()
+
+
+class ResponseReader(object):
+    """Reads Content-Length delimited responses off a blocking socket."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def _fill(self):
+        data = self.sock.recv(262144)
+        if not data:
+            raise EOFError("server closed the connection")
+        self.buffer += data
+
+    def read_response(self):
+        """Read one response and return the size of its body."""
+        buf = self.buffer
+        start = 0
+        while True:
+            idx = buf.find("\r\n\r\n", start)
+            if idx > -1:
+                break
+            start = max(len(buf) - 3, 0)
+            self._fill()
+        head = str(buf[:idx]).lower()
+        length = int(head.split("content-length:", 1)[1].split("\r\n", 1)[0])
+        end = idx + 4 + length
+        while len(buf) < end:
+            self._fill()
+        del buf[:end]
+        return length
+
+
+def connect(port, timeout=10.0):
+    """Connect to the server, waiting for it to start listening."""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection((HOST, port))
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def fetch(port, size, seconds, depth=1):
+    """Fetch /bytes/<size> for the given number of seconds, sending depth
+    requests at a time before reading their responses."""
+    sock = connect(port)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    reader = ResponseReader(sock)
+    request = "GET /bytes/%d HTTP/1.1\r\nHost: %s\r\n\r\n" % (size, HOST)
+    requests = request * depth
+    count = received = 0
+    start = time.time()
+    end = start + seconds
+    while True:
+        sock.sendall(requests)
+        for i in xrange(depth):
+            received += reader.read_response()
+        count += depth
+        now = time.time()
+        if now >= end:
+            break
+    sock.close()
+    return count / (now - start), received / (now - start) / (1024 * 1024)
+
+
+def main(seconds, sizes, depth=1):
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                               "--serve", str(PORT)])
+    depths = sorted(set([1, depth]))
+    try:
+        print "%12s %6s %14s %10s" % ("size", "depth", "requests/s", "MB/s")
+        for size in sizes:
+            for d in depths:
+                rps, mbps = fetch(PORT, size, seconds, d)
+                print "%12d %6d %14.0f %10.1f" % (size, d, rps, mbps)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["--serve"]:
+        serve(int(args[1]))
+    else:
+        depth = 1
+        if args[:1] == ["-p"]:
+            depth = int(args[1])
+            del args[:2]
+        seconds = 3.0
+        if args:
+            seconds = float(args.pop(0))
+        sizes = [int(arg) for arg in args] or DEFAULT_SIZES
+        main(seconds, sizes, depth)
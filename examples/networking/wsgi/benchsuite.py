@@ -0,0 +1,221 @@
+#
+# Canned load scenarios for stacklesswsgi, driven by loadgen.py.
+#
+# The server runs in a child process with a small app:
+#   /hello      a short text response
+#   /bytes/<n>  n bytes with a Content-Length header
+#   /text/<n>   n bytes of text, gzipped on threads by CompressionMiddleware
+#   /text-inline/<n>  the same, gzipped in the tasklet serving the request
+#   /comet      a long poll which is never answered
+#   /stats      the server's connection counters, as JSON
+# The /comet handler waits on a channel like the one in app_comet.py, without
+# that module's event source and sleep manager, which would keep the
+# scheduler busy and skew the other numbers.
+#
+# Usage: python benchsuite.py [--json] [-d seconds] [scenario ...]
+#
+# The scenarios are listed by -l. With --json, one JSON object is printed per
+# scenario, to keep and compare between revisions.
+#
+
+import json
+import os
+import random
+import socket
+import string
+import subprocess
+import sys
+import time
+
+import stackless
+import compression
+import loadgen
+
+HOST = "127.0.0.1"
+PORT = 40407
+
+# name: (description, path, concurrency, keep-alive, pipeline, idle clients,
+#        background load)
+# The background load is a (path, concurrency) of gzipped requests made at
+# the same time, whose effect on the latency of the main load is the point.
+SCENARIOS = [
+    ("hello", ("hello world, keep-alive", "/hello", 50, True, 1, 0, None)),
+    ("hello-pipelined", ("hello world, 16 pipelined requests", "/hello", 50, True, 16, 0, None)),
+    ("hello-close", ("hello world, a connection per request", "/hello", 50, False, 1, 0, None)),
+    ("1mb", ("1 MB bodies, keep-alive", "/bytes/1048576", 10, True, 1, 0, None)),
+    ("comet-idle", ("hello world with 10000 idle long polls open", "/hello", 50, True, 1, 10000, None)),
+    ("gzip-threads", ("hello world while 4 MB bodies are gzipped on threads",
+                      "/hello", 50, True, 1, 0, ("/text/4194304", 4))),
+    ("gzip-inline", ("hello world while 4 MB bodies are gzipped in tasklets",
+                     "/hello", 50, True, 1, 0, ("/text-inline/4194304", 4))),
+]
+
+
+comet_channel = stackless.channel()
+texts = {}
+
+
+def text_app(environ, start_response):
+    """Serves n bytes of text for /<anything>/<n>. It repeats a block of
+    random words which is bigger than zlib's window, so that compressing it
+    is real work."""
+    size = int(environ["PATH_INFO"].split("/")[2])
+    body = texts.get(size)
+    if body is None:
+        if None not in texts:
+            rnd = random.Random(0)
+            words = ["".join(rnd.choice(string.ascii_lowercase)
+                             for i in xrange(rnd.randint(2, 9)))
+                     for i in xrange(2000)]
+            block = []
+            length = 0
+            while length < 262144:
+                word = rnd.choice(words)
+                block.append(word)
+                length += len(word) + 1
+            texts[None] = " ".join(block)
+        block = texts[None]
+        body = texts[size] = (block * (size // len(block) + 1))[:size]
+    start_response("200 OK", [("Content-Type", "text/plain"),
+                              ("Content-Length", str(size))])
+    return [body]
+
+gzip_on_threads = compression.CompressionMiddleware(text_app)
+gzip_inline = compression.CompressionMiddleware(text_app, thread_min_size=None)
+
+
+def bench_app(environ, start_response):
+    path = environ["PATH_INFO"]
+    if path == "/hello":
+        body = "Hello world!\n"
+    elif path.startswith("/bytes/"):
+        body = "x" * int(path[7:])
+    elif path.startswith("/text/"):
+        return gzip_on_threads(environ, start_response)
+    elif path.startswith("/text-inline/"):
+        return gzip_inline(environ, start_response)
+    elif path == "/comet":
+        body = comet_channel.receive()
+    elif path == "/stats":
+        body = json.dumps(bench_app.server.stats())
+    else:
+        start_response("404 Not Found", [("Content-Length", "0")])
+        return [""]
+    start_response("200 OK", [("Content-Type", "text/plain"),
+                              ("Content-Length", str(len(body)))])
+    return [body]
+
+
+def serve(port):
+    import stacklesswsgi
+    server = stacklesswsgi.Server((HOST, port), bench_app)
+    # Leave room for the idle clients.
+    server.max_connections = 20000
+    server.keepalive_timeout = None
+    loadgen.raise_fd_limit(server.max_connections + 100)
+    bench_app.server = server
+    server.start()
+
+
+def wait_for_server(port, timeout=10.0):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection((HOST, port)).close()
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def server_stats(port):
+    """Fetch the server's connection counters."""
+    sock = socket.create_connection((HOST, port))
+    try:
+        sock.sendall("GET /stats HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n" % HOST)
+        data = ""
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        sock.close()
+    return json.loads(data.split("\r\n\r\n", 1)[1])
+
+
+def run_scenario(name, seconds, port=PORT):
+    """Run one scenario against the server on port and return its result
+    as a dict."""
+    (description, path, concurrency, keepalive, pipeline, idle,
+     background) = dict(SCENARIOS)[name]
+    clients = None
+    if idle:
+        clients = loadgen.IdleClients(HOST, port, "/comet", idle)
+    if background:
+        background_done = stackless.channel()
+        def run_background():
+            result = loadgen.run(HOST, port, background[0], background[1],
+                                 seconds, headers=[("Accept-Encoding", "gzip")])
+            background_done.send(result.as_dict())
+        stackless.tasklet(run_background)()
+    try:
+        result = loadgen.run(HOST, port, path, concurrency, seconds,
+                             keepalive, pipeline).as_dict()
+        if clients is not None:
+            result["idle_clients"] = len(clients.socks)
+            result["server"] = server_stats(port)
+        if background:
+            result["background"] = background_done.receive()
+    finally:
+        if clients is not None:
+            clients.close()
+    result.update(scenario=name, description=description, path=path,
+                  concurrency=concurrency, keepalive=keepalive,
+                  pipeline=pipeline)
+    return result
+
+
+def main(names, seconds, as_json, port=PORT):
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                               "--serve", str(port)])
+    try:
+        wait_for_server(port)
+        results = []
+        def go():
+            for name in names:
+                result = run_scenario(name, seconds, port)
+                loadgen.report(name, result, as_json)
+                if "background" in result and not as_json:
+                    loadgen.report("  background", result["background"])
+                results.append(result)
+        stackless.tasklet(go)()
+        stackless.run()
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["--serve"]:
+        serve(int(args[1]))
+    elif args[:1] == ["-l"]:
+        for name, info in SCENARIOS:
+            print "%-16s %s" % (name, info[0])
+    else:
+        as_json = False
+        if "--json" in args:
+            args.remove("--json")
+            as_json = True
+        seconds = 5.0
+        if args[:1] == ["-d"]:
+            seconds = float(args[1])
+            del args[:2]
+        names = args or [name for name, info in SCENARIOS]
+        for name in names:
+            if name not in dict(SCENARIOS):
+                sys.exit("unknown scenario %r, see -l" % name)
+        main(names, seconds, as_json)
@@ -0,0 +1,209 @@
+#
+# A WSGI middleware which gzips response bodies, for use with stacklesswsgi.
+#
+# zlib releases the GIL while it compresses, but a tasklet calling it still
+# holds up every other tasklet in the process until it is done. So pieces
+# of the body above a size are compressed on real threads, through
+# stacklesslib.util.call_on_thread, while the other connections carry on.
+# The compressed body is streamed out a piece at a time, with the chunked
+# transfer-coding, rather than being collected first.
+#
+# Usage:
+#   app = CompressionMiddleware(app)
+#   stacklesswsgi.Server(("127.0.0.1", 8080), app).start()
+#
+# Only responses which the client accepts gzip for, with a compressible
+# Content-Type, a 200 status and at least min_size bytes of body are
+# compressed. Responses from wsgi.file_wrapper are left alone, so that they
+# can still be sent with sendfile().
+#
+
+import zlib
+
+from stacklesslib import threadpool, util
+
+
+def accepts_gzip(environ):
+    """True if the request's Accept-Encoding allows gzip."""
+    for coding in environ.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        params = coding.split(";")
+        if params[0].strip().lower() not in ("gzip", "x-gzip", "*"):
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def iterate_with_writes(iterator, written):
+    """Yield the pieces of a response body, with the data the app passed to
+    write() in the meantime, held in the list written, in its place."""
+    while True:
+        try:
+            data = iterator.next()
+            finished = False
+        except StopIteration:
+            finished = True
+        # Anything written while the app produced a piece goes before it.
+        if written:
+            pieces = written[:]
+            del written[:]
+            for piece in pieces:
+                yield piece
+        if finished:
+            return
+        yield data
+
+
+class CompressionMiddleware(object):
+    """Gzips the responses of the WSGI app it wraps.
+    - min_size: bodies smaller than this many bytes are sent as they are.
+    - thread_min_size: pieces of the body at least this big are compressed
+      on a thread from pool. None compresses everything in the tasklet.
+    - piece_size: the most that is compressed at a time, so that output
+      starts to flow before a large body is all compressed.
+    - level: the zlib compression level.
+    """
+
+    min_size = 1024
+    thread_min_size = 16384
+    piece_size = 65536
+    level = 6
+    compressible_types = ("text/", "application/json", "application/javascript",
+                          "application/xml", "application/xhtml+xml",
+                          "image/svg+xml")
+
+    def __init__(self, app, pool=None, **options):
+        self.app = app
+        if pool is None:
+            pool = threadpool.simple_threadpool(n_threads=4)
+        self.pool = pool
+        for name, value in options.iteritems():
+            if not hasattr(self, name):
+                raise TypeError("unknown option %r" % name)
+            setattr(self, name, value)
+
+    def __call__(self, environ, start_response):
+        if environ["REQUEST_METHOD"] == "HEAD" or not accepts_gzip(environ):
+            return self.app(environ, start_response)
+
+        response_args = []
+        written = []
+        # Where the app's write() goes: held back with the body, unless the
+        # response is passed through.
+        write_to = [written.append]
+        def write(data):
+            write_to[0](data)
+        def capture_start_response(status, headers, exc_info=None):
+            if exc_info and response_args and response_args[0] is None:
+                # The headers have gone out already
+                try:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                finally:
+                    exc_info = None
+            response_args[:] = [status, headers, exc_info]
+            return write
+        response = self.app(environ, capture_start_response)
+
+        # If the app has already decided on a response which won't be
+        # compressed, pass it through untouched.
+        file_wrapper = environ.get("wsgi.file_wrapper")
+        if response_args and not written and (
+                not self.should_compress(*response_args[:2]) or
+                isinstance(file_wrapper, type) and isinstance(response, file_wrapper)):
+            write_to[0] = start_response(*response_args)
+            return response
+        return self.compress_response(response, response_args, written, start_response)
+
+    def should_compress(self, status, headers):
+        if status[:3] != "200":
+            return False
+        content_type = None
+        for key, value in headers:
+            key = key.lower()
+            if key == "content-type":
+                content_type = value.lower()
+            elif key == "content-encoding":
+                return False
+            elif key == "content-length":
+                try:
+                    if int(value) < self.min_size:
+                        return False
+                except ValueError:
+                    return False
+            elif key == "cache-control" and "no-transform" in value.lower():
+                return False
+        if content_type is None:
+            return False
+        for prefix in self.compressible_types:
+            if content_type.startswith(prefix):
+                return True
+        return False
+
+    def compress_response(self, response, response_args, written, start_response):
+        """Generate the body of response, gzipped if it turns out to be
+        worth it."""
+        body = iterate_with_writes(iter(response), written)
+        try:
+            # Hold on to the body until it is known to be big enough.
+            pending = []
+            size = 0
+            finished = False
+            while size < self.min_size:
+                try:
+                    data = body.next()
+                except StopIteration:
+                    finished = True
+                    break
+                if data:
+                    pending.append(data)
+                    size += len(data)
+
+            status, headers, exc_info = response_args
+            if finished or not self.should_compress(status, headers):
+                start_response(status, headers, exc_info)
+                response_args[0] = None
+                for data in pending:
+                    yield data
+                for data in body:
+                    yield data
+                return
+
+            headers = [(k, v) for k, v in headers if k.lower() != "content-length"]
+            headers.append(("Content-Encoding", "gzip"))
+            headers.append(("Vary", "Accept-Encoding"))
+            start_response(status, headers, exc_info)
+            response_args[0] = None
+
+            # wbits of 16 + MAX_WBITS gives the gzip header and trailer.
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            for data in pending:
+                for out in self.compress(compressor, data):
+                    yield out
+            for data in body:
+                for out in self.compress(compressor, data):
+                    yield out
+            yield compressor.flush()
+        finally:
+            if hasattr(response, "close"):
+                response.close()
+
+    def compress(self, compressor, data):
+        """Compress data a piece at a time, yielding the output there is."""
+        piece_size = self.piece_size
+        for offset in xrange(0, len(data), piece_size):
+            if len(data) > piece_size:
+                piece = buffer(data, offset, piece_size)
+            else:
+                piece = data
+            if self.thread_min_size is not None and len(piece) >= self.thread_min_size:
+                out = util.call_on_thread(compressor.compress, (piece,), pool=self.pool)
+            else:
+                out = compressor.compress(piece)
+            if out:
+                yield out
@@ -0,0 +1,416 @@
+#
+# A tasklet based HTTP load generator.
+#
+# Each simulated client is a tasklet using the stacklesslib socket
+# replacement, so a single process can keep thousands of connections busy
+# (or idle) at once. Clients can use keep-alive connections or a new
+# connection per request, and can pipeline requests. Throughput and the
+# latency distribution are reported at the end.
+#
+# Usage: python loadgen.py [options] http://host:port/path
+#
+# Run with -h for the options. See benchsuite.py for canned scenarios.
+#
+
+import json
+import optparse
+import socket
+import sys
+import time
+import urlparse
+
+import stackless
+import stacklesslib.main
+from stacklesslib.replacements import socket_asyncore
+from stacklesswsgi import asyncore_loop
+
+
+# The socket replacement starts a manager tasklet which polls with select(),
+# and that can't handle more than FD_SETSIZE (usually 1024) sockets. The
+# server's asyncore_loop uses poll() where it is available, and also runs
+# the stacklesslib event queue, which the Watchdog below needs.
+_manager = None
+
+def _start_manager():
+    global _manager
+    # asyncore_loop only marks itself running once its tasklet starts.
+    if not asyncore_loop.running and (_manager is None or not _manager.alive):
+        _manager = stackless.tasklet(asyncore_loop)()
+
+def install():
+    """Have the socket module create sockets that block only the calling
+    tasklet. Called by the functions below as needed."""
+    if socket.socket is not socket_asyncore._socketobject_new:
+        socket_asyncore.stacklesssocket_manager(_start_manager)
+        socket_asyncore.install()
+
+
+def raise_fd_limit(count):
+    """Try to allow at least count open files. Returns the limit in force."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < count:
+        if hard == resource.RLIM_INFINITY or hard > count:
+            soft = count
+        else:
+            soft = hard
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        except (ValueError, resource.error):
+            soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    return soft
+
+
+class ResponseReader(object):
+    """Reads HTTP responses off a socket. Bodies are delimited by
+    Content-Length, the chunked transfer-coding or the connection closing."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def _fill(self):
+        data = self.sock.recv(262144)
+        if not data:
+            return False
+        self.buffer += data
+        return True
+
+    def _read_until(self, marker):
+        buf = self.buffer
+        start = 0
+        while True:
+            idx = buf.find(marker, start)
+            if idx > -1:
+                return idx
+            start = max(len(buf) - len(marker) + 1, 0)
+            if not self._fill():
+                raise EOFError("Connection closed in the middle of a response")
+
+    def _read_exactly(self, count):
+        while len(self.buffer) < count:
+            if not self._fill():
+                raise EOFError("Connection closed in the middle of a response")
+
+    def read_response(self):
+        """Read one response. Returns (status, body size, keep-alive)."""
+        buf = self.buffer
+        idx = self._read_until("\r\n\r\n")
+        lines = str(buf[:idx]).split("\r\n")
+        del buf[:idx + 4]
+        status = int(lines[0].split(" ", 2)[1])
+        headers = {}
+        for line in lines[1:]:
+            k, v = line.split(":", 1)
+            headers[k.strip().lower()] = v.strip()
+        keepalive = headers.get("connection", "").lower() != "close"
+
+        if "content-length" in headers:
+            size = int(headers["content-length"])
+            self._read_exactly(size)
+            del buf[:size]
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            size = 0
+            while True:
+                idx = self._read_until("\r\n")
+                chunk = int(str(buf[:idx]).split(";", 1)[0], 16)
+                del buf[:idx + 2]
+                if not chunk:
+                    # Skip any trailers
+                    idx = self._read_until("\r\n")
+                    while idx:
+                        del buf[:idx + 2]
+                        idx = self._read_until("\r\n")
+                    del buf[:2]
+                    break
+                self._read_exactly(chunk + 2)
+                del buf[:chunk + 2]
+                size += chunk
+        else:
+            while self._fill():
+                pass
+            size = len(buf)
+            del buf[:]
+            keepalive = False
+        return status, size, keepalive
+
+
+class Result(object):
+    """What a load run measured. Latencies are in seconds."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.received = 0
+        self.latencies = []
+        self.seconds = 0.0
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.errors += other.errors
+        self.received += other.received
+        self.latencies += other.latencies
+
+    def percentile(self, p):
+        """The latency which p (0 to 1) of the requests took no longer than."""
+        if not self.latencies:
+            return None
+        latencies = self.latencies
+        index = min(int(p * len(latencies) + 0.5), len(latencies)) - 1
+        return latencies[max(index, 0)]
+
+    def as_dict(self):
+        self.latencies.sort()
+        def ms(value):
+            if value is None:
+                return None
+            return round(value * 1000.0, 3)
+        seconds = self.seconds or 1.0
+        return {"requests": self.requests,
+                "errors": self.errors,
+                "seconds": round(self.seconds, 3),
+                "requests_per_sec": round(self.requests / seconds, 1),
+                "mb_per_sec": round(self.received / seconds / (1024 * 1024), 2),
+                "latency_ms": {"p50": ms(self.percentile(0.5)),
+                               "p99": ms(self.percentile(0.99)),
+                               "p999": ms(self.percentile(0.999)),
+                               "max": ms(self.latencies and self.latencies[-1] or None)}}
+
+
+class Watchdog(object):
+    """Closes the connections of clients which have waited longer than
+    timeout seconds to connect or for their responses, so that a stalled
+    server can't hang the run. The clients count these as errors.
+    
+    Socket timeouts would need a timer for every recv() call, so instead,
+    like stacklesswsgi's connection_reaper, the waiting clients are checked
+    from one timer on the stacklesslib event queue."""
+    
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.interval = min(timeout / 4.0, 1.0)
+        # socket -> when its client started waiting on it
+        self.waiting = {}
+        self.timeouts = 0
+        self.running = False
+    
+    def start(self):
+        if not self.running:
+            self.running = True
+            stacklesslib.main.event_queue.push_after(self.check, self.interval)
+    
+    def stop(self):
+        if self.running:
+            self.running = False
+            try:
+                stacklesslib.main.event_queue.cancel(self.check)
+            except ValueError:
+                pass
+    
+    def watch(self, sock):
+        self.waiting[sock] = time.time()
+    
+    def unwatch(self, sock):
+        self.waiting.pop(sock, None)
+    
+    def check(self):
+        limit = time.time() - self.timeout
+        for sock, since in self.waiting.items():
+            if since <= limit:
+                del self.waiting[sock]
+                self.timeouts += 1
+                # Closing the socket object only drops its reference, so
+                # close the stackless socket under it, which fails the call
+                # the client is blocked in.
+                sock._sock.close()
+        if self.running:
+            stacklesslib.main.event_queue.push_after(self.check, self.interval)
+
+
+def client(address, request, deadline, keepalive, pipeline, result, watchdog=None):
+    """One simulated client. Sends pipeline requests at a time until the
+    deadline, reconnecting as needed, and records what happened in result.
+    If a watchdog is given, it times out the waits for the server."""
+    requests = request * pipeline
+    sock = reader = None
+    while time.time() < deadline:
+        try:
+            if sock is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                if watchdog is not None:
+                    watchdog.watch(sock)
+                sock.connect(address)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                reader = ResponseReader(sock)
+            start = time.time()
+            if watchdog is not None:
+                watchdog.watch(sock)
+            sock.sendall(requests)
+            for i in xrange(pipeline):
+                status, size, alive = reader.read_response()
+                now = time.time()
+                result.requests += 1
+                result.received += size
+                result.latencies.append(now - start)
+                if status >= 400:
+                    result.errors += 1
+            if watchdog is not None:
+                watchdog.unwatch(sock)
+            if not (keepalive and alive):
+                sock.close()
+                sock = None
+        except (EnvironmentError, EOFError, ValueError):
+            result.errors += 1
+            if sock is not None:
+                if watchdog is not None:
+                    watchdog.unwatch(sock)
+                sock.close()
+            sock = None
+    if sock is not None:
+        sock.close()
+
+
+def build_request(host, port, path, keepalive, headers=()):
+    lines = ["GET %s HTTP/1.1" % path, "Host: %s:%d" % (host, port)]
+    if not keepalive:
+        lines.append("Connection: close")
+    lines += ["%s: %s" % header for header in headers]
+    return "\r\n".join(lines) + "\r\n\r\n"
+
+
+def run(host, port, path="/", concurrency=10, duration=5.0, keepalive=True,
+        pipeline=1, headers=(), timeout=10.0):
+    """Load the server at host:port with concurrency clients fetching path
+    for duration seconds, and return a Result. headers is a list of extra
+    (name, value) request headers. Requests which take longer than timeout
+    seconds, unless it is None, are abandoned and count as errors. The
+    calling tasklet blocks while the client tasklets run."""
+    install()
+    raise_fd_limit(concurrency + 100)
+    request = build_request(host, port, path, keepalive, headers)
+    done = stackless.channel()
+    start = time.time()
+    deadline = start + duration
+    watchdog = None
+    if timeout is not None:
+        watchdog = Watchdog(timeout)
+        watchdog.start()
+
+    def run_client():
+        result = Result()
+        try:
+            client((host, port), request, deadline, keepalive, pipeline,
+                   result, watchdog)
+        finally:
+            done.send(result)
+    for i in xrange(concurrency):
+        stackless.tasklet(run_client)()
+
+    total = Result()
+    try:
+        for i in xrange(concurrency):
+            total.merge(done.receive())
+    finally:
+        if watchdog is not None:
+            watchdog.stop()
+    total.seconds = time.time() - start
+    return total
+
+
+class IdleClients(object):
+    """Opens count connections which each send a request for path, such as
+    a long poll, and then just sit there until closed."""
+
+    def __init__(self, host, port, path, count, connectors=100):
+        install()
+        raise_fd_limit(count + 200)
+        self.socks = []
+        self.failed = 0
+        request = build_request(host, port, path, True)
+        done = stackless.channel()
+
+        # Connect a bounded number at a time, so as not to overflow the
+        # server's listen queue.
+        def connector(count):
+            try:
+                for i in xrange(count):
+                    try:
+                        sock = socket.create_connection((host, port))
+                        sock.sendall(request)
+                        self.socks.append(sock)
+                    except EnvironmentError:
+                        self.failed += 1
+            finally:
+                done.send(None)
+        connectors = min(connectors, count) or 1
+        for i in xrange(connectors):
+            share = count // connectors + (i < count % connectors)
+            stackless.tasklet(connector)(share)
+        for i in xrange(connectors):
+            done.receive()
+
+    def close(self):
+        for sock in self.socks:
+            sock.close()
+        self.socks = []
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] http://host:port/path")
+    parser.add_option("-c", "--concurrency", type="int", default=10,
+                      help="number of simultaneous clients [%default]")
+    parser.add_option("-d", "--duration", type="float", default=5.0,
+                      help="seconds to run for [%default]")
+    parser.add_option("-p", "--pipeline", type="int", default=1,
+                      help="requests each client sends at a time [%default]")
+    parser.add_option("-t", "--timeout", type="float", default=10.0,
+                      help="seconds after which a request counts as an "
+                           "error [%default]")
+    parser.add_option("--close", action="store_false", dest="keepalive",
+                      default=True, help="use a new connection for each request")
+    parser.add_option("-H", "--header", action="append", dest="headers",
+                      default=[], help="add a 'Name: value' request header")
+    parser.add_option("--json", action="store_true", default=False,
+                      help="print the results as JSON")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("give one URL to load")
+    url = urlparse.urlparse(args[0])
+    host = url.hostname or "127.0.0.1"
+    port = url.port or 80
+    path = url.path or "/"
+    if url.query:
+        path += "?" + url.query
+    headers = []
+    for header in options.headers:
+        name, _, value = header.partition(":")
+        headers.append((name.strip(), value.strip()))
+
+    def go():
+        result = run(host, port, path, options.concurrency, options.duration,
+                     options.keepalive, options.pipeline, headers,
+                     options.timeout)
+        report(args[0], result.as_dict(), options.json)
+    stackless.tasklet(go)()
+    stackless.run()
+
+
+def report(name, result, as_json=False):
+    """Print one result, as a line of JSON or readable text."""
+    if as_json:
+        print json.dumps(dict(result, name=name), sort_keys=True)
+    else:
+        latency = result["latency_ms"]
+        print ("%-24s %9.1f req/s %8.2f MB/s  p50 %s ms  p99 %s ms  "
+               "p99.9 %s ms  errors %d" % (
+                   name, result["requests_per_sec"], result["mb_per_sec"],
+                   latency["p50"], latency["p99"], latency["p999"],
+                   result["errors"]))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
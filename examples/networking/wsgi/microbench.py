@@ -0,0 +1,158 @@
+#
+# Microbenchmarks for the request parsing and response header code of
+# stacklesswsgi.
+#
+# Nothing here touches a real socket. Requests are fed from memory through
+# a stand-in for sock_channel, so the numbers are the cost of the Python code
+# alone and can be compared between revisions of stacklesswsgi.py.
+#
+# Usage: python microbench.py [seconds]
+#
+
+import rfc822
+import sys
+import time
+
+import stacklesswsgi
+
+
+def make_request(header_count=30):
+    lines = ["GET /some/path/to/a/resource?with=a&query=string HTTP/1.1",
+             "Host: www.example.com"]
+    for i in range(header_count - 1):
+        lines.append("X-Header-Number-%d: some header value number %d" % (i, i))
+    return "\r\n".join(lines) + "\r\n\r\n"
+
+
+class MemoryChannel(object):
+    """Plays the part of a sock_channel, handing out the given data in
+    chunks of chunk_size, as they would come off the wire."""
+
+    def __init__(self, data, chunk_size=4096):
+        self.chunks = [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
+        self.chunks.reverse()
+
+    def recv_chunk(self):
+        if self.chunks:
+            return self.chunks.pop()
+        return ""
+
+    def recv(self, byte_count):
+        data = self.recv_chunk()
+        if len(data) > byte_count:
+            self.chunks.append(data[byte_count:])
+            data = data[:byte_count]
+        return data
+
+
+class LineReadingRFile(object):
+    """The line at a time reader which stacklesswsgi used before requests
+    were read with sock_channel_rfile.read_head, kept as the baseline."""
+
+    def __init__(self, sock_chan):
+        self.sock_chan = sock_chan
+        self.buffer = ""
+
+    def read(self, size):
+        data = self.sock_chan.recv(size)
+        retval = self.buffer + data
+        self.buffer = ""
+        return retval
+
+    def readline(self):
+        idx = self.buffer.find("\n")
+        if idx > -1:
+            line = self.buffer[:idx+1]
+            self.buffer = self.buffer[idx+1:]
+            return line
+        while "\n" not in self.buffer:
+            chunk = self.read(512)
+            if chunk == "":
+                break
+            self.buffer += chunk
+        idx = self.buffer.find("\n")
+        if idx > -1:
+            line = self.buffer[:idx+1]
+            self.buffer = self.buffer[idx+1:]
+            return line
+        line = self.buffer
+        self.buffer = ""
+        return line
+
+
+def read_lines(rfile):
+    """Read a request head line by line, like parse_request used to."""
+    lines = []
+    line = rfile.readline()
+    while line and line != "\r\n":
+        lines.append(line)
+        line = rfile.readline()
+    return lines
+
+
+def parse(request, environ, header_count):
+    rfile = stacklesswsgi.sock_channel_rfile(MemoryChannel(request))
+    environ = dict(environ, **{"wsgi.input": rfile})
+    req = stacklesswsgi.HTTPRequest(None, environ, None)
+    req.parse_request()
+    assert len(req.environ) > header_count
+
+
+def run(name, func, seconds, unit="requests/s"):
+    count = 0
+    start = time.time()
+    end = start + seconds
+    while True:
+        for i in xrange(100):
+            func()
+        count += 100
+        now = time.time()
+        if now >= end:
+            break
+    rate = count / (now - start)
+    print "%-40s %10.0f %s %8.2f us each" % (name, rate, unit, 1e6 / rate)
+
+
+def bench_parser(seconds, header_count=30):
+    request = make_request(header_count)
+    environ = {"ACTUAL_SERVER_PROTOCOL": "HTTP/1.1"}
+    print "Parsing a request with %d headers (%d bytes):" % (header_count, len(request))
+    run("readline() until blank line (old)",
+        lambda: read_lines(LineReadingRFile(MemoryChannel(request))), seconds)
+    run("sock_channel_rfile.read_head()",
+        lambda: stacklesswsgi.sock_channel_rfile(MemoryChannel(request)).read_head(),
+        seconds)
+    run("HTTPRequest.parse_request()",
+        lambda: parse(request, environ, header_count), seconds)
+
+
+def format_headers(environ, headers):
+    req = stacklesswsgi.HTTPRequest(None, environ, None)
+    req.response_protocol = "HTTP/1.1"
+    req.start_response("200 OK", headers)
+    return req.format_headers()
+
+
+def bench_headers(seconds):
+    environ = {"wsgi.input": None,
+               "ACTUAL_SERVER_PROTOCOL": "HTTP/1.1",
+               "SERVER_SOFTWARE": "stacklesswsgi WSGI Server"}
+    common = [("Content-Type", "text/html"), ("Content-Length", "1234")]
+    other = common + [("Cache-Control", "no-cache")]
+    # Have the Date header cached, as it is when the server runs.
+    stacklesswsgi.update_date_line()
+    print "Formatting response headers:"
+    run("rfc822.formatdate() alone", rfc822.formatdate, seconds, "calls/s")
+    run("Content-Type and Content-Length", lambda: format_headers(environ, common),
+        seconds, "responses/s")
+    run("three headers (general path)", lambda: format_headers(environ, other),
+        seconds, "responses/s")
+
+
+if __name__ == "__main__":
+    seconds = 2.0
+    if len(sys.argv) > 1:
+        seconds = float(sys.argv[1])
+    bench_parser(seconds)
+    print
+    bench_headers(seconds)
@@ -18,15 +18,30 @@
 #   http://www.tismer.com/mailman/listinfo/stackless
 #
 
+import base64
+import heapq
+import os
 import re
 import rfc822
+import stat
 import sys
+import time
 import traceback
 from urllib import unquote
 from urlparse import urlparse
 import asyncore
+import select
 import socket
+from collections import deque
 import stackless
+from stacklesslib import main
+
+# sendfile() comes from the pysendfile package on Python 2, and is in the
+# os module from Python 3.3.
+try:
+    from sendfile import sendfile
+except ImportError:
+    sendfile = getattr(os, "sendfile", None)
 
 
 class Server(object):
@@ -39,6 +54,15 @@ class Server(object):
     This will start a server listening on 127.0.0.1 port 8080.
     It will also start the stackless scheduler and begin serving
     requests.
+    
+    The number of connections and how long they may sit idle are limited
+    by the attributes below. Set any of them to None to lift the limit.
+    - max_connections: while this many connections are open, no more are
+      accepted. New ones wait in the listen queue of request_queue_size.
+    - keepalive_timeout: seconds a connection may wait for its next request.
+    - header_timeout: seconds a client has to send a whole request head,
+      so slow clients can't hold on to connections.
+    stats() returns counters for the connections.
     """
     
     protocol = "HTTP/1.1"
@@ -46,6 +70,11 @@ class Server(object):
     ready = False
     environ = {}
     
+    max_connections = 1000
+    request_queue_size = 128
+    keepalive_timeout = 15.0
+    header_timeout = 10.0
+    
     def __init__(self, bind_addr, wsgi_app, server_name=None):
         """Instantiate a WSGI server.
         - bind_addr is a (hostname,port) tuple
@@ -61,6 +90,13 @@ class Server(object):
         self.connection_class = HTTPConnection
         self.tasklet_class = stackless.tasklet
         
+        self.reaper = connection_reaper(self.keepalive_timeout, self.header_timeout)
+        # The accept loop waits on this while max_connections are open.
+        self.room_channel = stackless.channel()
+        self.room_channel.preference = 1
+        # How many times the accept loop waited for room.
+        self.held_back = 0
+        
         self.running = False
     
     def start(self, start_stackless=True):
@@ -70,8 +106,10 @@ class Server(object):
         call stackless.schedule by some other means. Otherwise the server will
         not function since all work is deferred to a tasklet.
         """
-        self.sock_server = sock_server(self.bind_addr)
+        self.sock_server = sock_server(self.bind_addr, self.request_queue_size)
         self.running = True
+        self.reaper.start()
+        start_date_line()
         
         self.tasklet_class(self._accept_loop)()
         
@@ -81,16 +119,47 @@ class Server(object):
     def stop(self):
         """Call this to make the server stop serving requests. If it is serving
         a request at the time stop() is called, it will finish that and then stop."""
+        if not self.running:
+            return
         self.running = False
+        self.reaper.stop()
+        stop_date_line()
+        # Let the accept loop see it, whether it is waiting for room or for
+        # a connection.
+        self.sock_server.close()
+        if self.room_channel.balance < 0:
+            self.room_channel.send(None)
+    
+    def stats(self):
+        """Return a dict of connection counters:
+        - active: connections currently open
+        - idle: open connections waiting for their next request
+        - header_timeouts: connections closed for not sending a request head in time
+        - idle_closed: connections closed for being idle too long
+        - held_back: times accepting stopped because max_connections were
+          open, leaving new connections in the listen queue
+        """
+        stats = self.reaper.stats()
+        stats["held_back"] = self.held_back
+        return stats
     
     def _accept_loop(self):
         """The main loop of the server, run in a seperate tasklet by start()."""
         while self.running:
+            if (self.max_connections is not None and
+                    len(self.reaper.connections) >= self.max_connections):
+                # Stop accepting until a connection closes. Clients wait in
+                # the listen queue meanwhile.
+                self.held_back += 1
+                self.room_channel.receive()
+                continue
+            
             # This line will suspend the server tasklet until there is a connection
             s, addr = self.sock_server.accept()
             
-            # See if we have already been asked to stop
-            if not self.running:
+            # See if we have already been asked to stop, or the listening
+            # socket was closed under us.
+            if not self.running or s is None:
                 return
             
             # Initialize the WSGI environment
@@ -105,24 +174,132 @@ class Server(object):
             # self.connection_class is a reference to a class that will
             # take care of reading and parsing requests out of the connection
             conn = self.connection_class(s, self.wsgi_app, environ)
+            conn.reaper = self.reaper
+            self.reaper.add(conn)
             
             # We create a new tasklet for each connection. This is similar
-            # to how threaded web servers work, except they usually keep a thread
-            # pool with an upper limit on number of threads. We just create new tasklets
-            # blindly without regard for how many requests the server is serving
-            # already. This is possible because of the light-weight nature of
-            # tasklets compared to threads.
+            # to how threaded web servers work, which keep a thread pool with
+            # an upper limit on number of threads. Our limit is on the number
+            # of connections, max_connections, and can be much higher than
+            # a thread pool's because of the light-weight nature of tasklets
+            # compared to threads.
             def comm(connection):
                 try:
                     connection.communicate()
                 finally:
                     connection.close()
+                    self.reaper.remove(connection)
+                    if self.room_channel.balance < 0:
+                        self.room_channel.send(None)
             self.tasklet_class(comm)(conn)
 
 
+class connection_reaper(object):
+    """Keeps track of the connections of a Server, and closes those which
+    sit idle between requests for longer than keepalive_timeout, or take
+    longer than header_timeout to send a request head.
+    
+    The deadlines of all connections are kept in one heap, which is checked
+    from a single timer on the stacklesslib event queue. An entry is not
+    removed when its connection moves on to another state. Instead, stale
+    entries are skipped when they come up, and the heap is rebuilt if too
+    many of them pile up."""
+    
+    # How often to look for connections which are past their deadline
+    interval = 0.5
+    
+    def __init__(self, keepalive_timeout, header_timeout):
+        self.keepalive_timeout = keepalive_timeout
+        self.header_timeout = header_timeout
+        self.connections = set()
+        self.deadlines = []
+        self.sequence = 0
+        self.running = False
+        
+        self.idle = 0
+        self.header_timeouts = 0
+        self.idle_closed = 0
+    
+    def start(self):
+        if not self.running:
+            self.running = True
+            main.event_queue.push_after(self.check, self.interval)
+    
+    def stop(self):
+        if self.running:
+            self.running = False
+            try:
+                main.event_queue.cancel(self.check)
+            except ValueError:
+                pass
+    
+    def stats(self):
+        return {"active": len(self.connections),
+                "idle": self.idle,
+                "header_timeouts": self.header_timeouts,
+                "idle_closed": self.idle_closed}
+    
+    def add(self, conn):
+        """Start tracking a newly accepted connection, which is expected to
+        send a request head in time."""
+        self.connections.add(conn)
+        self.set_state(conn, "head")
+    
+    def remove(self, conn):
+        if conn in self.connections:
+            self.set_state(conn, None)
+            self.connections.remove(conn)
+    
+    def set_state(self, conn, state):
+        """Record that conn is now "idle" (waiting for the next request),
+        reading a request "head", "busy" serving a request, or None when
+        it has been closed. Only the first two have a deadline."""
+        if conn.state == "idle":
+            self.idle -= 1
+        conn.state = state
+        if state == "idle":
+            self.idle += 1
+            timeout = self.keepalive_timeout
+        elif state == "head":
+            timeout = self.header_timeout
+        else:
+            timeout = None
+        
+        if timeout is None:
+            conn.deadline = None
+            return
+        conn.deadline = deadline = time.time() + timeout
+        self.sequence += 1
+        heapq.heappush(self.deadlines, (deadline, self.sequence, conn))
+        if len(self.deadlines) > 2 * len(self.connections) + 1000:
+            self.deadlines = [entry for entry in self.deadlines
+                              if entry[2].deadline == entry[0]]
+            heapq.heapify(self.deadlines)
+    
+    def check(self):
+        """Close the connections whose deadlines have passed. This is run
+        by the event queue every interval seconds."""
+        now = time.time()
+        heap = self.deadlines
+        while heap and heap[0][0] <= now:
+            deadline, sequence, conn = heapq.heappop(heap)
+            if conn.deadline != deadline:
+                # The connection has moved on since this entry was made.
+                continue
+            if conn.state == "idle":
+                self.idle_closed += 1
+            else:
+                self.header_timeouts += 1
+            self.set_state(conn, None)
+            conn.timeout()
+        if self.running:
+            main.event_queue.push_after(self.check, self.interval)
+
+
 # This method is intended to be started in a seperate tasklet.
 # It will repeatedly call asyncore.poll() to dispatch asyncore events
-# to the relevant listeners.
+# to the relevant listeners. Where the platform has poll(), asyncore.poll2()
+# is used instead, since select() can't handle more than FD_SETSIZE sockets.
 # This is started by sock_server, which is in turn started by the server above.
 # It is the responsibility of the caller not to invoke this if it's already
 # running. Callers can check the asyncore_loop.running attribute to see
@@ -131,28 +308,94 @@ def asyncore_loop():
     # Make sure only one invocation is active at any time
     assert asyncore_loop.running == False
     asyncore_loop.running = True
+    waker = loop_waker.install()
+    # The waker doesn't count as a reason to keep running.
+    own_dispatchers = waker is not None and 1 or 0
     try:
-        while len(asyncore.socket_map):
-            asyncore.poll(0.05)
+        while len(asyncore.socket_map) > own_dispatchers:
+            # Only block waiting for events when no other tasklet can run.
+            if stackless.runcount > 1:
+                asyncore_poll(0)
+            else:
+                asyncore_poll(0.05)
+            # Run any timers that are due, such as update_date_line.
+            main.event_queue.pump()
             stackless.schedule()
     finally:
         asyncore_loop.running = False
+        if waker is not None:
+            waker.close()
 asyncore_loop.running = False
 
+if hasattr(select, "poll"):
+    asyncore_poll = asyncore.poll2
+else:
+    asyncore_poll = asyncore.poll
+
+
+class loop_waker(getattr(asyncore, "file_dispatcher", object)):
+    """Wakes asyncore_loop from its wait when another thread has made a
+    tasklet runnable. stacklesslib.util.call_on_thread calls
+    main.mainloop.interrupt_wait() when its job is done, so while the loop
+    runs, that writes to a pipe which the loop polls. Only available where
+    asyncore can poll pipes."""
+    
+    def __init__(self):
+        pipe_r, self.pipe_w = os.pipe()
+        asyncore.file_dispatcher.__init__(self, pipe_r)
+        os.close(pipe_r)   # file_dispatcher keeps a dup of it
+        self.woken = False
+        self.saved_interrupt_wait = main.mainloop.__dict__.get("interrupt_wait")
+        main.mainloop.interrupt_wait = self.wake
+    
+    @classmethod
+    def install(cls):
+        if hasattr(asyncore, "file_dispatcher"):
+            return cls()
+        return None
+    
+    def wake(self):
+        # Called from other threads. One byte in the pipe is enough.
+        if not self.woken:
+            self.woken = True
+            try:
+                os.write(self.pipe_w, "x")
+            except OSError:
+                pass
+    
+    def writable(self):
+        return False
+    
+    def handle_read(self):
+        # Clear the flag first, so a wake() from now on writes again.
+        self.woken = False
+        try:
+            self.recv(4096)
+        except (OSError, socket.error):
+            pass
+    
+    def close(self):
+        if self.saved_interrupt_wait is None:
+            del main.mainloop.interrupt_wait
+        else:
+            main.mainloop.interrupt_wait = self.saved_interrupt_wait
+        asyncore.file_dispatcher.close(self)
+        os.close(self.pipe_w)
+
 
 class sock_server(asyncore.dispatcher):
     """This is an asyncore.dispatcher that listens on a TCP port. For each
     incoming connection, a sock_channel dispatcher is created and given
     responsibility over the socket"""
     
-    def __init__(self, addr):
+    def __init__(self, addr, backlog=5):
         """Bind to addr and start listening"""
         asyncore.dispatcher.__init__(self)
         self.accept_channel = None
         self.addr = addr
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.bind(addr)
-        self.listen(5)
+        self.listen(backlog)
         
         # Start the asyncore polling loop if it's not already running
         if not asyncore_loop.running:
@@ -161,10 +404,24 @@ class sock_server(asyncore.dispatcher):
     def accept(self):
         # This will suspend the current tasklet (by reading from
         # self.accept_channel). See handle_accept for details on
-        # when the tasklet is resumed.
+        # when the tasklet is resumed. Once closed, (None, None) is
+        # returned.
+        if not self.accepting:
+            return None, None
         if self.accept_channel is None:
             self.accept_channel = stackless.channel()
         return self.accept_channel.receive()
+    
+    def close(self):
+        asyncore.dispatcher.close(self)
+        # Wake whoever is waiting in accept()
+        while self.accept_channel is not None and self.accept_channel.balance < 0:
+            self.accept_channel.send((None, None))
+
+    def readable(self):
+        # Only poll for connections while someone is waiting to accept them,
+        # so that they are left in the listen queue when the server is busy.
+        return self.accept_channel is not None and self.accept_channel.balance < 0
 
     def handle_accept(self):
         # This is called by asyncore to signal that a socket is ready for
@@ -173,7 +430,11 @@ class sock_server(asyncore.dispatcher):
         # and write the results on the channel and the tasklet that called
         # accept() is resumed.
         if self.accept_channel and self.accept_channel.balance < 0:
-            s, a = asyncore.dispatcher.accept(self)
+            pair = asyncore.dispatcher.accept(self)
+            if pair is None:
+                # Another process got there first
+                return
+            s, a = pair
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             s = sock_channel(s)
             self.accept_channel.send((s,a))
@@ -183,37 +444,100 @@ class sock_channel(asyncore.dispatcher):
     """This is an asyncore dispatcher in charge of handling connections
     to http clients."""
     
+    # How much to ask the kernel for on each read event, and how much received
+    # data may pile up unread before we stop asking for read events.
+    recv_size = 65536
+    max_recv_buffer = 262144
+    # The most we hand to the kernel on each write event, so that one large
+    # response can't keep the asyncore loop from serving other connections.
+    max_send_size = 1048576
+    # Queued buffers smaller than this are joined together before sending,
+    # so that many small responses go out in one system call, like writev.
+    coalesce_size = 65536
+    
     def __init__(self, sock):
         """Initialize and start handling the connection on sock. Usually called
         by sock_server"""
         if sock.type == socket.SOCK_DGRAM:
             raise NotImplementedError("sock_channel can only handle TCP sockets")
         asyncore.dispatcher.__init__(self, sock)
-        self.send_buffer = ""
-        self.recv_buffer = ""
+        # Outgoing data is queued as memoryviews, so partial sends only
+        # advance a view instead of copying what is left.
+        self.send_buffer = deque()
+        self.send_buffered = 0
         self.sendall_channel = None
+        # While corked, queued data is held back until flush() is called or
+        # the connection runs out of input. See HTTPConnection._sendall.
+        self.corked = False
+        
+        # Received data is kept as the chunks that came off the wire, so that
+        # nothing is copied until a reader asks for it.
+        self.recv_chunks = deque()
+        self.recv_buffered = 0
+        self.recv_error = None
+        self.recv_closed = False
+        # Readers block on this channel until handle_read or close signals
+        # them. The preference makes sure signalling never blocks the
+        # asyncore loop.
         self.recv_channel = stackless.channel()
+        self.recv_channel.preference = 1
+    
+    def readable(self):
+        # Stop reading from a client that sends faster than it is served.
+        return self.recv_buffered < self.max_recv_buffer
     
     def writable(self):
         if not self.connected:
             return True
         # If we have buffered data to send, we're intersted in write events
-        return len(self.send_buffer)
+        return len(self.send_buffer) and not self.corked
     
-    def send(self, data):
+    def _queue_send(self, data):
         if self.send_buffer is None:
             raise socket.error(socket.EBADF, "Connection closed")
-        self.send_buffer += data
+        if data:
+            self.send_buffer.append(memoryview(data))
+            self.send_buffered += len(data)
+    
+    def queue(self, data, *more):
+        """Queue data, followed by any further buffers given, for sending
+        without waiting for it to be sent."""
+        self._queue_send(data)
+        for extra in more:
+            self._queue_send(extra)
+    
+    def send(self, data):
+        self._queue_send(data)
         # Request a schedule so that asyncore get's a chance to invoke the
         # handle_write event. There is no guarantee that the data will have
         # been sent completely when we return to here again.
         stackless.schedule()
         return len(data)
 
-    def sendall(self, data):
-        if self.send_buffer is None:
-            raise socket.error(socket.EBADF, "Connection closed")
-        self.send_buffer += data
+    def sendall(self, data, *more):
+        """Send data, followed by any further buffers given, and return once
+        all of it has been written to the socket."""
+        self.queue(data, *more)
+        self.flush()
+        # Here we are guaranteed that all of data has been sent
+        return len(data) + sum(len(extra) for extra in more)
+    
+    def sendfile(self, fileobj, offset, count, header=""):
+        """Send header, then count bytes of fileobj starting at offset, and
+        return once all of it has been written to the socket. Only the
+        calling tasklet waits while the file goes out. See file_range."""
+        self._queue_send(header)
+        if count > 0:
+            self.send_buffer.append(file_range(fileobj, offset, count))
+            self.send_buffered += count
+        self.flush()
+        return len(header) + count
+    
+    def flush(self):
+        """Return once everything queued has been written to the socket."""
+        self.corked = False
+        if not self.send_buffer:
+            return
         # Instead of asking for a schedule like send() does, we suspend
         # the current tasklet by reading from self.sendall_channel. Only
         # when the send_buffer has been completely sent on the wire, this
@@ -221,64 +545,134 @@ class sock_channel(asyncore.dispatcher):
         if self.sendall_channel is None:
             self.sendall_channel = stackless.channel()
         self.sendall_channel.receive()
-        # Here we are guaranteed that all of data has been sent
-        return len(data)
     
     def handle_write(self):
         # This is called by asyncore when it is ready to send out data.
-        # First see if we have some data to send...
-        if len(self.send_buffer):
-            sent = asyncore.dispatcher.send(self, self.send_buffer[:512])
-            self.send_buffer = self.send_buffer[sent:]
+        # Send as much as the kernel will take, up to max_send_size.
+        buf = self.send_buffer
+        budget = self.max_send_size
+        while buf and budget > 0:
+            view = buf[0]
+            if isinstance(view, file_range):
+                try:
+                    sent = view.send(self, budget)
+                except (EnvironmentError, EOFError):
+                    # The file or the connection failed part way through, so
+                    # there is no way to finish the response.
+                    self.close()
+                    return
+                budget -= sent
+                self.send_buffered -= sent
+                if view.count:
+                    break
+                buf.popleft()
+                continue
+            if (len(view) < self.coalesce_size and len(buf) > 1 and
+                    not isinstance(buf[1], file_range)):
+                view = buf[0] = self._coalesce()
+            if len(view) > budget:
+                view = view[:budget]
+            sent = asyncore.dispatcher.send(self, view)
+            budget -= sent
+            self.send_buffered -= sent
+            if sent == len(buf[0]):
+                buf.popleft()
+            else:
+                buf[0] = buf[0][sent:]
+                if sent < len(view):
+                    # The kernel buffer is full, wait for the next event.
+                    break
 
-            # If we completed sending everything in self.send_buffer and a call to
-            # sendall is waiting in another tasklet, let it know so it can resume.
-            if len(self.send_buffer) == 0 and self.sendall_channel and self.sendall_channel.balance < 0:
-                self.sendall_channel.send(None)
+        # If we completed sending everything in self.send_buffer and a call to
+        # sendall is waiting in another tasklet, let it know so it can resume.
+        if not buf and self.sendall_channel and self.sendall_channel.balance < 0:
+            self.sendall_channel.send(None)
+
+    def _coalesce(self):
+        """Join the small buffers at the front of the send queue into one,
+        and return it in place of them."""
+        buf = self.send_buffer
+        joined = bytearray()
+        while (buf and not isinstance(buf[0], file_range) and
+               len(joined) + len(buf[0]) <= self.coalesce_size):
+            joined += buf.popleft()
+        view = memoryview(joined)
+        buf.appendleft(view)
+        return view
 
+    def recv_chunk(self):
+        """Return the next block of received data, as it came off the wire.
+        A call to this method will suspend the current tasklet until there is
+        data available to be received. See handle_read on how that happens.
+        Returns "" once the connection has been closed."""
+        while not self.recv_chunks:
+            if self.recv_error is not None:
+                raise self.recv_error
+            if self.recv_closed:
+                return ""
+            # We have run out of input, so let out anything held back.
+            self.corked = False
+            self.recv_channel.receive()
+        data = self.recv_chunks.popleft()
+        self.recv_buffered -= len(data)
+        return data
+    
     def recv(self, byte_count):
-        # A call to this method will suspend the current tasklet until there is
-        # data available to be received. See handle_read on how that happens.
-        if byte_count > 0 and len(self.recv_buffer) == 0 or self.recv_channel.balance > 0:
-            self.recv_buffer += self.recv_channel.receive()
-        
-        # Give the caller only as much as he asked for
-        ret = self.recv_buffer[:byte_count]
-        
-        # and stash the rest in self.recv_buffer
-        self.recv_buffer = self.recv_buffer[byte_count:]
-        
-        return ret
+        data = self.recv_chunk()
+        if len(data) > byte_count:
+            # Give the caller only as much as he asked for and put the rest
+            # back for the next call.
+            rest = data[byte_count:]
+            self.recv_chunks.appendleft(rest)
+            self.recv_buffered += len(rest)
+            data = data[:byte_count]
+        return data
     
     def handle_read(self):
         # This is called by asyncore to let us know that there is data available
         # to be received.
         try:
-            ret = asyncore.dispatcher.recv(self, 20000)
-            if not ret:
-                # This means the other end closed the connection, close our end.
-                self.close()
-            # Send the data to whoever is or will be calling recv()
-            self.recv_channel.send(ret)
+            ret = asyncore.dispatcher.recv(self, self.recv_size)
         except socket.error, err:
             if self.send_buffer:
-                self.send_buffer = ""
+                self.send_buffer.clear()
+                self.send_buffered = 0
             # Any errors on the socket is propogated to the callers of recv()
-            self.recv_channel.send_exception(stdsocket.error, err)
+            self.recv_error = err
+            ret = ""
+        if ret:
+            self.recv_chunks.append(ret)
+            self.recv_buffered += len(ret)
+        else:
+            # This means the other end closed the connection, close our end.
+            self.recv_closed = True
+        # Wake whoever is calling recv()
+        while self.recv_channel.balance < 0:
+            self.recv_channel.send(None)
+        if self.recv_closed and self.connected:
+            self.close()
 
     def close(self):
         asyncore.dispatcher.close(self)
         self.connected = False
         self.accepting = False
         self.send_buffer = None
+        self.send_buffered = 0
         
         # Wake any tasklets that are waiting for sendall() to return
         if self.sendall_channel and self.sendall_channel.balance < 0:
             self.sendall_channel.send(None)
         
         # Wake any tasklets that are waiting for recv to return
-        while self.recv_channel and self.recv_channel.balance < 0:
-            self.recv_channel.send("")
+        self.recv_closed = True
+        while self.recv_channel.balance < 0:
+            self.recv_channel.send(None)
+    
+    def timeout(self):
+        """Close the connection, and have recv() raise socket.timeout in any
+        tasklet reading from it."""
+        self.recv_error = socket.timeout("timed out")
+        self.close()
     
     def handle_close(self):
         pass
@@ -287,55 +681,189 @@ class sock_channel(asyncore.dispatcher):
         self.close()
 
 
+class file_range(object):
+    """Part of a file queued for sending on a sock_channel. The data goes
+    straight from the file to the socket with sendfile() if we have it.
+    Otherwise it is read one block at a time, so that memory use stays the
+    same however large the file is."""
+    
+    block_size = 65536
+    
+    def __init__(self, fileobj, offset, count):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.count = count
+        # Data read from the file but not yet sent, when not using sendfile()
+        self.pending = None
+    
+    def __len__(self):
+        return self.count
+    
+    def send(self, dispatcher, limit):
+        """Send up to limit bytes on the socket of dispatcher and return how
+        many were sent. Stops early if the kernel won't take any more."""
+        total = 0
+        while self.count and total < limit:
+            want = min(self.count, limit - total)
+            if sendfile is not None:
+                try:
+                    sent = sendfile(dispatcher.socket.fileno(),
+                                    self.fileobj.fileno(), self.offset, want)
+                except OSError, err:
+                    if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    break
+                if not sent:
+                    raise EOFError("File ended before all of it was sent")
+            else:
+                if not self.pending:
+                    self.fileobj.seek(self.offset)
+                    data = self.fileobj.read(min(self.count, self.block_size))
+                    if not data:
+                        raise EOFError("File ended before all of it was sent")
+                    self.pending = memoryview(data)
+                sent = asyncore.dispatcher.send(dispatcher, self.pending[:want])
+                self.pending = self.pending[sent:]
+            self.offset += sent
+            self.count -= sent
+            total += sent
+            if sent < want:
+                break
+        return total
+
+
+class FileWrapper(object):
+    """The wsgi.file_wrapper of PEP 333. HTTPRequest sends the file of a
+    FileWrapper response with sendfile() when it can, otherwise the
+    response is iterated over like any other."""
+    
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, "close"):
+            self.close = filelike.close
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+
+def parse_byte_range(header, length):
+    """Parse the value of a Range header for an entity of length bytes.
+    Returns the (start, stop) slice to send, which is empty if the range
+    can't be satisfied, or None if the header should be ignored. Only a
+    single byte range is supported, as with most servers."""
+    units, _, spec = header.partition("=")
+    if units.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first:
+            start = int(first)
+            stop = length
+            if last:
+                stop = int(last) + 1
+                if stop <= start:
+                    return None
+        else:
+            # A suffix range: the last so many bytes
+            start = max(length - int(last), 0)
+            stop = length
+    except ValueError:
+        return None
+    return start, min(stop, length)
+
+
 class sock_channel_rfile(object):
     """This class provides a read-only file-like object on top of sock_channel.
     It is used by the HTTPRequest class to get data from the connection and
-    allow WSGI apps to read the request body."""
+    allow WSGI apps to read the request body.
+    
+    Incoming data is collected in a bytearray which grows by whole received
+    chunks, so a request head is scanned and copied only once no matter how
+    many lines it has."""
+    
+    # The largest request start-line plus headers that we will accept.
+    max_head_size = 65536
     
     def __init__(self, sock_chan):
         self.sock_chan = sock_chan
-        self.buffer = ""
+        self.buffer = bytearray()
+        # If set, read_head calls this once the first bytes of a head are in.
+        self.head_started = None
     
-    def read(self, size=-1):
-        if size == -1:
-            data = self.sock_chan.recv(512)
-            while len(data):
-                self.buffer += data
-                data = self.sock_chan.recv(512)
-            data = self.buffer
-            self.buffer = ""
-            return data
-        else:
-            data = self.sock_chan.recv(size)
-            retval = self.buffer + data
-            self.buffer = ""
-            return retval
-    
-    def readline(self):
-        idx = self.buffer.find("\n")
-        if idx > -1:
-            line = self.buffer[:idx+1]
-            self.buffer = self.buffer[idx+1:]
-            return line
-        
-        while "\n" not in self.buffer:
-            chunk = self.read(512)
-            if chunk == "":
-                break
-            self.buffer += chunk
-        
-        if self.buffer == "":
-            return ""
+    def _fill(self):
+        """Append the next received chunk to the buffer. Returns the number
+        of bytes added, 0 meaning the connection was closed."""
+        data = self.sock_chan.recv_chunk()
+        self.buffer += data
+        return len(data)
+    
+    def _take(self, count):
+        data = str(self.buffer[:count])
+        del self.buffer[:count]
+        return data
+    
+    def read_head(self):
+        """Read the request start-line and headers, including the blank line
+        which ends them. Returns "" if the connection closed before anything
+        arrived. Raises ValueError if it closed part way through the head, or
+        if the head is larger than max_head_size."""
+        buf = self.buffer
+        while len(buf) < 2 and self._fill():
+            pass
+        if buf and self.head_started is not None:
+            self.head_started()
+        if buf[:2] == "\r\n":
+            # RFC 2616 sec 4.1: "...if the server is reading the protocol
+            # stream at the beginning of a message and receives a CRLF
+            # first, it should ignore the CRLF."
+            # But only ignore one leading line! else we enable a DoS.
+            del buf[:2]
         
-        idx = self.buffer.find("\n")
-        if idx > -1:
-            line = self.buffer[:idx+1]
-            self.buffer = self.buffer[idx+1:]
-            return line
-        else:
-            line = self.buffer
-            self.buffer = ""
-            return line
+        start = 0
+        while True:
+            idx = buf.find("\r\n\r\n", start)
+            if idx > -1:
+                return self._take(idx + 4)
+            if len(buf) > self.max_head_size:
+                raise ValueError("Request headers too large.")
+            # Only rescan the tail that could hold a split terminator.
+            start = max(len(buf) - 3, 0)
+            if not self._fill():
+                if buf:
+                    raise ValueError("Illegal end of headers.")
+                return ""
+    
+    def read(self, size=-1):
+        buf = self.buffer
+        if size < 0:
+            while self._fill():
+                pass
+            size = len(buf)
+        elif not buf:
+            self._fill()
+        return self._take(size)
+    
+    def readline(self, size=-1):
+        buf = self.buffer
+        start = 0
+        while True:
+            idx = buf.find("\n", start)
+            if idx > -1:
+                return self._take(idx + 1)
+            if size >= 0 and len(buf) >= size:
+                return self._take(size)
+            start = len(buf)
+            if not self._fill():
+                return self._take(len(buf))
     
     def readlines(self, hint=None):
         lines = []
@@ -357,7 +885,159 @@ class sock_channel_rfile(object):
     
     def close(self):
         self.sock_chan = None
-        self.buffer = ""
+        self.buffer = bytearray()
+
+
+class body_reader(object):
+    """The wsgi.input of a request. The body is read from the connection
+    only as the app asks for it, undoing the chunked transfer-coding and
+    stopping at the end of the Content-Length, so memory use doesn't grow
+    with the size of the body. A client which sends faster than the app
+    reads is held back by sock_channel, which stops reading from it once
+    max_recv_buffer bytes are waiting."""
+    
+    # The longest chunk-size line we accept
+    max_line = 1024
+    
+    def __init__(self, rfile, content_length=None, trailers=None):
+        """Read a body of content_length bytes from rfile, or a chunked one
+        if content_length is None. Then trailers, if given, is called to
+        read the trailer headers at the end of a chunked body."""
+        self.rfile = rfile
+        self.chunked = content_length is None
+        self.trailers = trailers
+        # What is left to read of the body, or of the current chunk.
+        self.remaining = content_length or 0
+        self.chunks = 0
+        self.done = not self.chunked and not self.remaining
+    
+    def _available(self):
+        """Wait for some of the body to be in the rfile buffer and return
+        how much of what is there belongs to it. 0 means the body ended."""
+        buf = self.rfile.buffer
+        while not self.done:
+            if self.remaining:
+                if not buf and not self.rfile._fill():
+                    raise IOError("Connection closed before the end of the request body")
+                return min(self.remaining, len(buf))
+            if self.chunked:
+                self._next_chunk()
+            else:
+                self.done = True
+        return 0
+    
+    def _next_chunk(self):
+        rfile = self.rfile
+        if self.chunks:
+            line = rfile.readline(self.max_line)
+            if line != "\r\n":
+                raise ValueError("Bad chunked transfer coding "
+                                 "(expected '\\r\\n', got %r)" % line)
+        line = rfile.readline(self.max_line)
+        try:
+            if not line.endswith("\n"):
+                raise ValueError
+            size = int(line.split(";", 1)[0].strip(), 16)
+            if size < 0:
+                raise ValueError
+        except ValueError:
+            raise ValueError("Bad chunked transfer coding "
+                             "(bad chunk-size line %r)" % line)
+        self.chunks += 1
+        self.remaining = size
+        if not size:
+            # The last chunk, which is followed by any trailers.
+            self.done = True
+            if self.trailers is not None:
+                self.trailers()
+            else:
+                while rfile.readline(self.max_line) not in ("\r\n", ""):
+                    pass
+    
+    def _take(self, count):
+        self.remaining -= count
+        return self.rfile._take(count)
+    
+    def read(self, size=-1):
+        chunks = []
+        while size:
+            count = self._available()
+            if not count:
+                break
+            if size > 0:
+                count = min(count, size)
+                size -= count
+            chunks.append(self._take(count))
+        return "".join(chunks)
+    
+    def readinto(self, b):
+        """Read into the writable buffer b, until it is full or the body
+        ends. Returns the number of bytes read."""
+        view = memoryview(b)
+        total = 0
+        while total < len(view):
+            count = self._available()
+            if not count:
+                break
+            count = min(count, len(view) - total)
+            view[total:total+count] = self.rfile.buffer[:count]
+            del self.rfile.buffer[:count]
+            self.remaining -= count
+            total += count
+        return total
+    
+    def readline(self, size=-1):
+        chunks = []
+        while size:
+            count = self._available()
+            if not count:
+                break
+            if size > 0:
+                count = min(count, size)
+            idx = self.rfile.buffer.find("\n", 0, count)
+            if idx > -1:
+                count = idx + 1
+            chunks.append(self._take(count))
+            if idx > -1:
+                break
+            if size > 0:
+                size -= count
+        return "".join(chunks)
+    
+    def readlines(self, hint=None):
+        lines = []
+        line = self.readline()
+        while line:
+            lines.append(line)
+            line = self.readline()
+        return lines
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        line = self.readline()
+        if line:
+            return line
+        else:
+            raise StopIteration
+    
+    def drain(self, limit):
+        """Skip what the app left unread of the body, as long as that is no
+        more than limit bytes. Returns True if the whole body was consumed,
+        so that the connection can be used for another request."""
+        try:
+            while True:
+                count = self._available()
+                if not count:
+                    return True
+                if count > limit:
+                    return False
+                del self.rfile.buffer[:count]
+                self.remaining -= count
+                limit -= count
+        except (EnvironmentError, ValueError):
+            return False
 
 
 # The rest of this file is taken from CherryPy's excellent WSGI Server by Robert
@@ -378,6 +1058,79 @@ socket_errors_to_ignore = set(_ for _ in ("EPIPE", "ETIMEDOUT", "ECONNREFUSED",
           "WSAENETRESET", "WSAETIMEDOUT") if _ in dir(errno))
 socket_errors_to_ignore.add("timed out")
 
+# Status and header lines which are the same from one response to the next
+# are built once and kept here, keyed by (name, value) for headers and by
+# (protocol, status) for status lines. See header_line and status_line.
+header_lines = {}
+status_lines = {}
+max_header_lines = 1000
+
+# The spellings of the header names that format_headers takes its fast
+# path for.
+content_type_keys = frozenset(["Content-Type", "Content-type", "content-type"])
+content_length_keys = frozenset(["Content-Length", "Content-length", "content-length"])
+
+
+def header_line(name, value):
+    """Return the line for a response header, from header_lines if we have
+    built it before."""
+    try:
+        return header_lines[name, value]
+    except KeyError:
+        line = name + ": " + value + "\r\n"
+        if len(header_lines) < max_header_lines:
+            header_lines[name, value] = line
+        return line
+
+
+def status_line(protocol, status):
+    """Return the Status-Line of a response, from status_lines if we have
+    built it before."""
+    try:
+        return status_lines[protocol, status]
+    except KeyError:
+        line = protocol + " " + status + "\r\n"
+        if len(status_lines) < max_header_lines:
+            status_lines[protocol, status] = line
+        return line
+
+
+# The Date header only changes once a second, so rather than formatting it
+# for every response, update_date_line keeps it up to date from a timer
+# on the stacklesslib event queue. It runs while any Server is started.
+_date_line = None
+_date_line_servers = 0
+
+def update_date_line():
+    global _date_line
+    now = time.time()
+    _date_line = "Date: " + rfc822.formatdate(now) + "\r\n"
+    # Run again as the next second starts.
+    main.event_queue.push_after(update_date_line, 1.0 - now % 1.0)
+
+def start_date_line():
+    global _date_line_servers
+    _date_line_servers += 1
+    if _date_line_servers == 1:
+        update_date_line()
+
+def stop_date_line():
+    global _date_line, _date_line_servers
+    _date_line_servers -= 1
+    if not _date_line_servers:
+        try:
+            main.event_queue.cancel(update_date_line)
+        except ValueError:
+            pass
+        _date_line = None
+
+def date_line():
+    """Return the Date header line for a response sent now."""
+    if _date_line is None:
+        return "Date: " + rfc822.formatdate() + "\r\n"
+    return _date_line
+
+
 comma_separated_headers = set(['ACCEPT', 'ACCEPT-CHARSET', 'ACCEPT-ENCODING',
     'ACCEPT-LANGUAGE', 'ACCEPT-RANGES', 'ALLOW', 'CACHE-CONTROL',
     'CONNECTION', 'CONTENT-ENCODING', 'CONTENT-LANGUAGE', 'EXPECT',
@@ -393,6 +1146,8 @@ class HTTPRequest(object):
     
     sendall: the 'sendall' method from the connection's fileobject.
     wsgi_app: the WSGI application to call.
+    sendfile: the 'sendfile' method of the connection, if it has one. It
+        is used to send FileWrapper responses.
     environ: a partial WSGI environ (server and connection entries).
         The caller MUST set the following entries:
         * All wsgi.* entries, including .input
@@ -418,16 +1173,22 @@ class HTTPRequest(object):
         server may each request that the connection be closed.
     chunked_write: if True, output will be encoded with the "chunked"
         transfer-coding. This value is set automatically inside
-        send_headers.
+        format_headers.
+    max_coalesce_size: body chunks up to this size are joined with the
+        headers and chunk framing before sending.
     """
     
-    def __init__(self, sendall, environ, wsgi_app):
+    max_coalesce_size = 65536
+    
+    def __init__(self, sendall, environ, wsgi_app, sendfile=None):
         self.rfile = environ['wsgi.input']
         self.sendall = sendall
+        self.sendfile = sendfile
         self.environ = environ.copy()
         self.wsgi_app = wsgi_app
         
         self.ready = False
+        self.body = None
         self.started_response = False
         self.status = ""
         self.outheaders = []
@@ -444,24 +1205,23 @@ class HTTPRequest(object):
         # and doesn't need the client to request or acknowledge the close
         # (although your TCP stack might suffer for it: cf Apache's history
         # with FIN_WAIT_2).
-        request_line = self.rfile.readline()
-        if not request_line:
+        # The whole head is read in one go and then split into lines, rather
+        # than going back to the connection for every line.
+        try:
+            head = self.rfile.read_head()
+        except ValueError, ex:
+            self.simple_response("400 Bad Request", ex.args[0])
+            self.close_connection = True
+            return
+        if not head:
             # Force self.ready = False so the connection will close.
             self.ready = False
             return
         
-        if request_line == "\r\n":
-            # RFC 2616 sec 4.1: "...if the server is reading the protocol
-            # stream at the beginning of a message and receives a CRLF
-            # first, it should ignore the CRLF."
-            # But only ignore one leading line! else we enable a DoS.
-            request_line = self.rfile.readline()
-            if not request_line:
-                self.ready = False
-                return
-        
         environ = self.environ
         
+        lines = head.split("\r\n")
+        request_line = lines[0]
         method, path, req_protocol = request_line.strip().split(" ", 2)
         environ["REQUEST_METHOD"] = method
         
@@ -522,7 +1282,7 @@ class HTTPRequest(object):
         
         # then all the http headers
         try:
-            self.read_headers()
+            self.read_headers(lines[1:])
         except ValueError, ex:
             self.simple_response("400 Bad Request", repr(ex.args))
             return
@@ -562,9 +1322,20 @@ class HTTPRequest(object):
                     self.close_connection = True
                     return
         
+        # The body is read by the app as it goes, through a body_reader.
         if read_chunked:
-            if not self.decode_chunked():
+            self.body = body_reader(self.rfile, None, self.read_headers)
+        else:
+            try:
+                cl = int(environ.get("CONTENT_LENGTH") or 0)
+                if cl < 0:
+                    raise ValueError
+            except ValueError:
+                self.simple_response("400 Bad Request", "Malformed Content-Length Header.")
+                self.close_connection = True
                 return
+            self.body = body_reader(self.rfile, cl)
+        environ["wsgi.input"] = self.body
         
         # From PEP 333:
         # "Servers and gateways that implement HTTP 1.1 must provide
@@ -588,17 +1359,16 @@ class HTTPRequest(object):
         
         self.ready = True
     
-    def read_headers(self):
-        """Read header lines from the incoming stream."""
+    def read_headers(self, lines=None):
+        """Parse header lines into the environ. lines are the header lines of
+        an already read request head, without line endings. If not given, they
+        are read from the incoming stream instead (for chunked trailers)."""
         environ = self.environ
         
-        while True:
-            line = self.rfile.readline()
+        if lines is None:
+            lines = self._read_header_lines()
+        for line in lines:
             if not line:
-                # No more data--illegal end of headers
-                raise ValueError("Illegal end of headers.")
-            
-            if line == '\r\n':
                 # Normal end of headers
                 break
             
@@ -615,6 +1385,9 @@ class HTTPRequest(object):
                 if existing:
                     v = ", ".join((existing, v))
             environ[envname] = v
+        else:
+            # No more data--illegal end of headers
+            raise ValueError("Illegal end of headers.")
         
         ct = environ.pop("HTTP_CONTENT_TYPE", None)
         if ct:
@@ -623,54 +1396,91 @@ class HTTPRequest(object):
         if cl:
             environ["CONTENT_LENGTH"] = cl
     
-    def decode_chunked(self):
-        """Decode the 'chunked' transfer coding."""
-        cl = 0
-        data = StringIO.StringIO()
+    def _read_header_lines(self):
         while True:
-            line = self.rfile.readline().strip().split(";", 1)
-            chunk_size = int(line.pop(0), 16)
-            if chunk_size <= 0:
-                break
-            cl += chunk_size
-            data.write(self.rfile.read(chunk_size))
-            crlf = self.rfile.read(2)
-            if crlf != "\r\n":
-                self.simple_response("400 Bad Request",
-                                     "Bad chunked transfer coding "
-                                     "(expected '\\r\\n', got %r)" % crlf)
+            line = self.rfile.readline()
+            if not line:
                 return
-        
-        # Grab any trailer headers
-        self.read_headers()
-        
-        data.seek(0)
-        self.environ["wsgi.input"] = data
-        self.environ["CONTENT_LENGTH"] = str(cl) or ""
-        return True
+            yield line.rstrip("\r\n")
     
     def respond(self):
         """Call the appropriate WSGI app and write its iterable output."""
         response = self.wsgi_app(self.environ, self.start_response)
         try:
-            for chunk in response:
-                # "The start_response callable must not actually transmit
-                # the response headers. Instead, it must store them for the
-                # server or gateway to transmit only after the first
-                # iteration of the application return value that yields
-                # a NON-EMPTY string, or upon the application's first
-                # invocation of the write() callable." (PEP 333)
-                if chunk:
-                    self.write(chunk)
-                stackless.schedule()
+            if not self.send_file_wrapper(response):
+                for chunk in response:
+                    # "The start_response callable must not actually transmit
+                    # the response headers. Instead, it must store them for the
+                    # server or gateway to transmit only after the first
+                    # iteration of the application return value that yields
+                    # a NON-EMPTY string, or upon the application's first
+                    # invocation of the write() callable." (PEP 333)
+                    if chunk:
+                        self.write(chunk)
+                    stackless.schedule()
         finally:
             if hasattr(response, "close"):
                 response.close()
+        buf = []
         if (self.ready and not self.sent_headers):
             self.sent_headers = True
-            self.send_headers()
+            buf.append(self.format_headers())
         if self.chunked_write:
-            self.sendall("0\r\n\r\n")
+            buf.append("0\r\n\r\n")
+        if buf:
+            self.sendall("".join(buf))
+    
+    def send_file_wrapper(self, response):
+        """Send a FileWrapper response straight from its file, honouring a
+        Range request. Returns False if the response can't be sent this way,
+        because it isn't a regular file or the connection can't sendfile."""
+        if (self.sendfile is None or not isinstance(response, FileWrapper)
+                or not self.started_response or self.sent_headers):
+            return False
+        filelike = response.filelike
+        try:
+            fileno = filelike.fileno()
+            st = os.fstat(fileno)
+            offset = filelike.tell()
+        except (AttributeError, EnvironmentError, ValueError):
+            return False
+        if not stat.S_ISREG(st.st_mode):
+            return False
+        
+        length = max(st.st_size - offset, 0)
+        headers = []
+        for k, v in self.outheaders:
+            lk = k.lower()
+            if lk == "content-length":
+                # Respect the app if it only wants part of the file sent.
+                length = min(length, int(v))
+            elif lk != "accept-ranges":
+                headers.append((k, v))
+        headers.append(("Accept-Ranges", "bytes"))
+        
+        start, stop = 0, length
+        byte_range = None
+        if self.status[:3] == "200" and "HTTP_RANGE" in self.environ:
+            byte_range = parse_byte_range(self.environ["HTTP_RANGE"], length)
+        if byte_range is not None:
+            start, stop = byte_range
+            if start < stop:
+                self.status = "206 Partial Content"
+                headers.append(("Content-Range",
+                                "bytes %d-%d/%d" % (start, stop - 1, length)))
+            else:
+                self.status = "416 Requested Range Not Satisfiable"
+                headers.append(("Content-Range", "bytes */%d" % length))
+                start = stop = 0
+        
+        count = stop - start
+        headers.append(("Content-Length", str(count)))
+        if self.environ["REQUEST_METHOD"] == "HEAD":
+            count = 0
+        self.outheaders = headers
+        self.sent_headers = True
+        self.sendfile(filelike, offset + start, count, self.format_headers())
+        return True
     
     def simple_response(self, status, msg=""):
         """Write a simple response back to the client."""
@@ -713,19 +1523,55 @@ class HTTPRequest(object):
         if not self.started_response:
             raise AssertionError("WSGI write called before start_response.")
         
+        # Headers and chunk framing go out together with the chunk, so that
+        # a small response is a single send.
+        prefix = []
         if not self.sent_headers:
             self.sent_headers = True
-            self.send_headers()
+            prefix.append(self.format_headers())
         
         if self.chunked_write and chunk:
-            buf = [hex(len(chunk))[2:], "\r\n", chunk, "\r\n"]
-            self.sendall("".join(buf))
+            prefix += [hex(len(chunk))[2:], "\r\n"]
+            suffix = "\r\n"
         else:
+            suffix = ""
+        
+        if not prefix:
             self.sendall(chunk)
+        elif len(chunk) <= self.max_coalesce_size:
+            prefix += [chunk, suffix]
+            self.sendall("".join(prefix))
+        else:
+            # Not worth copying a large chunk just to save a send.
+            self.sendall("".join(prefix), chunk, suffix)
     
     def send_headers(self):
         """Assert, process, and send the HTTP response message-headers."""
-        hkeys = [key.lower() for key, value in self.outheaders]
+        self.sendall(self.format_headers())
+    
+    def format_headers(self):
+        """Assert and process the HTTP response message-headers and return
+        them as they go on the wire."""
+        outheaders = self.outheaders
+        if (len(outheaders) == 2 and outheaders[0][0] in content_type_keys
+                and outheaders[1][0] in content_length_keys
+                and self.status[:3] != "413"):
+            # Most responses are just a Content-Type and a Content-Length.
+            # Those need none of the checks below.
+            buf = [status_line(self.environ['ACTUAL_SERVER_PROTOCOL'], self.status),
+                   header_line("Content-Type", outheaders[0][1]),
+                   "Content-Length: ", outheaders[1][1], "\r\n"]
+            if self.response_protocol == 'HTTP/1.1':
+                if self.close_connection:
+                    buf.append("Connection: close\r\n")
+            elif not self.close_connection:
+                buf.append("Connection: Keep-Alive\r\n")
+            buf += [date_line(),
+                    header_line("Server", self.environ['SERVER_SOFTWARE']),
+                    "\r\n"]
+            return "".join(buf)
+        
+        hkeys = [key.lower() for key, value in outheaders]
         status = int(self.status[:3])
         
         if status == 413:
@@ -754,13 +1600,7 @@ class HTTPRequest(object):
                 if not self.close_connection:
                     self.outheaders.append(("Connection", "Keep-Alive"))
         
-        if "date" not in hkeys:
-            self.outheaders.append(("Date", rfc822.formatdate()))
-        
-        if "server" not in hkeys:
-            self.outheaders.append(("Server", self.environ['SERVER_SOFTWARE']))
-        
-        buf = [self.environ['ACTUAL_SERVER_PROTOCOL'], " ", self.status, "\r\n"]
+        buf = [status_line(self.environ['ACTUAL_SERVER_PROTOCOL'], self.status)]
         try:
             buf += [k + ": " + v + "\r\n" for k, v in self.outheaders]
         except TypeError:
@@ -770,8 +1610,15 @@ class HTTPRequest(object):
                 raise TypeError("WSGI response header value %r is not a string.")
             else:
                 raise
+        
+        if "date" not in hkeys:
+            buf.append(date_line())
+        
+        if "server" not in hkeys:
+            buf.append(header_line("Server", self.environ['SERVER_SOFTWARE']))
+        
         buf.append("\r\n")
-        self.sendall("".join(buf))
+        return "".join(buf)
 
 
 class HTTPConnection(object):
@@ -782,16 +1629,35 @@ class HTTPConnection(object):
     environ: a WSGI environ template. This will be copied for each request.
     
     rfile: a fileobject for reading from the sock_chan.
-    sendall: a function for writing (+ flush) to the sock_chan.
+    sendall: a function for writing (+ flush) to the sock_chan. Responses to
+        pipelined requests are held back and flushed together, see _sendall.
+    sendfile: a function for sending part of a file on the sock_chan.
     """
     
     RequestHandlerClass = HTTPRequest
+    
+    # If the app leaves no more than this much of a request body unread, it
+    # is skipped so the connection can carry on. Otherwise it is closed.
+    max_discard = 65536
+    # Responses to pipelined requests are held back until this much is
+    # waiting to be sent, or there are no more requests buffered.
+    max_pipeline_batch = 65536
+    
+    # Set by the Server, which keeps the state and deadline up to date
+    # through it. See connection_reaper.
+    reaper = None
+    state = None
+    deadline = None
+    # The body of the request being handled, which does not count as
+    # another pipelined request waiting. See _pipelined.
+    body = None
     environ = {"wsgi.version": (1, 0),
                "wsgi.url_scheme": "http",
                "wsgi.multithread": True,
                "wsgi.multiprocess": False,
                "wsgi.run_once": False,
                "wsgi.errors": sys.stderr,
+               "wsgi.file_wrapper": FileWrapper,
                }
     
     def __init__(self, sock_chan, wsgi_app, environ):
@@ -803,27 +1669,74 @@ class HTTPConnection(object):
         self.environ.update(environ)
         
         self.rfile = sock_channel_rfile(sock_chan)
-        self.sendall = sock_chan.sendall
+        self.sendall = self._sendall
+        self.sendfile = sock_chan.sendfile
         
         self.environ["wsgi.input"] = self.rfile
     
+    def _sendall(self, data, *more):
+        """Write to the sock_chan. If the client has already sent us another
+        request, the data is only queued, so the responses to a run of
+        pipelined requests go out together once the input has been used up.
+        Large responses are still streamed straight out."""
+        sock_chan = self.sock_chan
+        sock_chan.queue(data, *more)
+        if self._pipelined() and sock_chan.send_buffered < self.max_pipeline_batch:
+            sock_chan.corked = True
+        else:
+            sock_chan.flush()
+    
+    def _pipelined(self):
+        """Return True if the client has sent more than what is left of the
+        body of the current request, that is, another request is waiting."""
+        waiting = len(self.rfile.buffer) + self.sock_chan.recv_buffered
+        body = self.body
+        if body is not None and not body.done:
+            if body.chunked:
+                # Where a chunked body ends isn't known until it is read.
+                return False
+            waiting -= body.remaining
+        return waiting > 0
+    
+    def _set_state(self, state):
+        if self.reaper is not None:
+            self.reaper.set_state(self, state)
+    
+    def _head_started(self):
+        if self.state == "idle":
+            self._set_state("head")
+    
+    def timeout(self):
+        """Close a connection which has missed its deadline."""
+        self.sock_chan.timeout()
+    
     def communicate(self):
         """Read each request and respond appropriately."""
+        self.rfile.head_started = self._head_started
         try:
             while True:
                 # (re)set req to None so that if something goes wrong in
                 # the RequestHandlerClass constructor, the error doesn't
                 # get written to the previous request.
                 req = None
+                self.body = None
                 req = self.RequestHandlerClass(self.sendall, self.environ,
-                                               self.wsgi_app)
+                                               self.wsgi_app, self.sendfile)
                 # This order of operations should guarantee correct pipelining.
                 req.parse_request()
                 if not req.ready:
                     return
+                self.body = req.body
+                if self.sock_chan.corked and not self._pipelined():
+                    # This is the last request sent so far. Let out the
+                    # responses held back for the ones before it now, as
+                    # its app may block for a long time.
+                    self.sock_chan.flush()
+                self._set_state("busy")
                 req.respond()
-                if req.close_connection:
+                if req.close_connection or not req.body.drain(self.max_discard):
                     return
+                self._set_state("idle")
         except socket.error, e:
             errno = e.args[0]
             if errno not in socket_errors_to_ignore:
@@ -844,5 +1757,7 @@ class HTTPConnection(object):
     
     def close(self):
         """Close the socket underlying this connection."""
+        # Anything held back for pipelining still has to go out.
+        self.sock_chan.flush()
         self.rfile.close()
-        self.sock_chan.close()
+        self.sock_chan.close()
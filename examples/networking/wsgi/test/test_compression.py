@@ -0,0 +1,89 @@
+import os, sys, unittest, zlib
+
+# Ensure the module to be tested is importable.
+if __name__ == "__main__":
+    currentPath = sys.path[0]
+    parentPath = os.path.dirname(currentPath)
+    if parentPath not in sys.path:
+        sys.path.append(parentPath)
+
+import compression
+
+
+class CompressionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.environ = {
+            "REQUEST_METHOD": "GET",
+            "HTTP_ACCEPT_ENCODING": "gzip",
+        }
+        self.started = []
+        self.server_written = []
+
+    def start_response(self, status, headers, exc_info=None):
+        self.started.append((status, headers))
+        return self.server_written.append
+
+    def Run(self, app, content_type="text/plain"):
+        def wrapped_app(environ, start_response):
+            return app(environ, start_response, content_type)
+        middleware = compression.CompressionMiddleware(wrapped_app, thread_min_size=None, min_size=100)
+        response = middleware(self.environ, self.start_response)
+        body = []
+        for data in response:
+            # The server sends what is written before the next piece.
+            body.extend(self.server_written)
+            del self.server_written[:]
+            body.append(data)
+        body.extend(self.server_written)
+        return "".join(body)
+
+    def WritingApp(self, environ, start_response, content_type):
+        """An app which writes some of its body and returns the rest."""
+        write = start_response("200 OK", [ ("Content-Type", content_type) ])
+        write("a" * 50)
+        def Body():
+            yield "b" * 50
+            write("c" * 50)
+            yield "d" * 50
+            write("e" * 50)
+        return Body()
+
+    def LateWritingApp(self, environ, start_response, content_type):
+        """An app which only writes while its body is iterated over."""
+        write = start_response("200 OK", [ ("Content-Type", content_type) ])
+        def Body():
+            yield "b" * 50
+            write("c" * 50)
+            yield "d" * 50
+            write("e" * 50)
+        return Body()
+
+    def testWritesAreCompressed(self):
+        """The goal of this test is to ensure that data the app passes to
+        write(), before and during the iteration of its body, is compressed
+        with the rest and in the right order."""
+
+        body = self.Run(self.WritingApp)
+        headers = dict(self.started[0][1])
+        self.failUnless(headers.get("Content-Encoding") == "gzip", "The response was not compressed")
+        expected = "a" * 50 + "b" * 50 + "c" * 50 + "d" * 50 + "e" * 50
+        self.failUnless(zlib.decompress(body, 16 + zlib.MAX_WBITS) == expected, "Written data was lost or reordered")
+
+    def testWritesArePassedThrough(self):
+        """The goal of this test is to ensure that data the app passes to
+        write() is not lost when its response is not compressed."""
+
+        body = self.Run(self.WritingApp, "image/png")
+        headers = dict(self.started[0][1])
+        self.failUnless("Content-Encoding" not in headers, "The response was compressed")
+        expected = "a" * 50 + "b" * 50 + "c" * 50 + "d" * 50 + "e" * 50
+        self.failUnless(body == expected, "Written data was lost or reordered, got %r" % body)
+
+        # Passed through before any of the body was seen.
+        del self.started[:]
+        body = self.Run(self.LateWritingApp, "image/png")
+        self.failUnless(body == expected[50:], "Written data was lost or reordered, got %r" % body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+import os, sys, unittest
+from collections import deque
+import stackless
+
+# Ensure the module to be tested is importable.
+if __name__ == "__main__":
+    currentPath = sys.path[0]
+    parentPath = os.path.dirname(currentPath)
+    if parentPath not in sys.path:
+        sys.path.append(parentPath)
+
+import stacklesswsgi
+
+
+class DummySockChannel(object):
+    """Stands in for a sock_channel, handing out the given chunks of input
+    and recording what is sent and when it is flushed."""
+
+    def __init__(self, chunks, events):
+        self.recv_chunks = deque(chunks)
+        self.recv_buffered = sum(len(chunk) for chunk in chunks)
+        self.send_buffered = 0
+        self.corked = False
+        self.events = events
+
+    def recv_chunk(self):
+        if not self.recv_chunks:
+            return ""
+        data = self.recv_chunks.popleft()
+        self.recv_buffered -= len(data)
+        return data
+
+    def queue(self, data, *more):
+        for data in (data,) + more:
+            self.send_buffered += len(data)
+        self.events.append("queue")
+
+    def flush(self):
+        self.corked = False
+        if self.send_buffered:
+            self.send_buffered = 0
+            self.events.append("flush")
+
+    def sendfile(self, fileobj, offset, count, header=""):
+        raise NotImplementedError
+
+
+class ConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.events = []
+
+    def App(self, environ, start_response):
+        self.events.append("app " + environ["PATH_INFO"])
+        start_response("200 OK", [("Content-Type", "text/plain"),
+                                  ("Content-Length", "2")])
+        return ["ok"]
+
+    def Communicate(self, *chunks):
+        sock_chan = DummySockChannel(chunks, self.events)
+        environ = {"SERVER_SOFTWARE": "test", "ACTUAL_SERVER_PROTOCOL": "HTTP/1.1",
+                   "SERVER_NAME": "localhost", "SERVER_PORT": "80",
+                   "REMOTE_ADDR": "127.0.0.1", "REMOTE_PORT": "1234"}
+        conn = stacklesswsgi.HTTPConnection(sock_chan, self.App, environ)
+        conn.communicate()
+        return sock_chan
+
+    def testPipelinedResponsesHeldBack(self):
+        """The goal of this test is to ensure that the responses to
+        pipelined requests are held back while more requests are waiting,
+        and let out before the app of the last one runs."""
+        request = "GET /%s HTTP/1.1\r\nHost: a\r\n\r\n"
+        self.Communicate(request % "a" + request % "b" + request % "c")
+        self.assertEqual(self.events, [
+            "app /a", "queue", "app /b", "queue", "flush",
+            "app /c", "queue", "flush"])
+
+    def testUnreadBodyNotPipelined(self):
+        """The goal of this test is to ensure that the body of a request
+        which the app does not read is not taken for another request."""
+        self.Communicate("POST /a HTTP/1.1\r\nHost: a\r\nContent-Length: 5\r\n\r\nabcde")
+        self.assertEqual(self.events, ["app /a", "queue", "flush"])
+
+
+class RequestHeadTestCase(unittest.TestCase):
+    def Request(self, *chunks):
+        sock_chan = DummySockChannel(chunks, [])
+        environ = {"ACTUAL_SERVER_PROTOCOL": "HTTP/1.1",
+                   "wsgi.input": stacklesswsgi.sock_channel_rfile(sock_chan)}
+        sent = []
+        req = stacklesswsgi.HTTPRequest(sent.append, environ, None)
+        req.parse_request()
+        return req, "".join(sent)
+
+    def testHeadAcrossChunks(self):
+        req, sent = self.Request("GET / HTTP/1.1\r\nHo", "st: a\r\n\r", "\n")
+        self.failUnless(req.ready, "The request was not parsed")
+        self.assertEqual(req.environ["HTTP_HOST"], "a")
+
+    def testClosedBeforeRequest(self):
+        req, sent = self.Request()
+        self.failIf(req.ready or sent, "A request was made up out of nothing")
+
+    def testClosedMidHead(self):
+        """The goal of this test is to ensure that a request whose head was
+        cut short by the client closing the connection is refused."""
+        req, sent = self.Request("GET / HTTP/1.1\r\nHost: a\r\n")
+        self.failIf(req.ready, "A truncated request was dispatched")
+        self.failUnless(sent.startswith("HTTP/1.1 400 "), "Expected a 400 response, got %r" % sent)
+
+
+class ServerTestCase(unittest.TestCase):
+    def testStopWhileAccepting(self):
+        """The goal of this test is to ensure that stopping a server which
+        is waiting for a connection ends its accept loop."""
+        server = stacklesswsgi.Server(("127.0.0.1", 0), None, "localhost")
+        server.tasklet_class = Tasklets(stackless.tasklet)
+        server.start(start_stackless=False)
+        def Stopper():
+            stackless.schedule()
+            server.stop()
+        stackless.tasklet(Stopper)()
+        # Returns once the listening socket and the accept loop are gone.
+        stackless.run()
+        self.failIf(server.tasklet_class.tasklets[0].alive, "The accept loop is still running")
+
+    def testHeldBack(self):
+        """The goal of this test is to ensure that the times the server
+        stops accepting at max_connections are counted."""
+        server = stacklesswsgi.Server(("127.0.0.1", 0), None, "localhost")
+        server.max_connections = 0
+        server.start(start_stackless=False)
+        def Stopper():
+            stackless.schedule()
+            server.stop()
+        stackless.tasklet(Stopper)()
+        stackless.run()
+        self.assertEqual(server.stats()["held_back"], 1)
+
+
+class Tasklets(object):
+    """Makes tasklets like tasklet_class, and keeps them."""
+
+    def __init__(self, tasklet_class):
+        self.tasklet_class = tasklet_class
+        self.tasklets = []
+
+    def __call__(self, func):
+        t = self.tasklet_class(func)
+        self.tasklets.append(t)
+        return t
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+#stacklesslib.broadcast.py
+"""
+This module provides a publish/subscribe primitive for pushing messages to
+many waiting tasklets, such as the long-poll requests of a comet server.
+
+Messages are published to a named Topic, which keeps the most recent ones
+in a ring buffer of fixed size. Each message has a sequence number, and a
+subscriber's position in a topic is a cursor: the sequence number of the
+next message it wants. A long-poll client can carry its cursor between
+requests, so nothing needs to be kept for it on the server while it isn't
+waiting.
+
+All tasklets waiting on a topic block on one channel, which a publish
+empties in a single pass. The sends don't block, so the waiters are just
+made runnable, and they each read what they are missing when they next get
+to run. Publishing therefore costs the same whether there are ten waiters
+or a hundred thousand, apart from the scheduling itself.
+
+A subscriber which falls so far behind that messages it hasn't seen drop
+out of the history is handled according to the topic's lag policy:
+- SKIP: carry on from the oldest message still held.
+- COALESCE: skip to the newest message, for topics where each message
+  supersedes the ones before it.
+- DROP: raise SubscriberLagged, so that the subscriber starts over.
+
+The timeout feature works only if someone is pumping the
+stacklesslib.main.event_queue
+"""
+
+from __future__ import with_statement
+from __future__ import absolute_import
+
+import stackless
+
+from .util import atomic, channel_wait, WaitTimeoutError
+
+SKIP = "skip"
+COALESCE = "coalesce"
+DROP = "drop"
+
+
+class SubscriberLagged(RuntimeError):
+    """Raised by a DROP topic when messages were lost to a subscriber.
+    The missed attribute is how many."""
+    def __init__(self, missed):
+        RuntimeError.__init__(self, "%d messages were dropped" % missed)
+        self.missed = missed
+
+
+class Topic(object):
+    history_size = 1000
+    lag_policy = SKIP
+
+    def __init__(self, name=None, history_size=None, lag_policy=None):
+        self.name = name
+        if history_size is not None:
+            self.history_size = history_size
+        if lag_policy is not None:
+            self.lag_policy = lag_policy
+        if self.lag_policy not in (SKIP, COALESCE, DROP):
+            raise ValueError("unknown lag policy %r" % (self.lag_policy,))
+        if self.history_size < 1:
+            raise ValueError("history_size must be at least 1")
+        self.ring = [None] * self.history_size
+        self.next_id = 0   # The sequence number of the next message
+        self.lagged = 0    # The number of reads which had lost messages
+
+        # The sender never blocks, so publish() only makes the waiters
+        # runnable and carries on.
+        self.chan = stackless.channel()
+        self.chan.preference = 1
+
+    def __repr__(self):
+        return "<Topic %r next_id=%d waiting=%d>" % (self.name, self.next_id, self.waiting)
+
+    @property
+    def waiting(self):
+        """The number of tasklets waiting for messages."""
+        return max(-self.chan.balance, 0)
+
+    @property
+    def first_id(self):
+        """The sequence number of the oldest message held."""
+        return max(self.next_id - self.history_size, 0)
+
+    def cursor(self):
+        """A cursor for messages published from now on."""
+        return self.next_id
+
+    def publish(self, message):
+        """Add a message to the topic and wake up everyone waiting on it.
+        Returns the message's sequence number."""
+        with atomic():
+            msg_id = self.next_id
+            self.ring[msg_id % self.history_size] = message
+            self.next_id = msg_id + 1
+            chan = self.chan
+            for i in xrange(-chan.balance):
+                # guard against waiters which timed out in the meantime
+                if chan.balance < 0:
+                    chan.send(None)
+            return msg_id
+
+    def read(self, cursor=0, limit=None):
+        """Return (messages, cursor) for the messages from cursor on, and the
+        cursor to read from next time. If messages were lost, the new cursor
+        is more than len(messages) past the old one, unless the lag policy
+        is DROP, in which case SubscriberLagged is raised."""
+        next_id = self.next_id
+        if cursor > next_id:
+            # A cursor from before a restart, say. Start afresh.
+            cursor = next_id
+        first_id = next_id - self.history_size
+        if cursor < first_id:
+            self.lagged += 1
+            if self.lag_policy == DROP:
+                raise SubscriberLagged(first_id - cursor)
+            if self.lag_policy == COALESCE:
+                # Only the newest message matters
+                cursor = next_id - 1
+            else:
+                cursor = first_id
+        end = next_id
+        if limit is not None:
+            end = min(end, cursor + limit)
+        ring, size = self.ring, self.history_size
+        return [ring[i % size] for i in xrange(cursor, end)], end
+
+    def wait(self, cursor, timeout=None, limit=None):
+        """Like read(), but if there is nothing from cursor on, block until
+        something is published or the timeout passes. An empty list of
+        messages means that the timeout passed."""
+        with atomic():
+            cursor = min(cursor, self.next_id)
+            if cursor == self.next_id:
+                try:
+                    channel_wait(self.chan, timeout)
+                except WaitTimeoutError:
+                    return [], cursor
+            return self.read(cursor, limit)
+
+    def subscribe(self, cursor=None):
+        """Return a Subscription, by default for messages published from now on."""
+        return Subscription(self, cursor)
+
+
+class Subscription(object):
+    """Keeps a cursor into a topic for a subscriber which stays around."""
+
+    def __init__(self, topic, cursor=None):
+        self.topic = topic
+        if cursor is None:
+            cursor = topic.cursor()
+        self.cursor = cursor
+        self.missed = 0    # The number of messages lost by lagging behind
+
+    def _update(self, messages, cursor):
+        self.missed += cursor - self.cursor - len(messages)
+        self.cursor = cursor
+        return messages
+
+    def read(self, limit=None):
+        """Return the messages which have arrived since the last call."""
+        return self._update(*self.topic.read(self.cursor, limit))
+
+    def get(self, timeout=None, limit=None):
+        """Return the messages which have arrived since the last call,
+        waiting for at least one unless the timeout passes first."""
+        return self._update(*self.topic.wait(self.cursor, timeout, limit))
+
+    def __iter__(self):
+        while True:
+            for message in self.get():
+                yield message
+
+
+class Broadcast(object):
+    """A set of topics, which are created on first use. Keyword arguments
+    are passed on to each new Topic."""
+
+    topic_class = Topic
+
+    def __init__(self, **topic_args):
+        self.topic_args = topic_args
+        self.topics = {}
+
+    def topic(self, name):
+        try:
+            return self.topics[name]
+        except KeyError:
+            topic = self.topics[name] = self.topic_class(name, **self.topic_args)
+            return topic
+
+    def publish(self, name, message):
+        return self.topic(name).publish(message)
+
+    def read(self, name, cursor=0, limit=None):
+        return self.topic(name).read(cursor, limit)
+
+    def wait(self, name, cursor, timeout=None, limit=None):
+        return self.topic(name).wait(cursor, timeout, limit)
+
+    def subscribe(self, name, cursor=None):
+        return self.topic(name).subscribe(cursor)
+
+    def stats(self):
+        """Return a dict of counters per topic name."""
+        return dict((name, {"next_id": topic.next_id,
+                            "waiting": topic.waiting,
+                            "lagged": topic.lagged})
+                    for name, topic in self.topics.iteritems())
@@ -10,6 +10,10 @@ try:
     import stacklessio
 except ImportError:
     stacklessio = None
+try:
+    import pyuv
+except ImportError:
+    pyuv = None
 
 _sleep = time.sleep # Steal this before monkeypatching occurs.
 
@@ -280,6 +284,14 @@ class MainLoop(object):
         """Stop the run"""
         self.running = False
 
+    def install(self):
+        """Called by set_mainloop when this becomes the main loop."""
+        pass
+
+    def uninstall(self):
+        """Called by set_mainloop when another loop replaces this one."""
+        pass
+
     #these two really should be part of the "App" class.
     def sleep(self, delay):
         self.scheduler.sleep(delay)
@@ -297,6 +309,81 @@ class SLIOMainLoop(MainLoop):
         stacklessio.break_wait()
 
 
+class PyuvMainLoop(MainLoop):
+    """
+    A main loop which makes libuv the only wait primitive of the process.
+    Timed events are run from a uv timer and the socket_pyuv IO callbacks
+    wake their blocked tasklets directly, so there is no pumping tasklet
+    competing with the others.  Another thread can break the wait through
+    a uv async handle.
+    """
+    def __init__(self):
+        MainLoop.__init__(self)
+        if pyuv is None:
+            raise RuntimeError("PyuvMainLoop requires the pyuv module")
+        from .replacements import socket_pyuv
+        self.socket_pyuv = socket_pyuv
+        # The wait is interruptable, so it does not need to be short.
+        self.max_wait_time = 1.0
+        self.loop = socket_pyuv._pyuv_loop
+        self.timer = pyuv.Timer(self.loop)
+        self.waker = pyuv.Async(self.loop, self._waker_callback)
+        self.old_manager = None
+
+    def install(self):
+        # The sockets are serviced by our wait, not by a tasklet of their own.
+        if self.old_manager is None:
+            self.old_manager = self.socket_pyuv._manage_sockets_func
+            self.socket_pyuv.stacklesssocket_manager(lambda: None)
+
+    def uninstall(self):
+        if self.old_manager is not None:
+            self.socket_pyuv.stacklesssocket_manager(self.old_manager)
+            self.old_manager = None
+
+    def close(self):
+        """Give socket_pyuv back its own manager, and release the uv handles."""
+        self.uninstall()
+        self.timer.close()
+        self.waker.close()
+
+    def _timer_callback(self, timer_handle):
+        self.event_queue.pump()
+
+    def _waker_callback(self, async_handle):
+        pass
+
+    def interrupt_wait(self):
+        self.waker.send()
+
+    def wait(self):
+        """ Wait in libuv until IO is ready or the next scheduled event is due """
+        if stackless.runcount > 1:
+            wait_time = 0.0
+        else:
+            wait_time = self.get_wait_time(elapsed_time())
+        if not wait_time and not len(self.socket_pyuv._socket_map):
+            # There is no IO to poll for, and no reason to block.
+            return
+        self.timer.start(self._timer_callback, wait_time, 0.0)
+        try:
+            self.socket_pyuv._run_once(self.loop)
+        finally:
+            self.timer.stop()
+
+
+def set_mainloop(loop):
+    """
+    Make 'loop' the main loop, which stacklesslib and the functions below
+    use, for example set_mainloop(PyuvMainLoop()).  Returns the old one.
+    """
+    global mainloop
+    old = mainloop
+    old.uninstall()
+    mainloop = loop
+    loop.install()
+    return old
+
 # Convenience functions to sleep in the global scheduler.
 def sleep(delay):
     mainloop.sleep(delay)
@@ -66,7 +66,7 @@ def patch_socket(will_be_pumped=True):
         sys.modules["_socket"] = _socket
     else:
         # Fallback on the generic 'stacklesssocket' module.
-        from stacklesslib.replacements import socket
+        from stacklesslib.replacements import socket_asyncore as socket
         socket._sleep_func = main.sleep
         socket._schedule_func = lambda: main.sleep(0)
         if will_be_pumped:
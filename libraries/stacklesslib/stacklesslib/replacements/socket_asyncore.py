@@ -42,6 +42,7 @@ import asyncore
 from collections import deque
 import gc
 import logging
+import os
 import select
 import socket as stdsocket # We need the "socket" name for the function we export.
 import sys
@@ -63,6 +64,11 @@ import stackless
 VALUE_MAX_NONBLOCKINGREAD_SIZE = 1000000
 VALUE_MAX_NONBLOCKINGREAD_CALLS = 100
 
+# This value governs how many pending connections a listening socket
+# accepts when poll() reports it readable, before the other sockets get
+# their turn.  Connections beyond the waiting accept() calls are queued.
+VALUE_MAX_ACCEPTS_PER_EVENT = 64
+
 ## Monkey-patching support..
 
 # We need this so that sockets are cleared out when they are no longer in use.
@@ -197,6 +203,50 @@ class _socketobject_new(_socketobject_old):
 
     accept.__doc__ = _socketobject_old.accept.__doc__
 
+# Python 2 does not export this, even where the platform supports it.
+SO_REUSEPORT = getattr(stdsocket, "SO_REUSEPORT", None)
+if SO_REUSEPORT is None and sys.platform.startswith("linux"):
+    SO_REUSEPORT = 15
+
+def make_reuseport_listener(address, backlog=128, family=AF_INET):
+    """
+    Create a socket listening on the given address with SO_REUSEPORT set,
+    so that several processes can each have their own listening socket on
+    the same address and the kernel balances incoming connections between
+    them.
+    """
+    if SO_REUSEPORT is None:
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+    listenSocket = stdsocket.socket(family, SOCK_STREAM)
+    listenSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    listenSocket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    listenSocket.bind(address)
+    listenSocket.listen(backlog)
+    return listenSocket
+
+def spawn_reuseport_listeners(address, count, worker, backlog=128):
+    """
+    Fork 'count' worker processes that each create their own SO_REUSEPORT
+    listening socket on 'address' and call 'worker(listenSocket)' with it.
+    The worker is responsible for running the scheduler, and the process
+    exits when it returns.  The process ids of the workers are returned.
+    """
+    pids = []
+    for i in range(count):
+        pid = os.fork()
+        if pid == 0:
+            exitCode = 0
+            try:
+                try:
+                    worker(make_reuseport_listener(address, backlog))
+                except BaseException:
+                    logging.root.exception("reuseport worker %d failed", i)
+                    exitCode = 1
+            finally:
+                os._exit(exitCode)
+        pids.append(pid)
+    return pids
+
 def make_blocking_socket(family=AF_INET, type=SOCK_STREAM, proto=0):
     """
     Sometimes you may want to create a normal Python socket, even when
@@ -316,6 +366,7 @@ class _fakesocket(asyncore_dispatcher):
         # This will register the real socket in the internal socket map.
         asyncore_dispatcher.__init__(self, realSocket)
 
+        self.acceptQueue = deque()
         self.readQueue = deque()
         self.writeQueue = deque()
         self.sendToBuffers = deque()
@@ -390,9 +441,15 @@ class _fakesocket(asyncore_dispatcher):
     ## Overriden socket methods.
 
     def accept(self):
+        # Connections accepted in excess of the waiting calls come first.
+        if len(self.acceptQueue):
+            return self.acceptQueue.popleft()
         self._ensure_non_blocking_read()
         if not self.acceptChannel:
             self.acceptChannel = make_channel()
+            # Prefer the sender, so that handle_accept can hand over
+            # connections without blocking.
+            self.acceptChannel.preference = 1
         return self.receive_with_timeout(self.acceptChannel)
 
     def connect(self, address):
@@ -547,6 +604,8 @@ class _fakesocket(asyncore_dispatcher):
         # Clear out all the channels with relevant errors.
         while self.acceptChannel and self.acceptChannel.balance < 0:
             self.acceptChannel.send_exception(stdsocket.error, EBADF, 'Bad file descriptor')
+        while len(self.acceptQueue):
+            self.acceptQueue.popleft()[0].close()
         while self.connectChannel and self.connectChannel.balance < 0:
             self.connectChannel.send_exception(stdsocket.error, ECONNREFUSED, 'Connection refused')
         self._clear_queue(self.writeQueue, stdsocket.error, ECONNRESET)
@@ -595,12 +654,22 @@ class _fakesocket(asyncore_dispatcher):
         self._timeout = value
 
     def handle_accept(self):
-        if self.acceptChannel and self.acceptChannel.balance < 0:
+        """
+        Drain the listen backlog until it would block, up to a bounded number
+        of connections per event.  Waiting accept calls are handed their
+        connection directly, any others are queued for later accept calls.
+        """
+        if not self.acceptChannel or self.acceptChannel.balance >= 0:
+            return
+        for i in xrange(VALUE_MAX_ACCEPTS_PER_EVENT):
             t = asyncore.dispatcher.accept(self)
             if t is None:
                 return
             t[0].setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-            stackless.tasklet(self.acceptChannel.send)(t)
+            if self.acceptChannel.balance < 0:
+                self.acceptChannel.send(t)
+            else:
+                self.acceptQueue.append(t)
 
     # Inform the blocked connect call that the connection has been made.
     def handle_connect(self):
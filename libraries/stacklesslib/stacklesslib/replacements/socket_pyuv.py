@@ -17,6 +17,7 @@ Todo list:
         translated to the standard Python socket ones.
 """
 
+from collections import deque
 import errno
 import random
 import socket as stdsocket # We need the "socket" name for the function we export.
@@ -111,6 +112,24 @@ _pumping = False
 _pyuv_loop = pyuv.Loop.default_loop()
 _socket_map = weakref.WeakValueDictionary()
 
+# pyuv workaround: older releases only offer 'run_once', newer ones take a
+# run mode.  A zero timeout timer gives 'run_once' non-blocking behaviour.
+if hasattr(pyuv, "UV_RUN_NOWAIT"):
+    def _run_once(loop):
+        loop.run(pyuv.UV_RUN_ONCE)
+    def _run_nowait(loop):
+        loop.run(pyuv.UV_RUN_NOWAIT)
+else:
+    def _run_once(loop):
+        loop.run_once()
+    def _run_nowait(loop):
+        timer = pyuv.Timer(loop)
+        timer.start(lambda redundant_timer_handle: None, 0.0, 0.0)
+        try:
+            loop.run_once()
+        finally:
+            timer.close()
+
 def pump_pyuv():
     global _pumping
     global _pyuv_loop
@@ -127,7 +146,7 @@ def pump_pyuv():
         while len(_socket_map):
             # Ensure the timeout is from the start of our run call.
             timer.again()
-            _pyuv_loop.run_once()
+            _run_once(_pyuv_loop)
             _schedule_func()
     finally:
         _pumping = False
@@ -139,7 +158,22 @@ def start_pumping():
         _pumping = True
         return stackless.tasklet(pump_pyuv)()
 
+def pump():
+    """Poll libuv for IO without waiting."""
+    if len(_socket_map):
+        _run_nowait(_pyuv_loop)
+
+def stacklesssocket_manager(mgr):
+    """
+    Register an alternative to 'start_pumping', which gets called every
+    time a new socket is created.  A main loop that runs the libuv loop
+    itself passes a function that does nothing.
+    """
+    global _manage_sockets_func
+    _manage_sockets_func = mgr
+
 _schedule_func = stackless.schedule
+_manage_sockets_func = start_pumping
 _sleep_func = None
 _timeout_func = None
 
@@ -149,6 +183,14 @@ def can_timeout():
 
 _next_fileno = 10101000
 
+# Reading on a TCP socket stays armed while it has consumers, with incoming
+# data collected in a per-socket buffer.  When this many bytes are buffered
+# and not yet received, reading is paused until half of them are consumed.
+READ_HIGH_WATERMARK = 256 * 1024
+# Sends return as soon as their data is queued in libuv.  Only when this
+# many bytes are queued and not yet written does a sender block.
+WRITE_HIGH_WATERMARK = 256 * 1024
+
 class _fakesocket(object):
     # Optionally overriden variables.
     _accept_channel = None
@@ -159,8 +201,21 @@ class _fakesocket(object):
     _opt_keepalive_delay = DEFAULT_KEEPALIVE_DELAY
     _opt_nodelay = DEFAULT_NODELAY_FLAG
     _opt_reuseaddr = DEFAULT_REUSE_FLAG
+    _read_buffered = 0
+    _read_channel = None
+    _read_eof = False
+    _read_error = None
+    _read_high_watermark = READ_HIGH_WATERMARK
+    _reading = False
     _timeout = None
     _was_connected = False
+    _write_blocked = 0
+    _write_channel = None
+    _write_error = None
+    _write_high_watermark = WRITE_HIGH_WATERMARK
+    _write_pending = 0
+    _write_pending_peak = 0
+    _write_queued = 0
     # Official socket object functions.
     def __init__(self, family=AF_INET, type=SOCK_STREAM, proto=0):
         global _next_fileno
@@ -178,12 +233,14 @@ class _fakesocket(object):
         self._type = type
         self._proto = proto
         # Internal support.
+        self._read_buffer = deque()
+        self._write_sizes = deque()
         self._fileno = _next_fileno
         _next_fileno += 1
         if can_timeout():
             self._timeout = stdsocket.getdefaulttimeout()
         _socket_map[id(self)] = self
-        start_pumping()
+        _manage_sockets_func()
     def accept(self): # TCP
         def accept_result(_new_tcp_socket):
             _new_tcp_socket._was_connected = True
@@ -230,8 +287,12 @@ class _fakesocket(object):
         channel.preference = 1
         def close_callback(_socket_handle):
             channel.send(None)
+        self._reading = False
         self._socket.close(close_callback)
         channel.receive()
+        # Blocked readers get what a closed connection gives them.
+        self._read_eof = True
+        self._wake_readers()
     def connect(self, address): # TCP
         address = self._resolve_address(address)
         err = self.connect_ex(address)
@@ -273,32 +334,29 @@ class _fakesocket(object):
     def makefile(self, mode, bufsize): # ?? HOW?
         raise NotImplementedError("socket.makefile")
     def recv(self, bufsize, flags=0): # TCP?
-        """
-        TODO: Deal with the 'bufsize' constraint.  Currently data returned
-              can be larger than this size.
-        """
         if self.type != SOCK_DGRAM and not self._connected:
             # Sockets which have never been connected do this.
             if not self._was_connected:
                 raise stdsocket.error(ENOTCONN, 'Socket is not connected')
 
-        channel = stackless.channel()
-        channel.preference = 1
-        if self.type == SOCK_STREAM:
-            def tcp_callback(redundant_handle, data, err):
-                self._tcp_socket.stop_read()
-                if channel.balance < 0:
-                    if err == pyuv.errno.UV_EOF:
-                        err = None
-                        data = ""
-                    if err is None:
-                        channel.send(data)
-                    else:
-                        channel.send_exception(stdsocket.error, _errno_map[err])
-            self._tcp_socket.start_read(tcp_callback)
-        else:
+        if self.type != SOCK_STREAM:
             raise NotImplementedError("socket.recvfrom/UDP")
-        return self._receive_with_timeout(channel)
+        if bufsize < 0:
+            raise ValueError("negative buffersize in recv")
+        while not self._read_buffered:
+            if self._read_error is not None:
+                err, self._read_error = self._read_error, None
+                raise stdsocket.error(err)
+            if self._read_eof or not bufsize:
+                return ""
+            self._start_reading()
+            if not self._blocking or self._timeout == 0.0:
+                raise stdsocket.error(EWOULDBLOCK, _EWOULDBLOCK_text)
+            if self._read_channel is None:
+                self._read_channel = stackless.channel()
+                self._read_channel.preference = 1
+            self._receive_with_timeout(self._read_channel)
+        return self._take_buffered(bufsize)
     def recvfrom(self, bufsize, flags=0): # UDP?
         """
         TODO: Deal with the 'bufsize' constraint.  Currently data returned
@@ -323,23 +381,25 @@ class _fakesocket(object):
             return self.recv(bufsize, flags), self.getpeername()
     def recvfrom_into(self, buffer, nbytes, flags=0):
         raise NotImplementedError("socket.recvfrom_into")
-    def recv_into(self, buffer, nbytes, flags=0):
-        raise NotImplementedError("socket.recv_into")
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        if not nbytes:
+            nbytes = len(buffer)
+        data = self.recv(nbytes, flags)
+        buffer[:len(data)] = data
+        return len(data)
     def send(self, string, flags=0): # TCP / UDP
-        channel = stackless.channel()
-        channel.preference = 1
-        def write_callback(redundant_tcp_handle, err):
-            if channel.balance < 0:
-                if err is None:
-                    channel.send(None)
-                else:
-                    # TODO: Really should be able to pass multiple arguments to the exception type..
-                    channel.send_exception(stdsocket.error, _errno_map[err])
-        self._socket.write(string, write_callback)
-        self._receive_with_timeout(channel)
+        if self._write_pending >= self._write_high_watermark:
+            if not self._blocking or self._timeout == 0.0:
+                raise stdsocket.error(EWOULDBLOCK, _EWOULDBLOCK_text)
+            self._write_blocked += 1
+            self._wait_for_writes(self._write_high_watermark)
+        self._queue_write(string)
         return len(string)
     def sendall(self, string, flags=0):
-        return self.send(string, flags)
+        self.send(string, flags)
+        # Only the final drain is waited for, and only by blocking sockets.
+        if self._blocking and self._timeout != 0.0:
+            self._wait_for_writes(1)
     def sendto(self, string, *args):
         if type(string) is unicode:
             # TODO: Either..
@@ -432,6 +492,99 @@ class _fakesocket(object):
     def proto(self):
         return self._proto
     # Custom internal logic.
+    def _start_reading(self):
+        if not self._reading and not self._read_eof:
+            self._reading = True
+            self._tcp_socket.start_read(self._read_callback)
+    def _read_callback(self, redundant_handle, data, err):
+        if err is None:
+            if not data:
+                return
+            self._read_buffer.append(data)
+            self._read_buffered += len(data)
+            if self._read_buffered >= self._read_high_watermark:
+                self._reading = False
+                self._tcp_socket.stop_read()
+        else:
+            self._reading = False
+            self._tcp_socket.stop_read()
+            if err == pyuv.errno.UV_EOF:
+                self._read_eof = True
+            else:
+                self._read_error = _errno_map[err]
+        self._wake_readers()
+    def _wake_readers(self):
+        channel = self._read_channel
+        while channel is not None and channel.balance < 0:
+            channel.send(None)
+    def _take_buffered(self, bufsize):
+        buf = self._read_buffer
+        data = buf[0]
+        if len(data) > bufsize:
+            buf[0] = data[bufsize:]
+            data = data[:bufsize]
+        else:
+            buf.popleft()
+            if buf and len(data) < bufsize:
+                chunks = [ data ]
+                remaining = bufsize - len(data)
+                while buf and remaining:
+                    data = buf[0]
+                    if len(data) > remaining:
+                        buf[0] = data[remaining:]
+                        data = data[:remaining]
+                    else:
+                        buf.popleft()
+                    chunks.append(data)
+                    remaining -= len(data)
+                data = "".join(chunks)
+        self._read_buffered -= len(data)
+        # Resume reading once the consumers have caught up.
+        if self._read_buffered <= self._read_high_watermark // 2:
+            self._start_reading()
+        return data
+    def write_stats(self):
+        """
+        Return the send buffering metrics of this socket: the bytes queued in
+        libuv and not yet written, the peak of that, the total bytes queued
+        and the number of times a sender blocked on the high watermark.
+        """
+        return {
+            "pending": self._write_pending,
+            "pending_peak": self._write_pending_peak,
+            "queued": self._write_queued,
+            "blocked": self._write_blocked,
+        }
+    def _queue_write(self, data):
+        self._raise_write_error()
+        nbytes = len(data)
+        self._socket.write(data, self._write_callback)
+        self._write_sizes.append(nbytes)
+        self._write_pending += nbytes
+        self._write_queued += nbytes
+        if self._write_pending > self._write_pending_peak:
+            self._write_pending_peak = self._write_pending
+    def _write_callback(self, redundant_tcp_handle, err):
+        # Stream writes complete in the order they were queued.
+        self._write_pending -= self._write_sizes.popleft()
+        if err is not None and self._write_error is None:
+            self._write_error = _errno_map.get(err, EBADF)
+        channel = self._write_channel
+        while channel is not None and channel.balance < 0:
+            channel.send(None)
+    def _wait_for_writes(self, limit):
+        """Block while at least 'limit' bytes are waiting to be written."""
+        if self._write_pending >= limit:
+            if self._write_channel is None:
+                self._write_channel = stackless.channel()
+                self._write_channel.preference = 1
+            while self._write_pending >= limit and self._write_error is None:
+                self._receive_with_timeout(self._write_channel)
+        self._raise_write_error()
+    def _raise_write_error(self):
+        if self._write_error is not None:
+            # TODO: Really should be able to pass multiple arguments to the exception type..
+            raise stdsocket.error(self._write_error)
     def _receive_with_timeout(self, channel):
         if self._timeout is not None:
             # Start a timing out process.
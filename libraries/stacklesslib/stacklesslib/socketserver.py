@@ -1,8 +1,18 @@
 """
 Utilities to use the socketserver with stackless
 """
-import stackless
+import errno
+import multiprocessing
+import os
+import signal
 import socket
+import SocketServer
+import traceback
+
+import stackless
+
+from . import main
+from .replacements.socket_asyncore import SO_REUSEPORT
 
 class TaskletMixIn:
     """SocketServer mix-in class to handle each request in a new tasklet."""
@@ -78,3 +88,187 @@ class PatchServer:
             except:
                 self.handle_error(request, client_address)
                 self.shutdown_request(request)
+
+
+class PreforkTaskletServer(PatchServer, TaskletMixIn, SocketServer.TCPServer):
+    """
+    A TCP server which binds once and forks worker processes to serve the
+    connections.  Each worker runs the stacklesslib main loop and handles
+    each request in a tasklet, so that one host is not limited to one core.
+    The workers share the listening socket of the parent or, if 'reuse_port'
+    is set, each listen on the same address with their own SO_REUSEPORT
+    socket, which needs a fixed port.
+
+    The parent supervises the workers and replaces any that exit.  SIGHUP
+    makes it replace them one at a time, with each old worker finishing the
+    requests it is serving before it exits, and SIGTERM or SIGINT stops
+    them all in the same graceful way.  The socket module must be
+    monkeypatched for the workers to serve requests concurrently.
+    """
+    allow_reuse_address = True
+    request_queue_size = 128
+    poll_interval = 0.5
+    # Seconds a stopping worker gives the requests in progress to finish.
+    graceful_timeout = 30.0
+    # A worker which exits sooner than this after starting is replaced
+    # only after this delay, so that a failing worker does not spin.
+    restart_delay = 1.0
+
+    def __init__(self, server_address, RequestHandlerClass, workers=None, reuse_port=False):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if reuse_port and SO_REUSEPORT is None:
+            raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.worker_pids = {}   # pid -> start time
+        self.retiring_pids = set()
+        self.restart_requested = False
+        self.shutting_down = False
+        # Worker process state.
+        self.stopping = False
+        self.active_requests = 0
+        SocketServer.TCPServer.__init__(self, server_address, RequestHandlerClass,
+                                        bind_and_activate=not reuse_port)
+
+    def serve_forever(self, poll_interval=None):
+        """Start the workers and supervise them until they are shut down."""
+        if poll_interval is not None:
+            self.poll_interval = poll_interval
+        old_handlers = {}
+        for signum, handler in ((signal.SIGTERM, self._shutdown_signal),
+                                (signal.SIGINT, self._shutdown_signal),
+                                (signal.SIGHUP, self._restart_signal)):
+            old_handlers[signum] = signal.signal(signum, handler)
+        try:
+            for i in xrange(self.workers):
+                self._spawn_worker()
+            stopped = False
+            while self.worker_pids:
+                if self.shutting_down:
+                    if not stopped:
+                        stopped = True
+                        self._signal_workers(list(self.worker_pids))
+                elif self.restart_requested:
+                    self.restart_requested = False
+                    self._rolling_restart()
+                    continue
+                pid = self._wait_for_worker()
+                if pid is not None:
+                    self._worker_exited(pid)
+        finally:
+            for signum, handler in old_handlers.iteritems():
+                signal.signal(signum, handler)
+            self.server_close()
+
+    def _shutdown_signal(self, signum, frame):
+        self.shutting_down = True
+
+    def _restart_signal(self, signum, frame):
+        self.restart_requested = True
+
+    def _spawn_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                try:
+                    self._worker_main()
+                except BaseException:
+                    traceback.print_exc()
+                    exit_code = 1
+            finally:
+                os._exit(exit_code)
+        self.worker_pids[pid] = main.elapsed_time()
+        return pid
+
+    def _signal_workers(self, pids, signum=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def _wait_for_worker(self):
+        """Reap an exited worker, or sleep a while if there is none."""
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                return None
+            if e.errno == errno.ECHILD:
+                self.worker_pids.clear()
+                return None
+            raise
+        if pid == 0:
+            # Signals cut this short, so shutdown and restarts stay prompt.
+            main._sleep(self.poll_interval)
+            return None
+        return pid
+
+    def _worker_exited(self, pid):
+        started = self.worker_pids.pop(pid, None)
+        if started is None:
+            return
+        if pid in self.retiring_pids:
+            self.retiring_pids.discard(pid)
+            return
+        if self.shutting_down:
+            return
+        if main.elapsed_time() - started < self.restart_delay:
+            main._sleep(self.restart_delay)
+        self._spawn_worker()
+
+    def _rolling_restart(self):
+        """Replace the workers one at a time, each new one before its old one goes."""
+        for pid in list(self.worker_pids):
+            if self.shutting_down:
+                return
+            if pid not in self.worker_pids:
+                continue
+            self._spawn_worker()
+            self.retiring_pids.add(pid)
+            self._signal_workers([ pid ])
+            while pid in self.worker_pids:
+                exited = self._wait_for_worker()
+                if exited is not None:
+                    self._worker_exited(exited)
+
+    # Worker process logic.
+    def _worker_main(self):
+        # The parent decides when workers stop or restart.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._worker_stop_signal)
+        self.worker_pids = {}
+        self.retiring_pids = set()
+        if self.reuse_port:
+            self.socket = socket.socket(self.address_family, self.socket_type)
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            self.server_bind()
+            self.server_activate()
+        stackless.tasklet(self._worker_serve)()
+        main.mainloop.run()
+
+    def _worker_stop_signal(self, signum, frame):
+        self.stopping = True
+        main.mainloop.interrupt_wait()
+
+    def _worker_serve(self):
+        try:
+            while not self.stopping:
+                self._handle_request_timeout(self.poll_interval)
+            # Stop accepting, and let the requests in progress finish.
+            self.socket.close()
+            deadline = main.elapsed_time() + self.graceful_timeout
+            while self.active_requests and main.elapsed_time() < deadline:
+                main.sleep(0.05)
+        finally:
+            main.mainloop.stop()
+
+    def process_request_tasklet(self, request, client_address):
+        self.active_requests += 1
+        try:
+            TaskletMixIn.process_request_tasklet(self, request, client_address)
+        finally:
+            self.active_requests -= 1
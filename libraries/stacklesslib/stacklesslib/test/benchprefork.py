@@ -0,0 +1,93 @@
+"""
+Load benchmark for the PreforkTaskletServer.
+
+A line echo server is run with 1, 2 and 4 worker processes, and driven
+over loopback by client processes which each make as many request and
+response round trips as they can for a fixed time.  The throughput should
+scale with the worker count until the cores are saturated.
+
+Usage: python benchprefork.py [seconds] [clients]
+"""
+
+import os
+import signal
+import socket
+import sys
+import time
+
+ADDRESS = ("127.0.0.1", 40405)
+# Work done per request, so that the workers are the bottleneck.
+REQUEST_WORK = 2000
+
+
+def run_server(workers):
+    import stacklesslib.monkeypatch
+    stacklesslib.monkeypatch.patch_all()
+    import SocketServer
+    from stacklesslib.socketserver import PreforkTaskletServer
+
+    class EchoHandler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            while line:
+                sum(xrange(REQUEST_WORK))
+                self.wfile.write(line)
+                line = self.rfile.readline()
+
+    server = PreforkTaskletServer(ADDRESS, EchoHandler, workers=workers)
+    server.serve_forever()
+
+
+def run_client(duration, resultFd):
+    s = socket.create_connection(ADDRESS)
+    f = s.makefile("rb")
+    requests = 0
+    endTime = time.time() + duration
+    while time.time() < endTime:
+        s.sendall("ping\n")
+        f.readline()
+        requests += 1
+    s.close()
+    os.write(resultFd, "%d\n" % requests)
+
+
+def fork(function, *args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            function(*args)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def wait_for_server():
+    while True:
+        try:
+            socket.create_connection(ADDRESS).close()
+            return
+        except socket.error:
+            time.sleep(0.05)
+
+
+def measure(workers, duration, clients):
+    serverPid = fork(run_server, workers)
+    try:
+        wait_for_server()
+        readFd, writeFd = os.pipe()
+        clientPids = [ fork(run_client, duration, writeFd) for i in range(clients) ]
+        os.close(writeFd)
+        results = os.fdopen(readFd).read().split()
+        for pid in clientPids:
+            os.waitpid(pid, 0)
+    finally:
+        os.kill(serverPid, signal.SIGTERM)
+        os.waitpid(serverPid, 0)
+    return sum(int(n) for n in results) / duration
+
+
+if __name__ == "__main__":
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5.0
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    for workers in (1, 2, 4):
+        print "workers %d: %.0f requests/s" % (workers, measure(workers, duration, clients))
@@ -0,0 +1,125 @@
+import unittest
+
+import stackless
+
+import stacklesslib.main
+from stacklesslib.broadcast import Broadcast, Topic, SubscriberLagged, COALESCE, DROP
+
+
+class TestTopic(unittest.TestCase):
+    def testRead(self):
+        topic = Topic()
+        cursor = topic.cursor()
+        self.assertEqual(topic.read(cursor), ([], cursor))
+        for i in range(3):
+            topic.publish(i)
+        self.assertEqual(topic.read(cursor), ([0, 1, 2], 3))
+        self.assertEqual(topic.read(cursor, limit=2), ([0, 1], 2))
+        self.assertEqual(topic.read(3), ([], 3))
+
+    def testHistoryWraps(self):
+        topic = Topic(history_size=4)
+        for i in range(10):
+            topic.publish(i)
+        self.assertEqual(topic.first_id, 6)
+        self.assertEqual(topic.read(7), ([7, 8, 9], 10))
+        # Messages 0 to 5 are gone, so a reader at 0 skips them.
+        self.assertEqual(topic.read(0), ([6, 7, 8, 9], 10))
+        self.assertEqual(topic.lagged, 1)
+
+    def testCoalesce(self):
+        topic = Topic(history_size=4, lag_policy=COALESCE)
+        for i in range(10):
+            topic.publish(i)
+        self.assertEqual(topic.read(0), ([9], 10))
+        self.assertEqual(topic.lagged, 1)
+
+    def testCoalesceKeepingUp(self):
+        # A reader whose messages are all still held gets every one of them.
+        topic = Topic(history_size=4, lag_policy=COALESCE)
+        for i in range(10):
+            topic.publish(i)
+        self.assertEqual(topic.read(6), ([6, 7, 8, 9], 10))
+        self.assertEqual(topic.read(8), ([8, 9], 10))
+        self.assertEqual(topic.lagged, 0)
+
+    def testDrop(self):
+        topic = Topic(history_size=4, lag_policy=DROP)
+        for i in range(10):
+            topic.publish(i)
+        self.assertEqual(topic.read(6), ([6, 7, 8, 9], 10))
+        try:
+            topic.read(1)
+        except SubscriberLagged, e:
+            self.assertEqual(e.missed, 5)
+        else:
+            self.fail("SubscriberLagged not raised")
+
+    def testSubscription(self):
+        topic = Topic(history_size=4)
+        topic.publish("old")
+        sub = topic.subscribe()
+        self.assertEqual(sub.read(), [])
+        for i in range(6):
+            topic.publish(i)
+        self.assertEqual(sub.read(), [2, 3, 4, 5])
+        self.assertEqual(sub.missed, 2)
+
+
+class TestWaiting(unittest.TestCase):
+    def testWakeAll(self):
+        topic = Topic()
+        received = []
+        def waiter():
+            received.append(topic.wait(topic.cursor()))
+        for i in range(100):
+            stackless.tasklet(waiter)()
+        stackless.run()
+        self.assertEqual(topic.waiting, 100)
+
+        # The publisher isn't held up by the waiters
+        topic.publish("hello")
+        self.assertEqual(received, [])
+        self.assertEqual(topic.waiting, 0)
+        stackless.run()
+        self.assertEqual(received, [(["hello"], 1)] * 100)
+
+    def testNoWaitWhenBehind(self):
+        topic = Topic()
+        topic.publish("a")
+        self.assertEqual(topic.wait(0), (["a"], 1))
+
+    def testTimeout(self):
+        topic = Topic()
+        received = []
+        def waiter():
+            received.append(topic.wait(topic.cursor(), timeout=0.01))
+        stackless.tasklet(waiter)()
+        stackless.run()
+        while not received:
+            stacklesslib.main.event_queue.pump()
+            stackless.run()
+        self.assertEqual(received, [([], 0)])
+        self.assertEqual(topic.waiting, 0)
+        topic.publish("late")
+        self.assertEqual(topic.read(0), (["late"], 1))
+
+    def testBroadcastTopics(self):
+        broadcast = Broadcast(history_size=10)
+        received = []
+        def waiter(name):
+            received.append((name, broadcast.wait(name, 0)[0]))
+        stackless.tasklet(waiter)("a")
+        stackless.tasklet(waiter)("b")
+        stackless.run()
+        broadcast.publish("b", 1)
+        stackless.run()
+        self.assertEqual(received, [("b", [1])])
+        self.assertEqual(broadcast.stats()["a"]["waiting"], 1)
+        broadcast.publish("a", 2)
+        stackless.run()
+        self.assertEqual(received, [("b", [1]), ("a", [2])])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -56,6 +56,56 @@ class TestMainLoop(unittest.TestCase):
         self.checkLeftThingsClean() # Boilerplate check. 
 
 
+class TestPyuvMainLoop(unittest.TestCase):
+    def setUp(self):
+        if stacklesslib.main.pyuv is None:
+            self.skipTest("pyuv is not installed")
+        self.mainloop = stacklesslib.main.PyuvMainLoop()
+
+    def tearDown(self):
+        self.mainloop.close()
+
+    def testSocketManager(self):
+        """
+        Check that the loop only takes over servicing the sockets while it
+        is the main loop.
+        """
+        socket_pyuv = self.mainloop.socket_pyuv
+        manager = socket_pyuv._manage_sockets_func
+        old = stacklesslib.main.set_mainloop(self.mainloop)
+        try:
+            self.assertTrue(stacklesslib.main.mainloop is self.mainloop)
+            self.assertTrue(socket_pyuv._manage_sockets_func is not manager)
+        finally:
+            stacklesslib.main.set_mainloop(old)
+        self.assertTrue(socket_pyuv._manage_sockets_func is manager)
+
+    def testSleepWakesFromTimer(self):
+        """
+        Put a tasklet to sleep and run the loop until it wakes up.  With
+        nothing else to do, the loop should block in libuv until the
+        uv timer runs the event.
+        """
+        elapsed_time = stacklesslib.main.elapsed_time
+        woken = []
+        def Sleeper():
+            self.mainloop.sleep(0.05)
+            woken.append(elapsed_time())
+
+        start = elapsed_time()
+        stackless.tasklet(Sleeper)()
+        iterations = 0
+        while not woken:
+            self.mainloop.pump()
+            self.mainloop.run_tasklets()
+            self.mainloop.wait()
+            iterations += 1
+
+        self.assertTrue(woken[0] - start >= 0.04)
+        # Blocking waits, not a busy loop of polls.
+        self.assertTrue(iterations < 10)
+
+
 def ArbitraryFunc():
     sum = 0
     for i in range(1000):
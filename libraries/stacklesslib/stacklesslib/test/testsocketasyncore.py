@@ -0,0 +1,59 @@
+import asyncore
+import socket
+import unittest
+
+import stackless
+
+from stacklesslib.replacements import socket_asyncore
+
+
+class TestAccept(unittest.TestCase):
+    def setUp(self):
+        # The test polls the sockets itself, rather than a manager tasklet.
+        self.old_manager = socket_asyncore._manage_sockets_func
+        socket_asyncore.stacklesssocket_manager(lambda: None)
+        self.sockets = []
+
+    def tearDown(self):
+        for s in self.sockets:
+            s.close()
+        socket_asyncore.stacklesssocket_manager(self.old_manager)
+
+    def testBatchedAccept(self):
+        """
+        Connect several clients before anyone accepts, and check that one
+        event accepts them all, handing the first to the waiting accept
+        call and queueing the rest for the calls that follow, in order.
+        """
+        listener = socket_asyncore._socketobject_new(socket.AF_INET, socket.SOCK_STREAM)
+        self.sockets.append(listener)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(5)
+
+        clients = []
+        for i in range(3):
+            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sockets.append(client)
+            client.connect(listener.getsockname())
+            clients.append(client.getsockname())
+
+        accepted = []
+        def Acceptor():
+            for i in range(len(clients)):
+                conn, addr = listener.accept()
+                self.sockets.append(conn)
+                accepted.append(addr)
+        t = stackless.tasklet(Acceptor)()
+        t.run()
+        self.assertTrue(t.alive)
+
+        asyncore.poll(1.0)
+        self.assertEqual(len(listener._sock.acceptQueue), len(clients) - 1)
+
+        stackless.run()
+        self.assertFalse(t.alive)
+        self.assertEqual(accepted, clients)
+
+
+if __name__ == '__main__':
+    unittest.main()
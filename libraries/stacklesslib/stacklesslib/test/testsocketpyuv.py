@@ -0,0 +1,207 @@
+import errno
+import unittest
+from collections import deque
+
+import stackless
+
+try:
+    from stacklesslib.replacements import socket_pyuv
+except ImportError:
+    socket_pyuv = None
+
+
+class FakeTCP(object):
+    """
+    Stands in for the pyuv TCP handle of a socket, so that tests decide
+    when writes complete and what data arrives.
+    """
+    def __init__(self):
+        self.writes = []
+        self.reading = False
+        self.start_reads = 0
+        self.stop_reads = 0
+
+    def write(self, data, callback):
+        self.writes.append((data, callback))
+
+    def complete_writes(self, err=None):
+        writes, self.writes = self.writes, []
+        for data, callback in writes:
+            callback(self, err)
+
+    def start_read(self, callback):
+        self.reading = True
+        self.start_reads += 1
+
+    def stop_read(self):
+        self.reading = False
+        self.stop_reads += 1
+
+
+class SocketTestCase(unittest.TestCase):
+    def setUp(self):
+        if socket_pyuv is None:
+            self.skipTest("pyuv is not installed")
+
+    def makeSocket(self):
+        # Bypass '__init__', which would create a real handle on the loop.
+        sock = socket_pyuv._fakesocket.__new__(socket_pyuv._fakesocket)
+        sock._socket = sock._tcp_socket = FakeTCP()
+        sock._family = socket_pyuv.AF_INET
+        sock._type = socket_pyuv.SOCK_STREAM
+        sock._proto = 0
+        sock._read_buffer = deque()
+        sock._write_sizes = deque()
+        sock._connected = True
+        return sock
+
+
+class TestSend(SocketTestCase):
+    def testSendQueues(self):
+        sock = self.makeSocket()
+        self.assertEqual(sock.send("abc"), 3)
+        self.assertEqual(sock.send("de"), 2)
+        self.assertEqual(len(sock._socket.writes), 2)
+        self.assertEqual(sock.write_stats(), {
+            "pending": 5, "pending_peak": 5, "queued": 5, "blocked": 0 })
+        sock._socket.complete_writes()
+        self.assertEqual(sock.write_stats(), {
+            "pending": 0, "pending_peak": 5, "queued": 5, "blocked": 0 })
+
+    def testSendBlocksAtHighWatermark(self):
+        sock = self.makeSocket()
+        sock._write_high_watermark = 8
+        sock.send("x" * 8)
+        done = []
+        def Sender():
+            sock.send("y")
+            done.append(True)
+        t = stackless.tasklet(Sender)()
+        t.run()
+        # The sender waits for the queue to drain below the watermark.
+        self.assertTrue(t.alive)
+        self.assertFalse(done)
+        self.assertEqual(len(sock._socket.writes), 1)
+        self.assertEqual(sock.write_stats()["blocked"], 1)
+
+        sock._socket.complete_writes()
+        stackless.run()
+        self.assertEqual(done, [True])
+        self.assertEqual(sock.write_stats(), {
+            "pending": 1, "pending_peak": 8, "queued": 9, "blocked": 1 })
+
+    def testNonBlockingSendAtHighWatermark(self):
+        sock = self.makeSocket()
+        sock.setblocking(0)
+        sock._write_high_watermark = 8
+        sock.send("x" * 8)
+        try:
+            sock.send("y")
+        except socket_pyuv.stdsocket.error, e:
+            self.assertEqual(e.args[0], errno.EWOULDBLOCK)
+        else:
+            self.fail("send did not raise EWOULDBLOCK")
+        self.assertEqual(sock.write_stats()["blocked"], 0)
+
+    def testSendallWaitsForDrain(self):
+        sock = self.makeSocket()
+        done = []
+        def Sender():
+            sock.sendall("abc")
+            done.append(True)
+        t = stackless.tasklet(Sender)()
+        t.run()
+        self.assertTrue(t.alive)
+        self.assertFalse(done)
+
+        sock._socket.complete_writes()
+        stackless.run()
+        self.assertEqual(done, [True])
+        # Waiting for the final drain is not a watermark stall.
+        self.assertEqual(sock.write_stats()["blocked"], 0)
+
+    def testNonBlockingSendall(self):
+        sock = self.makeSocket()
+        sock.setblocking(0)
+        sock.sendall("abc")
+        self.assertEqual(sock.write_stats()["pending"], 3)
+
+    def testWriteError(self):
+        sock = self.makeSocket()
+        sock.send("abc")
+        sock._socket.complete_writes(socket_pyuv.pyuv.errno.UV_ECONNRESET)
+        self.assertRaises(socket_pyuv.stdsocket.error, sock.send, "d")
+
+
+
+class TestRecv(SocketTestCase):
+    def feed(self, sock, data):
+        sock._read_callback(sock._tcp_socket, data, None)
+
+    def testRecvSplitsByBufsize(self):
+        sock = self.makeSocket()
+        self.feed(sock, "abcdef")
+        self.feed(sock, "ghi")
+        self.assertEqual(sock.recv(4), "abcd")
+        self.assertEqual(sock.recv(4), "efgh")
+        self.assertEqual(sock.recv(4), "i")
+        self.assertEqual(sock._read_buffered, 0)
+
+    def testRecvWaitsForData(self):
+        sock = self.makeSocket()
+        received = []
+        def Receiver():
+            received.append(sock.recv(10))
+        t = stackless.tasklet(Receiver)()
+        t.run()
+        # Reading was started for the receiver, which waits for data.
+        self.assertTrue(t.alive)
+        self.assertTrue(sock._tcp_socket.reading)
+
+        self.feed(sock, "abc")
+        stackless.run()
+        self.assertEqual(received, ["abc"])
+
+    def testNonBlockingRecv(self):
+        sock = self.makeSocket()
+        sock.setblocking(0)
+        try:
+            sock.recv(10)
+        except socket_pyuv.stdsocket.error, e:
+            self.assertEqual(e.args[0], errno.EWOULDBLOCK)
+        else:
+            self.fail("recv did not raise EWOULDBLOCK")
+        self.assertTrue(sock._tcp_socket.reading)
+
+    def testEOFWithBufferedData(self):
+        sock = self.makeSocket()
+        sock._start_reading()
+        self.feed(sock, "abc")
+        sock._read_callback(sock._tcp_socket, None, socket_pyuv.pyuv.errno.UV_EOF)
+        self.assertFalse(sock._tcp_socket.reading)
+        # Data that arrived before the end of the stream is still received.
+        self.assertEqual(sock.recv(2), "ab")
+        self.assertEqual(sock.recv(2), "c")
+        self.assertEqual(sock.recv(2), "")
+        self.assertEqual(sock._tcp_socket.start_reads, 1)
+
+    def testReadPausesAtHighWatermark(self):
+        sock = self.makeSocket()
+        sock._read_high_watermark = 8
+        sock._start_reading()
+        self.feed(sock, "abcd")
+        self.assertTrue(sock._tcp_socket.reading)
+        self.feed(sock, "efgh")
+        self.assertFalse(sock._tcp_socket.reading)
+        self.assertEqual(sock._tcp_socket.stop_reads, 1)
+
+        # Reading resumes once half of the buffered data is consumed.
+        self.assertEqual(sock.recv(2), "ab")
+        self.assertFalse(sock._tcp_socket.reading)
+        self.assertEqual(sock.recv(2), "cd")
+        self.assertTrue(sock._tcp_socket.reading)
+        self.assertEqual(sock._tcp_socket.start_reads, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,8 +9,8 @@ from . import locks
 
 #defeat monkeypatching of the "threading" module
 if hasattr(threading, "real_threading"):
-    _realthreading = threading.realthreading
-    _RealThread = threading.realthreading.Thread
+    _realthreading = threading.real_threading
+    _RealThread = threading.real_threading.Thread
 else:
     _realthreading = threading
     _RealThread = threading.Thread
@@ -77,7 +77,9 @@ class simple_threadpool(dummy_threadpool):
             try:
                 # Wait for quit or job
                 while True:
-                    self.cond.wait_for(predicate)
+                    # threading.Condition has no wait_for() before Python 3.2
+                    while not predicate():
+                        self.cond.wait()
                     if self.threads_n > self.threads_max:
                         return
                     job = self.queue.popleft()
@@ -4,7 +4,7 @@ import stackless
 import contextlib
 import weakref
 import collections
-from . import main, threadpool
+from . import main
 
 
 @contextlib.contextmanager
@@ -220,5 +220,7 @@ def call_on_thread(function, args=(), kwargs={}, stack_size=None, pool=None, tim
        Ideal for performing OS type tasks, such as saving files or compressing
     """
     if not pool:
+        # imported here, since threadpool imports locks, which imports us
+        from . import threadpool
         pool = threadpool.dummy_threadpool(stack_size)
     return call_async(pool.submit, function, args, kwargs, timeout=timeout)
@@ -0,0 +1,59 @@
+#
+# Measures how long jobs given to uthread.pool wait before they start.
+#
+# A driver tasklet pools bursts of jobs, waits for them all to run, then
+# sleeps briefly so the pool goes idle before the next burst.  For each
+# burst size the results are:
+#   p50/p99/max  how long the jobs waited to start, in milliseconds
+#   helpers      the number of pool helper tasklets after the last burst
+#
+# The statistics uthread keeps for the benchmark context are shown at the
+# end.
+#
+# Usage: python poolbenchmark.py [burst sizes ...]
+#
+# The burst sizes default to 1, 100 and 10000.
+#
+
+import sys, time
+import uthread
+
+DEFAULT_BURSTS = [ 1, 100, 10000 ]
+ROUNDS = 20
+CONTEXT = "poolbenchmark::Job"
+
+
+def Job(queueTime, latencies):
+    latencies.append(time.time() - queueTime)
+
+
+def Percentile(sortedValues, fraction):
+    return sortedValues[min(int(len(sortedValues) * fraction), len(sortedValues) - 1)]
+
+
+def Driver(bursts):
+    print "%8s %9s %9s %9s %8s" % ("burst", "p50 ms", "p99 ms", "max ms", "helpers")
+    for burst in bursts:
+        latencies = []
+        for i in xrange(ROUNDS):
+            expected = len(latencies) + burst
+            for j in xrange(burst):
+                uthread.pool(CONTEXT, Job, time.time(), latencies)
+            while len(latencies) < expected:
+                uthread.BeNice()
+            uthread.Sleep(0.01)
+        latencies.sort()
+        print "%8d %9.3f %9.3f %9.3f %8d" % (burst, Percentile(latencies, 0.5) * 1000.0,
+            Percentile(latencies, 0.99) * 1000.0, latencies[-1] * 1000.0, uthread.poolHelperCount)
+
+    stats = uthread.GetPoolStats()[CONTEXT]
+    print
+    print "%d jobs, queue wait %.3f ms mean %.3f ms max, run time %.3f ms mean" % (stats["jobs"],
+        stats["queueWait"] * 1000.0 / stats["jobs"], stats["maxQueueWait"] * 1000.0,
+        stats["runTime"] * 1000.0 / stats["jobs"])
+
+
+if __name__ == "__main__":
+    bursts = [ int(arg) for arg in sys.argv[1:] ] or DEFAULT_BURSTS
+    uthread.new(Driver, bursts)
+    uthread.Run()
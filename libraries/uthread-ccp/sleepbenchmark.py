@@ -0,0 +1,63 @@
+#
+# Measures the cost of uthread.Sleep with many sleeping tasklets.
+#
+# Each tasklet sleeps a few times, for random periods of up to a second.
+# For each number of tasklets the results are:
+#   sleep us     the time taken by the initial Sleep calls, per tasklet
+#   run s        the time uthread.Run took to wake them all
+#   cpu s        the processor time used by uthread.Run, which is close to
+#                the run time if it spins rather than blocks while waiting
+#   lag p50/max  how late the tasklets woke, in milliseconds
+#
+# Usage: python sleepbenchmark.py [tasklets ...]
+#
+# The number of tasklets defaults to 1000, 10000 and 100000.
+#
+
+import sys, time, random
+import stackless
+import uthread
+
+DEFAULT_COUNTS = [ 1000, 10000, 100000 ]
+SLEEPS_PER_TASKLET = 3
+MAX_SLEEP = 1.0
+
+
+def Sleeper(delays, lags):
+    for delay in delays:
+        endTime = time.time() + delay
+        uthread.Sleep(delay)
+        lags.append(time.time() - endTime)
+
+
+def Measure(count):
+    rnd = random.Random(count)
+    lags = []
+    for i in xrange(count):
+        delays = [ rnd.uniform(0, MAX_SLEEP) for j in xrange(SLEEPS_PER_TASKLET) ]
+        stackless.tasklet(Sleeper)(delays, lags)
+
+    # Run each tasklet up to its first sleep.
+    startTime = time.time()
+    stackless.run()
+    sleepTime = time.time() - startTime
+
+    startTime, startClock = time.time(), time.clock()
+    uthread.Run()
+    runTime, cpuTime = time.time() - startTime, time.clock() - startClock
+
+    lags.sort()
+    return sleepTime, runTime, cpuTime, lags[len(lags) // 2], lags[-1]
+
+
+def Run(counts):
+    print "%9s %10s %8s %8s %9s %9s" % ("tasklets", "sleep us", "run s", "cpu s", "lag p50", "lag max")
+    for count in counts:
+        sleepTime, runTime, cpuTime, lagMedian, lagMax = Measure(count)
+        print "%9d %10.1f %8.2f %8.2f %9.2f %9.2f" % (count, sleepTime * 1e6 / count,
+            runTime, cpuTime, lagMedian * 1000.0, lagMax * 1000.0)
+
+
+if __name__ == "__main__":
+    counts = [ int(arg) for arg in sys.argv[1:] ] or DEFAULT_COUNTS
+    Run(counts)
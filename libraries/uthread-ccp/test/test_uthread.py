@@ -0,0 +1,138 @@
+import os, sys, time, unittest
+import stackless
+
+# Ensure the module to be tested is importable.
+if __name__ == "__main__":
+    currentPath = sys.path[0]
+    parentPath = os.path.dirname(currentPath)
+    if parentPath not in sys.path:
+        sys.path.append(parentPath)
+
+import uthread
+
+
+class PoolTestCase(unittest.TestCase):
+    def testBlockedHelpers(self):
+        """The goal of this test is to ensure that a pooled job which waits
+        on another pooled job is not left waiting when all the helpers in
+        the pool are busy with jobs like it."""
+
+        event = uthread.Event()
+        finished = []
+
+        def Waiter():
+            event.Wait()
+            finished.append(None)
+
+        # More waiting jobs than the pool has ever held helpers.
+        count = 250
+        for i in range(count):
+            uthread.pool("test::Waiter", Waiter)
+        uthread.pool("test::Setter", event.SetEvent)
+        uthread.Run()
+
+        self.failUnless(len(finished) == count, "Only %d of %d waiting jobs finished" % (len(finished), count))
+        stats = uthread.GetPoolStats()
+        self.failUnless(stats["test::Waiter"]["jobs"] == count, "The jobs were not counted")
+
+    def testIdleHelpersExit(self):
+        """The goal of this test is to ensure that the helpers started for a
+        burst of jobs exit again once the burst is over."""
+
+        peak = [ 0 ]
+        def Job():
+            peak[0] = max(peak[0], uthread.poolHelperCount)
+            uthread.BeNice()
+
+        for i in range(5000):
+            uthread.pool("test::Job", Job)
+        uthread.Run()
+        # Jobs which do not block are run by the helpers which are idle.
+        wanted = max(uthread.poolMinHelpers, uthread.poolMaxIdleHelpers)
+        self.failUnless(peak[0] <= uthread.poolMinHelpers + wanted, "The burst reached %d helpers" % peak[0])
+        self.failUnless(uthread.poolHelperCount <= wanted, "%d helpers were left" % uthread.poolHelperCount)
+        # Those left are all waiting for jobs, none are stuck elsewhere.
+        waiting = -uthread.__uthread__queue__.channel.balance
+        self.failUnless(waiting == uthread.poolHelperCount == uthread.poolIdleHelpers,
+            "%d helpers were left, %d waiting for jobs" % (uthread.poolHelperCount, waiting))
+
+
+class FixedTime:
+    """Stands in for the time module in uthread, so that sleepers can be
+    given the same end time."""
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+class SleepTestCase(unittest.TestCase):
+    def setUp(self):
+        # Keep the LockCheck tasklet, which is always sleeping, out of it.
+        self.lockCheckSleepers = uthread.sleepingTasklets
+        uthread.sleepingTasklets = []
+
+    def tearDown(self):
+        uthread.KillSleepingTasklets()
+        stackless.run()
+        uthread.sleepingTasklets = self.lockCheckSleepers
+        uthread.time = time
+
+    def Sleepers(self, delays, woken):
+        def Sleeper(name, delay):
+            uthread.Sleep(delay)
+            woken.append(name)
+        tasklets = [ stackless.tasklet(Sleeper)(name, delay) for name, delay in delays ]
+        stackless.run()
+        return tasklets
+
+    def testWakeAllDue(self):
+        """The goal of this test is to ensure that every sleeper whose time
+        is up is woken in one pass, in the order of their end times, and
+        that those still sleeping are left alone."""
+
+        woken = []
+        uthread.time = FixedTime(1000.0)
+        self.Sleepers([ ("c", 3.0), ("a", 1.0), ("later", 60.0), ("b", 2.0) ], woken)
+        uthread.time = FixedTime(1010.0)
+        self.failUnless(uthread.CheckSleepingTasklets() == 3, "Expected three sleepers to be woken")
+        stackless.run()
+        self.failUnless(woken == [ "a", "b", "c" ], "Woken in the wrong order %s" % woken)
+        self.failUnless(len(uthread.sleepingTasklets) == 1, "The later sleeper was not left sleeping")
+        self.failUnless(uthread.CheckSleepingTasklets() == 0, "Nothing else was due")
+
+    def testEqualEndTimes(self):
+        """The goal of this test is to ensure that sleepers with the same
+        end time wake in the order they went to sleep."""
+
+        woken = []
+        uthread.time = FixedTime(1000.0)
+        names = [ str(i) for i in range(20) ]
+        self.Sleepers([ (name, 1.0) for name in names ], woken)
+        uthread.time = FixedTime(1001.0)
+        uthread.CheckSleepingTasklets()
+        stackless.run()
+        self.failUnless(woken == names, "Woken in the wrong order %s" % woken)
+
+    def testGetSleepTime(self):
+        self.failUnless(uthread.GetSleepTime() is None, "Expected no sleepers")
+        uthread.time = FixedTime(1000.0)
+        self.Sleepers([ ("a", 5.0), ("b", 2.0) ], [])
+        self.failUnless(uthread.GetSleepTime() == 2.0, "Expected the nearest end time")
+        # Overdue sleepers are due at once.
+        uthread.time = FixedTime(1003.0)
+        self.failUnless(uthread.GetSleepTime() == 0.0, "Expected an overdue sleeper")
+
+    def testKillSleepingTasklets(self):
+        woken = []
+        tasklets = self.Sleepers([ ("a", 1.0), ("b", 1.0), ("c", 60.0) ], woken)
+        uthread.KillSleepingTasklets()
+        stackless.run()
+        self.failUnless(uthread.sleepingTasklets == [], "The sleepers were not forgotten")
+        self.failIf([ t for t in tasklets if t.alive ], "Sleeping tasklets were left alive")
+        self.failUnless(woken == [], "Killed sleepers carried on")
+
+
+if __name__ == "__main__":
+    unittest.main()
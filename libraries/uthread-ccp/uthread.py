@@ -54,6 +54,7 @@ OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 import stackless
 import sys
 import time
+import heapq
 import types
 import weakref
 import traceback
@@ -162,40 +163,58 @@ def IsCurrentSynonymOf(synonym_threadid):
 
 # Sleeping related logic.
 
+# A heap of (endTime, sequenceNumber, channel), so that the next tasklet to
+# wake is always first.  The sequence number wakes tasklets with the same
+# end time in the order they went to sleep.
 sleepingTasklets = []
+sleepSequence = 0
 
 def Sleep(secondsToWait):
     '''
     Yield the calling tasklet until the given number of seconds have passed.
     '''
-    global sleepingTasklets
+    global sleepSequence
     channel = stackless.channel()
+    # Waking the tasklet only makes it runnable, so that all those due can
+    # be woken in one pass and then run under the watchdog.
+    channel.preference = 1
     endTime = time.time() + secondsToWait
-    sleepingTasklets.append((endTime, channel))
-    sleepingTasklets.sort()
+    sleepSequence += 1
+    heapq.heappush(sleepingTasklets, (endTime, sleepSequence, channel))
     # Block until we get sent an awakening notification.
     channel.receive()
 
 def CheckSleepingTasklets():
     '''
-    Function for internal uthread.py usage.
+    Function for internal uthread.py usage.  Wakes every tasklet whose
+    time is up, and returns how many there were.
     '''
-    global sleepingTasklets
-    if len(sleepingTasklets):
-        endTime = sleepingTasklets[0][0]
-        if endTime <= time.time():
-            channel = sleepingTasklets[0][1]
-            del sleepingTasklets[0]
+    woken = 0
+    if sleepingTasklets:
+        now = time.time()
+        while sleepingTasklets and sleepingTasklets[0][0] <= now:
+            channel = heapq.heappop(sleepingTasklets)[2]
             # We have to send something, but it doesn't matter what as it is not used.
             # Handle the case where the tasklet has been prematurely killed, otherwise
             # the caller will be blocked indefinitely.
             if channel.balance:
                 channel.send(None)
+                woken += 1
+    return woken
+
+def GetSleepTime():
+    '''
+    Returns the seconds until the next sleeping tasklet is due to wake,
+    or None if there are none.
+    '''
+    if sleepingTasklets:
+        return max(sleepingTasklets[0][0] - time.time(), 0.0)
+    return None
 
 def KillSleepingTasklets():
     global sleepingTasklets
     if len(sleepingTasklets):
-        for timestamp, channel in sleepingTasklets:
+        for timestamp, sequenceNumber, channel in sleepingTasklets:
             t = channel.queue
             while t is not None:
                 toBeKilled = t
@@ -244,8 +263,10 @@ def Run():
     indefinitely as there will be nothing to wake them up.
 
     This function will exit when there are no remaining tasklets to run,
-    whether being nice or sleeping.
+    whether being nice or sleeping.  When all there is are sleeping
+    tasklets, it blocks until the first of them is due to wake.
     '''
+    # The LockCheck tasklet is always sleeping, and is not counted.
     while yieldChannel.balance or len(sleepingTasklets)>1 or stackless.runcount > 1:
         RunNiceTasklets()
         t = stackless.run(500000)
@@ -254,7 +275,10 @@ def Run():
             traceback.print_stack(t.frame)
             print "*** Uncooperative tasklet", t, "being sent exception ***"
             t.raise_exception(TimeoutException)
-        CheckSleepingTasklets()
+        if not CheckSleepingTasklets() and not yieldChannel.balance and stackless.runcount == 1 \
+           and len(sleepingTasklets)>1:
+            # Nothing else to do until the next sleeper is due.
+            time.sleep(GetSleepTime())
 
 semaphores               = weakref.WeakKeyDictionary({})
 
@@ -585,24 +609,6 @@ class FIFO(object):
             sys.exc_clear()
 
 
-# -----------------------------------------------------------------------------------
-#  Queue - QueueCheck
-# -----------------------------------------------------------------------------------
-def QueueCheck(o):
-
-    while True:
-        try:
-            o.pump()
-        except ReferenceError:
-            sys.exc_clear()
-            break
-        except StandardError:
-            StackTrace()
-            sys.exc_clear()
-
-        Sleep(0.1)
-
-
 # -----------------------------------------------------------------------------------
 #  Queue Class
 # -----------------------------------------------------------------------------------
@@ -615,7 +621,9 @@ class Queue(FIFO):
     def __init__(self):
         FIFO.__init__(self)
         self.channel  = stackless.channel()
-        self.blockingThreadRunning = False
+        # Handing an item to a waiting tasklet makes it runnable, rather than
+        # switching to it, so that putting never interrupts the caller.
+        self.channel.preference = 1
 
     # -----------------------------------------------------------------------------------
     #  Queue - put
@@ -638,12 +646,10 @@ class Queue(FIFO):
     # -----------------------------------------------------------------------------------
     def non_blocking_put(self, x):
 
-        # Create a non blocking worker thread if this is the first time this gets called
-        if not self.blockingThreadRunning:
-            self.blockingThreadRunning = True
-            new(QueueCheck, weakref.proxy(self)).context = "uthread::QueueCheck"
-
+        # A waiting tasklet gets the item straight away, but as the channel
+        # prefers the sender it does not run until the caller yields.
         self.push(x)
+        self.pump()
 
     # -----------------------------------------------------------------------------------
     #  Queue - get
@@ -723,22 +729,95 @@ def LockCheck():
 new(LockCheck).context = "uthread::LockCheck"
 
 __uthread__queue__          = None
+
+# The pool starts with poolMinHelpers helper tasklets.  A helper is idle
+# from when it finishes a job until it takes the next one.  When a helper
+# takes a job and no other is idle, another is started.  There is no upper
+# limit, as a job may block until another pooled job runs.  A helper which
+# finishes a job when poolMaxIdleHelpers are already idle exits instead,
+# leaving at least poolMinHelpers.
+poolMinHelpers              = 4
+poolMaxIdleHelpers          = 8
+poolHelperCount             = 0
+poolIdleHelpers             = 0
+
+# ctx: [jobs, total queue wait, max queue wait, total run time, max run time]
+poolStats                   = {}
+
+def GetPoolStats():
+    '''
+    Returns a dictionary for each context which jobs have been pooled under,
+    of the number of jobs run, and the total and longest times in seconds
+    the jobs waited in the queue and took to run.
+    '''
+    stats = {}
+    for ctx, (jobs, queueWait, maxQueueWait, runTime, maxRunTime) in poolStats.iteritems():
+        stats[ctx] = {
+            "jobs": jobs,
+            "queueWait": queueWait,
+            "maxQueueWait": maxQueueWait,
+            "runTime": runTime,
+            "maxRunTime": maxRunTime,
+        }
+    return stats
+
+def ResetPoolStats():
+    poolStats.clear()
+
+def RecordPoolJob(ctx, queueWait, runTime):
+    '''
+    Function for internal uthread.py usage.
+    '''
+    entry = poolStats.get(ctx, None)
+    if entry is None:
+        entry = poolStats[ctx] = [ 0, 0.0, 0.0, 0.0, 0.0 ]
+    entry[0] += 1
+    entry[1] += queueWait
+    entry[3] += runTime
+    if queueWait > entry[2]:
+        entry[2] = queueWait
+    if runTime > entry[4]:
+        entry[4] = runTime
+
+def StartPoolHelper(queue):
+    '''
+    Function for internal uthread.py usage.
+    '''
+    global poolHelperCount
+    poolHelperCount += 1
+    new(PoolHelper, queue).context = "uthread::PoolHelper"
+
 def PoolHelper(queue):
+    global poolHelperCount, poolIdleHelpers
     t = stackless.getcurrent()
     t.localStorage   = {}
     respawn = True
     try:
         try:
             while 1:
-                BeNice()
-                ctx, callingContext, func, args, keywords = queue.get()
-                if (queue.channel.balance >= 0):
-                    new(PoolHelper, queue).context = "uthread::PoolHelper"
+                if poolIdleHelpers >= poolMaxIdleHelpers and poolHelperCount > poolMinHelpers:
+                    respawn = False
+                    break
+                poolIdleHelpers += 1
+                try:
+                    # Let other tasklets run between jobs, but wait for a new job
+                    # on the queue itself so that it is handed over at once.
+                    if queue.Length():
+                        BeNice()
+                    job = queue.get()
+                finally:
+                    poolIdleHelpers -= 1
+                ctx, callingContext, func, args, keywords, queueTime = job
+                job = None
+                if not poolIdleHelpers:
+                    StartPoolHelper(queue)
                 #SetLocalStorage(loc)
                 # _tmpctx = t.PushTimer(ctx)
+                startTime = time.time()
                 try:
                     apply( func, args, keywords )
                 finally:
+                    RecordPoolJob(ctx, startTime - queueTime, time.time() - startTime)
                     ctx                 = None
                     callingContext      = None
                     func                = None
@@ -758,9 +837,10 @@ def PoolHelper(queue):
             StackTrace("Unhandled exception in %s%s" % (ctx, extra))
             sys.exc_clear()
     finally:
+        poolHelperCount -= 1
         if respawn:
             del t
-            new(PoolHelper, queue).context = "uthread::PoolHelper"
+            StartPoolHelper(queue)
 
 def PoolWorker(ctx,func,*args,**keywords):
     '''
@@ -794,13 +874,13 @@ def PoolWithoutTheStars(ctx,func,args,keywords,unsafe=0,worker=0):
 
     if __uthread__queue__ is None:
         __uthread__queue__ = Queue()
-        for i in range(60):
-            new(PoolHelper, __uthread__queue__).context = "uthread::PoolHelper"
+        for i in range(poolMinHelpers):
+            StartPoolHelper(__uthread__queue__)
     #if unsafe or worker:
     #    st = None
     #else:
     #    st = copy.copy(GetLocalStorage())
-    __uthread__queue__.non_blocking_put( (str(ctx), callingContext, func, args, keywords,) )
+    __uthread__queue__.non_blocking_put( (str(ctx), callingContext, func, args, keywords, time.time(),) )
     return None
 
 def Pool(ctx,func,*args,**keywords):